@@ -1,7 +1,10 @@
 import random
 import re
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from threading import Event
+from threading import Event, Lock
+from time import monotonic
 
 from slack_bolt import App, BoltResponse
 from slack_bolt.adapter.socket_mode import SocketModeHandler
@@ -11,9 +14,19 @@ from slack_sdk.errors import SlackApiError
 
 from workspace.techsupport.jobs import get_dates_from_config as get_tech_support_dates
 
-from . import job_configs, scheduler, settings
+from . import job_configs, metrics, scheduler, settings
 from .logger import log_call, logger
-from .slack import notify_slack
+from .slack import notify_slack, slack_web_client
+from .users import UserDirectory
+
+
+# Maximum number of channels to join at once when the bot starts
+MAX_CONCURRENT_JOINS = 10
+
+# Every event is checked against those already handled, so rather than writing to
+# the database for each one, the numbers of hits and misses are counted in memory
+# and recorded at most this often (in seconds)
+DEDUP_METRICS_INTERVAL = 60
 
 
 class SocketModeCheckHandler(SocketModeHandler):
@@ -35,57 +48,135 @@ class SocketModeCheckHandler(SocketModeHandler):
 
 def run():  # pragma: no cover
     """Start the bot running."""
-    app = App(
-        token=settings.SLACK_BOT_TOKEN,
-        signing_secret=settings.SLACK_SIGNING_SECRET,
-        # enable @app.error handler to catch the patterns we don't specifically handle
-        raise_error_for_unhandled_request=True,
+    app = build_app(signing_secret=settings.SLACK_SIGNING_SECRET)
+    handler = SocketModeCheckHandler(
+        app,
+        settings.SLACK_APP_TOKEN,
+        # the number of threads that dispatch events received from the socket
+        concurrency=settings.BOT_MAX_CONCURRENT_EVENTS,
     )
-    handler = SocketModeCheckHandler(app, settings.SLACK_APP_TOKEN)
 
-    bot_user_id, internal_user_ids = get_users_info(app.client)
+    bot_user_id, users = get_users_info(app.client)
     channels = get_channels(app.client)
     join_all_channels(app.client, channels, bot_user_id)
-    register_listeners(
-        app, job_configs.config, channels, bot_user_id, internal_user_ids
-    )
+    register_listeners(app, job_configs.config, channels, bot_user_id, users)
     handler.start()
     logger.info("Connected")
 
 
-def get_users_info(client):
-    users = {user["name"]: user for user in client.users_list()["members"]}
-    internal_user_ids = {
-        user["id"]
-        for user in users.values()
-        if not user["is_bot"] and not user.get("is_restricted", True)
-    }
-    return users[settings.SLACK_APP_USERNAME]["id"], internal_user_ids
+class RecentlySeen:
+    """A bounded record of keys seen in the last BOT_DEDUP_TTL seconds, used to
+    spot events that have already been handled."""
+
+    def __init__(self):
+        # key -> time seen, oldest first
+        self._seen = OrderedDict()
+        self._lock = Lock()
+        # (kind, result) -> count since metrics were last recorded
+        self._counts = Counter()
+        self._counted_since = monotonic()
+
+    def check(self, kind, key):
+        """Return whether key has been seen recently, and record that it has."""
+
+        now = monotonic()
+        with self._lock:
+            while self._seen and (
+                now - next(iter(self._seen.values())) >= settings.BOT_DEDUP_TTL
+            ):
+                self._seen.popitem(last=False)
+            seen = (kind, key) in self._seen
+            if not seen:
+                if len(self._seen) >= settings.BOT_DEDUP_MAX_SIZE:
+                    self._seen.popitem(last=False)
+                self._seen[(kind, key)] = now
+            self._counts[(kind, "hit" if seen else "miss")] += 1
+            counts = None
+            if now - self._counted_since >= DEDUP_METRICS_INTERVAL:
+                counts, self._counts = self._counts, Counter()
+                self._counted_since = now
+        if counts is not None:
+            self._record_counts(counts)
+        return seen
+
+    def forget(self, kind, key):
+        """Forget that key has been seen, so that it's handled again."""
+
+        with self._lock:
+            self._seen.pop((kind, key), None)
+
+    def _record_counts(self, counts):
+        for (kind, result), amount in counts.items():
+            metrics.inc(
+                "bennettbot_slack_event_dedup_total", amount, kind=kind, result=result
+            )
+
 
+def build_app(signing_secret=None):
+    """Build the App, with a listener pool of BOT_MAX_CONCURRENT_EVENTS threads.
+
+    Bolt already runs listeners in a pool of threads once events have been
+    acknowledged, but its default pool only has 5 threads.
+    """
+    return App(
+        # use our client, which keeps to Slack's rate limits
+        client=slack_web_client(),
+        signing_secret=signing_secret,
+        # enable @app.error handler to catch the patterns we don't specifically handle
+        raise_error_for_unhandled_request=True,
+        listener_executor=ThreadPoolExecutor(
+            max_workers=settings.BOT_MAX_CONCURRENT_EVENTS,
+            thread_name_prefix="bennettbot-listener",
+        ),
+    )
 
-def user_is_guest(client, user_id):
-    user = client.users_info(user=user_id)["user"]
-    return user.get("is_restricted", True)
+
+def get_users_info(client):
+    users = UserDirectory(client)
+    users.load()
+    return users.get_id_by_name(settings.SLACK_APP_USERNAME), users
 
 
 def get_channels(client):
     return {
         channel["name"]: channel["id"]
-        for channel in client.conversations_list(types="public_channel", limit=1000)[
-            "channels"
-        ]
+        for page in client.conversations_list(
+            types="public_channel", exclude_archived=True, limit=1000
+        )
+        for channel in page["channels"]
         if not channel["is_archived"]
     }
 
 
+def get_member_channel_ids(client, user_id):
+    """Return the ids of the public channels that the user is a member of."""
+    return {
+        channel["id"]
+        for page in client.users_conversations(
+            user=user_id, types="public_channel", exclude_archived=True, limit=1000
+        )
+        for channel in page["channels"]
+    }
+
+
 def join_all_channels(client, channels, user_id):
-    joined = []
-    for channel_name, channel_id in channels.items():
-        if user_id not in client.conversations_members(channel=channel_id)["members"]:
-            logger.info("Bot user joining channel", channel=channel_name)
-            client.conversations_join(channel=channel_id, users=user_id)
-            joined.append(channel_name)
-    return joined
+    member_channel_ids = get_member_channel_ids(client, user_id)
+    to_join = {
+        channel_name: channel_id
+        for channel_name, channel_id in channels.items()
+        if channel_id not in member_channel_ids
+    }
+
+    def join(channel_name, channel_id):
+        logger.info("Bot user joining channel", channel=channel_name)
+        client.conversations_join(channel=channel_id, users=user_id)
+
+    # Our client keeps to the rate limit for conversations.join, so this only
+    # limits how many threads wait for it
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOINS) as executor:
+        # list() so that any exception is raised here
+        list(executor.map(join, to_join.keys(), to_join.values()))
+    return list(to_join)
 
 
 def tech_support_out_of_office():
@@ -95,7 +186,7 @@ def tech_support_out_of_office():
         return end
 
 
-def register_listeners(app, config, channels, bot_user_id, internal_user_ids):
+def register_listeners(app, config, channels, bot_user_id, users):
     """
     Register listeners for this app
 
@@ -104,6 +195,7 @@ def register_listeners(app, config, channels, bot_user_id, internal_user_ids):
     - A tech-support listener
     - An error handler
     - A listener for new channels
+    - Listeners for new and changed users
 
     The listeners are defined inside this function to allow different config to be
     passed in for tests.
@@ -124,6 +216,25 @@ def register_listeners(app, config, channels, bot_user_id, internal_user_ids):
         r".*(^|[^\w\-/])tech-support($|[^\w\-]).*", flags=re.I
     )
 
+    recently_seen = RecentlySeen()
+
+    @app.middleware
+    def skip_duplicate_events(body, next_):
+        """Ignore events that Slack has already delivered."""
+        if "event_id" in body and recently_seen.check("event", body["event_id"]):
+            logger.info("Ignoring duplicate event", event_id=body["event_id"])
+            return BoltResponse(status=200, body="Duplicate event")
+        return next_()
+
+    bot_mention_regex = re.compile(
+        (
+            rf".*"  # allow anything before the bot mention
+            rf"(<@{bot_user_id}(|.+)?>)"  # match either <@bot_id> or <"bot_id|bot_name">
+            rf"(?P<text_match>.*)"  # capture everything else (including nothing) in a named group
+        ),
+        flags=re.X,  # ignore whitespace in the regex
+    )
+
     @app.event(
         "app_mention",
         # Don't match app mentions that include tech support keywords; these will be
@@ -187,15 +298,7 @@ def register_listeners(app, config, channels, bot_user_id, internal_user_ids):
             # If the bot isn't mentioned, it's a DM and we expect to receive
             # a message with just a command (but allowing for spurious whitespace
             # and punctuation, which we'll deal with later
-            text_match = re.match(
-                (
-                    rf".*"  # allow anything before the bot mention
-                    rf"(<@{bot_user_id}(|.+)?>)"  # match either <@bot_id> or <"bot_id|bot_name">
-                    rf"(?P<text_match>.*)"  # capture everything else (including nothing) in a named group
-                ),
-                text,
-                flags=re.X,  # ignore whitespace in the regex
-            )
+            text_match = bot_mention_regex.match(text)
             text = text_match.group("text_match")
 
         # handle extra whitespace and punctuation
@@ -207,26 +310,26 @@ def register_listeners(app, config, channels, bot_user_id, internal_user_ids):
             handle_status(event, say)
             return
 
+        if text == "status history" or text.startswith("status history "):
+            job_type = text.removeprefix("status history").strip() or None
+            handle_status_history(event, say, job_type)
+            return
+
         if text.startswith("remove job id"):
             handle_remove_job(app, event, say, text)
             return
 
-        for slack_config in config["slack"]:
-            if slack_config["regex"].match(text):
-                if not user_has_permission(
-                    app, event, say, text, config["restricted"], internal_user_ids
-                ):
-                    return
-                handle_command(app, event, say, slack_config, is_im=is_im)
+        if slack_config := job_configs.find_slack_config(config, text):
+            if not user_has_permission(event, say, text, config["restricted"], users):
                 return
+            handle_command(app, event, say, slack_config, is_im=is_im)
+            return
 
-        for namespace, help_config in config["help"].items():
-            for pattern in [f"^{namespace} help$", f"^help {namespace}$"]:
-                if re.match(pattern, text):
-                    handle_namespace_help(
-                        event, say, help_config, config["restricted"][namespace]
-                    )
-                    return
+        if namespace := config["help_commands"].get(text):
+            handle_namespace_help(
+                event, say, config["help"][namespace], config["restricted"][namespace]
+            )
+            return
 
         include_apology = text != "help"
         handle_help(event, say, config, include_apology)
@@ -285,31 +388,44 @@ def register_listeners(app, config, channels, bot_user_id, internal_user_ids):
         # We don't use the matcher for this, because we want to tell users to
         # call for support from a non-dm channel
         if event["channel_type"] in ["channel", "group"]:
-            # Respond with reaction
-            # If we've already responded, the attempt to react here will raise
-            # an exception; if this happens, then the user is editing something
-            # other than the keyword in the message, and we don't need to repost
-            # it again. We let the default error handler will deal with it.
+            # If we've recently reposted this message, the user is editing
+            # something other than the keyword in the message, and we don't need
+            # to repost it again.
+            key = (channel, message["ts"], keyword)
+            if recently_seen.check("support_request", key):
+                logger.info(
+                    f"Already handled {keyword} message", message=message["text"]
+                )
+                return
             reaction = {"tech-support": "sos", "bennett-admins": "flamingo"}[keyword]
-            app.client.reactions_add(
-                channel=channel, timestamp=message["ts"], name=reaction
-            )
-            logger.info(f"Received {keyword} message", message=message["text"])
-            if keyword == "tech-support":
-                # If out of office, respond with an ooo message, but still repost to channel
-                out_of_office_until = tech_support_out_of_office()
-                if out_of_office_until:
-                    logger.info("Tech support OOO", until=out_of_office_until)
-                    say(
-                        f"tech-support is currently out of office and will respond after {out_of_office_until}",
-                        channel=channel,
-                        thread_ts=message["ts"],
-                    )
-
-            message_url = app.client.chat_getPermalink(
-                channel=channel, message_ts=message["ts"]
-            )["permalink"]
-            say(message_url, channel=channel_id)
+            try:
+                # Respond with reaction
+                # If we've already responded longer ago than we remember, the
+                # attempt to react here will raise an exception, and we let the
+                # default error handler deal with it.
+                app.client.reactions_add(
+                    channel=channel, timestamp=message["ts"], name=reaction
+                )
+                logger.info(f"Received {keyword} message", message=message["text"])
+                if keyword == "tech-support":
+                    # If out of office, respond with an ooo message, but still repost to channel
+                    out_of_office_until = tech_support_out_of_office()
+                    if out_of_office_until:
+                        logger.info("Tech support OOO", until=out_of_office_until)
+                        say(
+                            f"tech-support is currently out of office and will respond after {out_of_office_until}",
+                            channel=channel,
+                            thread_ts=message["ts"],
+                        )
+
+                message_url = app.client.chat_getPermalink(
+                    channel=channel, message_ts=message["ts"]
+                )["permalink"]
+                say(message_url, channel=channel_id)
+            except Exception:
+                # Forget the message, so that we try again if the user edits it
+                recently_seen.forget("support_request", key)
+                raise
         else:
             say(
                 f"Sorry, I can't call {keyword} from this conversation.",
@@ -324,6 +440,13 @@ def register_listeners(app, config, channels, bot_user_id, internal_user_ids):
         logger.info("Bot user joining channel", name=channel["name"], id=channel["id"])
         app.client.conversations_join(channel=channel["id"], users=bot_user_id)
 
+    @app.event("team_join")
+    @app.event("user_change")
+    def update_user(event, ack):
+        ack()
+        logger.info(f"Received {event['type']} event", user=event["user"]["id"])
+        users.update(event["user"])
+
     @app.error
     def handle_errors(error, body):
         if "message" in body["event"]:
@@ -372,6 +495,14 @@ def handle_status(message, say):
     say(status, thread_ts=message.get("thread_ts"))
 
 
+@log_call
+def handle_status_history(message, say, job_type):
+    """Report durations of recent runs of jobs (of given type) back to Slack."""
+
+    status = _build_status_history(job_type)
+    say(status, thread_ts=message.get("thread_ts"))
+
+
 @log_call
 def handle_remove_job(app, message, say, text):
     """Remove a job from the database so it can be rerun."""
@@ -393,6 +524,7 @@ def handle_remove_job(app, message, say, text):
 def _build_status():
     running_jobs = []
     scheduled_jobs = []
+    capped_jobs = scheduler.get_capped_jobs(job_configs.config)
 
     for j in scheduler.get_jobs():
         if j["started_at"]:
@@ -421,9 +553,15 @@ def _build_status():
         lines.append(_pluralise(len(scheduled_jobs), "scheduled job:"))
         lines.append("")
         for j in scheduled_jobs:
-            lines.append(
-                f"* [{j['id']}] {j['type']} (starting after {j['start_after']})"
-            )
+            if j["id"] in capped_jobs:
+                lines.append(
+                    f"* [{j['id']}] {j['type']} (due since {j['start_after']}; "
+                    f"waiting because {capped_jobs[j['id']]})"
+                )
+            else:
+                lines.append(
+                    f"* [{j['id']}] {j['type']} (starting after {j['start_after']})"
+                )
         lines.append("")
 
     if active_suppressions:
@@ -452,6 +590,49 @@ def _build_status():
     return "\n".join(lines).strip()
 
 
+def _build_status_history(job_type):
+    stats = scheduler.get_job_run_stats(job_type)
+    if not stats:
+        if job_type:
+            return f"No runs of {job_type} found"
+        return "No job runs found"
+
+    lines = [
+        f"Job runs in the last {settings.JOB_RUN_RETENTION_DAYS} days "
+        "(time queued and time taken are shown as p50 / p95):",
+        "",
+    ]
+    for s in stats:
+        lines.append(
+            f"* {s['type']}: {_pluralise_count(s['runs'], 'run')} "
+            f"({s['failures']} failed), "
+            f"queued {_format_seconds(s['queue_p50'])} / {_format_seconds(s['queue_p95'])}, "
+            f"took {_format_seconds(s['duration_p50'])} / {_format_seconds(s['duration_p95'])}"
+        )
+
+    if job_type:
+        lines.extend(["", "Most recent runs:", ""])
+        for r in scheduler.get_job_runs(job_type):
+            lines.append(
+                f"* [{r['job_id']}] started at {r['started_at']}, "
+                f"took {_format_seconds(r['duration_seconds'])}, "
+                f"return code {r['rc']}"
+            )
+
+    return "\n".join(lines)
+
+
+def _format_seconds(seconds):
+    return f"{seconds:.1f}s"
+
+
+def _pluralise_count(n, noun):
+    if n == 1:
+        return f"1 {noun}"
+    else:
+        return f"{n} {noun}s"
+
+
 def _pluralise(n, noun):
     if n == 1:
         return f"There is 1 {noun}"
@@ -459,22 +640,15 @@ def _pluralise(n, noun):
         return f"There are {n} {noun}s"
 
 
-def user_has_permission(app, event, say, text, restricted_config, internal_user_ids):
+def user_has_permission(event, say, text, restricted_config, users):
     user_id = event["user"]
-    # Internal users can do everything
-    if user_id in internal_user_ids:
-        return True
     # Unrestricted namespace jobs can be run by anyone
     namespace = text.split()[0]
     if not restricted_config[namespace]:
         return True
-    # This is a job in a restricted namespace
-    # There's a possibility this is a new user that we haven't registered in
-    # internal_user_ids, so before rejecting them, fetch their info and
-    # check that they really are a guest user.
-    # It's unlikely that guest users will try to call bot commands often, so it's
-    # not too much of a burden to run this check if/whenthey do
-    if not user_is_guest(app.client, user_id):
+    # This is a job in a restricted namespace, which can only be run by users who
+    # aren't guests
+    if not users.is_guest(user_id):
         return True
 
     # User doesn't have permission, tell them so nicely before returning
@@ -625,6 +799,10 @@ def handle_help(message, say, config, include_apology):
         f"Enter `{prefix}[category] help` (e.g. `{prefix}{random.choice(list(config['help']))} help`) for more help"
     )
     lines.append(f"Enter `{prefix}status` to see running and scheduled jobs")
+    lines.append(
+        f"Enter `{prefix}status history [job_type]` to see how long recent jobs "
+        "(of that type) were queued for and took to run"
+    )
     lines.append(
         f"Enter `{prefix}remove job id [id]` to remove a job; this will not "
         "cancel jobs that are in progress, but will let you retry a job that "
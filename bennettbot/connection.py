@@ -1,36 +1,296 @@
+import math
+import os
 import sqlite3
+import threading
+import time
 
 from . import settings
 
 
-SCHEMA = """
-CREATE TABLE IF NOT EXISTS job (
-    id INTEGER PRIMARY KEY,
-    type TEXT NOT NULL,
-    args TEXT,
-    channel TEXT,
-    thread_ts TEXT,
-    start_after DATETIME,
-    started_at DATETIME,
-    is_im BOOLEAN
-);
+# Each migration is a list of statements that are run in a single transaction.
+# The database's user_version records how many migrations have been applied, so
+# migrations must only ever be appended to this list.
+MIGRATIONS = [
+    # 1: initial schema
+    [
+        """
+        CREATE TABLE IF NOT EXISTS job (
+            id INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            args TEXT,
+            channel TEXT,
+            thread_ts TEXT,
+            start_after DATETIME,
+            started_at DATETIME,
+            is_im BOOLEAN
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS suppression (
+            id INTEGER PRIMARY KEY,
+            job_type TEXT NOT NULL,
+            start_at DATETIME,
+            end_at DATETIME
+        )
+        """,
+    ],
+    # 2: indexes for the queries run by the dispatcher and schedule_job
+    [
+        "CREATE INDEX job_started_at_start_after ON job (started_at, start_after)",
+        "CREATE INDEX job_type_started_at ON job (type, started_at)",
+        "CREATE INDEX suppression_job_type_start_at_end_at ON suppression (job_type, start_at, end_at)",
+        "CREATE INDEX suppression_start_at ON suppression (start_at)",
+        "CREATE INDEX suppression_end_at ON suppression (end_at)",
+    ],
+    # 3: history of job runs
+    [
+        """
+        CREATE TABLE job_run (
+            id INTEGER PRIMARY KEY,
+            job_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            args TEXT,
+            channel TEXT,
+            start_after DATETIME,
+            started_at DATETIME,
+            finished_at DATETIME,
+            queue_seconds REAL,
+            duration_seconds REAL,
+            rc INTEGER
+        )
+        """,
+        "CREATE INDEX job_run_type_finished_at ON job_run (type, finished_at)",
+        "CREATE INDEX job_run_finished_at ON job_run (finished_at)",
+    ],
+    # 4: counters and histograms, which are updated by every process (see metrics.py)
+    [
+        """
+        CREATE TABLE metric (
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            suffix TEXT NOT NULL,
+            le REAL NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (name, labels, suffix, le)
+        )
+        """,
+    ],
+    # 5: messages waiting to be sent to Slack (see outbox.py)
+    [
+        """
+        CREATE TABLE outbox (
+            id INTEGER PRIMARY KEY,
+            channel TEXT NOT NULL,
+            thread_ts TEXT,
+            message TEXT NOT NULL,
+            message_format TEXT,
+            repost_to TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            send_after DATETIME NOT NULL
+        )
+        """,
+        "CREATE INDEX outbox_channel_thread_ts ON outbox (channel, thread_ts)",
+    ],
+    # 6: support requests found by the MessageChecker (see dispatcher.py)
+    [
+        """
+        CREATE TABLE checked_message (
+            keyword TEXT NOT NULL,
+            channel TEXT NOT NULL,
+            ts TEXT NOT NULL,
+            PRIMARY KEY (keyword, channel, ts)
+        )
+        """,
+        """
+        CREATE TABLE message_check (
+            keyword TEXT PRIMARY KEY,
+            last_checked_at DATETIME NOT NULL
+        )
+        """,
+    ],
+    # 7: counts of the changes that processes wait for (see wait_for_change)
+    [
+        """
+        CREATE TABLE change_count (
+            name TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        )
+        """,
+    ],
+]
 
-CREATE TABLE IF NOT EXISTS suppression (
-    id INTEGER PRIMARY KEY,
-    job_type TEXT NOT NULL,
-    start_at DATETIME,
-    end_at DATETIME
-);
-"""
+# Connections are cached per thread, since the bot runs its listeners in a thread
+# pool and sqlite3 connections shouldn't be used by more than one thread at once.
+# Each cached connection records the pid of the process that opened it, so that a
+# process forked from the dispatcher (see JobDispatcher.start_job) never reuses
+# its parent's connection, and the generation it was opened in, so that
+# reset_connections() invalidates connections held by every thread.
+_local = threading.local()
+_lock = threading.Lock()
+_generation = 0
+_connections = []
+_initialised_paths = set()
+_stats = {"opened": 0, "reused": 0}
 
 
 def get_connection():
-    """Return connection to database, ensuring tables exist."""
+    """Return connection to database, ensuring it has been migrated.
 
+    The connection is opened on first use in each process and thread, and is
+    reused by subsequent calls.
+    """
+
+    db_path = str(settings.DB_PATH)
+    key = (os.getpid(), _generation, db_path)
+
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.key == key:
+        _stats["reused"] += 1
+        return conn
+
+    conn = _connect(db_path)
+    _local.conn = conn
+    _local.key = key
+    _stats["opened"] += 1
+    return conn
+
+
+def _connect(db_path):
     def dict_factory(cursor, row):
         return {col[0]: row[ix] for ix, col in enumerate(cursor.description)}
 
-    conn = sqlite3.connect(settings.DB_PATH)
+    # Connections are only ever used by the thread that opened them, but
+    # reset_connections() may close them from another thread
+    conn = sqlite3.connect(
+        db_path,
+        timeout=settings.DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+    )
     conn.row_factory = dict_factory
-    conn.executescript(SCHEMA)
+    apply_pragmas(conn)
+
+    with _lock:
+        if db_path not in _initialised_paths:
+            # The journal mode is stored in the database file, so only needs to
+            # be set once
+            conn.execute(f"PRAGMA journal_mode = {settings.DB_JOURNAL_MODE}")
+            migrate(conn)
+            _initialised_paths.add(db_path)
+        _connections.append((os.getpid(), conn))
+
     return conn
+
+
+def migrate(conn):
+    """Apply any migrations that haven't yet been applied to the database."""
+
+    with conn:
+        # Take the write lock before checking the version, so that if several
+        # processes start at once, only one of them applies each migration
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()["user_version"]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number:d}")
+
+
+def apply_pragmas(conn):
+    """Apply the per-connection pragmas configured in settings."""
+
+    conn.execute(f"PRAGMA busy_timeout = {settings.DB_BUSY_TIMEOUT_MS:d}")
+    conn.execute(f"PRAGMA synchronous = {settings.DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA mmap_size = {settings.DB_MMAP_SIZE:d}")
+    conn.execute(f"PRAGMA cache_size = {settings.DB_CACHE_SIZE:d}")
+
+
+def reset_connections():
+    """Close all connections opened by this process, so that the next call to
+    get_connection() in any thread opens a new connection and re-checks the
+    migrations.
+
+    This is needed if the database file is removed or replaced, as happens
+    between tests.
+    """
+
+    global _generation
+
+    with _lock:
+        pid = os.getpid()
+        for conn_pid, conn in _connections:
+            if conn_pid == pid:
+                conn.close()
+        _connections.clear()
+        _generation += 1
+        _initialised_paths.clear()
+
+
+def get_data_version():
+    """Return a number that changes whenever another connection commits a change
+    to the database.
+
+    See https://www.sqlite.org/pragma.html#pragma_data_version
+    """
+
+    conn = get_connection()
+    return conn.execute("PRAGMA data_version").fetchone()["data_version"]
+
+
+def record_change(conn, name):
+    """Increment the change count with the given name, as part of the transaction
+    that is in progress on conn, to wake processes waiting for it to change."""
+
+    conn.execute(
+        """
+        INSERT INTO change_count (name, count) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET count = count + 1
+        """,
+        [name],
+    )
+
+
+def get_change_count(name):
+    """Return the number of changes recorded with the given name."""
+
+    conn = get_connection()
+    row = conn.execute(
+        "SELECT count FROM change_count WHERE name = ?", [name]
+    ).fetchone()
+    return 0 if row is None else row["count"]
+
+
+def wait_for_change(name, change_count, timeout, poll_interval):
+    """Wait until another connection has recorded a change with the given name since
+    change_count was retrieved, or until timeout seconds have passed.
+
+    Many other changes are made to the database (e.g. to record metrics), so we
+    only wait for the changes that we're interested in.  Checking the data version
+    is much cheaper than running a query, so we check it frequently, and only read
+    the change count once another connection has committed a change.  Returns
+    whether a change was seen.
+    """
+
+    data_version = None
+    for _ in range(math.ceil(timeout / poll_interval)):
+        if (new_data_version := get_data_version()) != data_version:
+            data_version = new_data_version
+            if get_change_count(name) != change_count:
+                return True
+        time.sleep(poll_interval)
+    return get_change_count(name) != change_count
+
+
+def connection_stats():
+    """Return counts of connections opened and reused by this process."""
+
+    return dict(_stats)
+
+
+def _after_fork_in_child():
+    # Connections inherited from the parent must not be used or closed by the
+    # child, so we just forget about them
+    _connections.clear()
+    _stats.update(opened=0, reused=0)
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,9 +1,12 @@
+import contextlib
+import importlib
 import json
 import os
 import re
 import shlex
 import subprocess
 import sys
+import threading
 import time
 import traceback
 from datetime import datetime, timedelta, timezone
@@ -11,10 +14,17 @@ from multiprocessing import Process
 from pathlib import Path
 
 import requests
+from slack_sdk.errors import SlackApiError
 
-from . import job_configs, scheduler, settings
+from . import connection, job_configs, metrics, outbox, scheduler, settings
 from .logger import logger
-from .slack import notify_slack, slack_web_client
+from .slack import notify_slack, slack_web_client, update_slack_message
+
+
+# Slack's search index can take a while to show new messages, and Slack's dates may
+# be in a different timezone from ours, so the MessageChecker searches for messages
+# from a little before its last successful check
+MESSAGE_SEARCH_GRACE = timedelta(hours=2)
 
 
 def run():  # pragma: no cover
@@ -22,14 +32,20 @@ def run():  # pragma: no cover
     slack_client = slack_web_client(token_type="bot")
     checker = MessageChecker(slack_client, slack_web_client(token_type="user"))
     checker.run_check()
+    outbox.start_sender()
+    preload_entrypoints(job_configs.config)
     while True:
+        change_count = connection.get_change_count(scheduler.CHANGE_NAME)
         run_once(slack_client, job_configs.config)
-        time.sleep(1)
+        wait_for_work(change_count)
 
 
 def run_once(slack_client, config):
-    """Clear any expired suppressions, then start a new subprocess for each
-    available job.
+    """Clear any expired suppressions, then reserve all available jobs and start a
+    new subprocess for each of them.
+
+    See scheduler.reserve_jobs() for how the priorities and concurrency limits in
+    config affect which jobs are reserved.
 
     We collect and return started processes so that we can wait for them to
     finish in tests before asserting the tests have done anything.
@@ -37,21 +53,62 @@ def run_once(slack_client, config):
     scheduler.remove_expired_suppressions()
 
     processes = []
-    while True:
-        job_id = scheduler.reserve_job()
-        if job_id is None:
-            break
-        job_dispatcher = JobDispatcher(slack_client, job_id, config)
+    for job in scheduler.reserve_jobs(config=config):
+        job_dispatcher = JobDispatcher(slack_client, job, config)
         processes.append(job_dispatcher.start_job())
 
     return processes
 
 
+def wait_for_work(change_count):
+    """Sleep until the next job becomes due or the next suppression expires.
+
+    We wake up early if another process schedules or cancels a job, a running job
+    finishes, or a suppression is added or removed after change_count was retrieved
+    (see scheduler.CHANGE_NAME).
+    """
+    timeout = settings.DISPATCHER_MAX_SLEEP
+    next_due_time = scheduler.get_next_due_time()
+    if next_due_time is not None:
+        seconds_until_due = (next_due_time - datetime.now(timezone.utc)).total_seconds()
+        timeout = max(min(timeout, seconds_until_due), 0)
+    connection.wait_for_change(
+        scheduler.CHANGE_NAME,
+        change_count,
+        timeout,
+        settings.DISPATCHER_POLL_INTERVAL,
+    )
+
+
+def preload_entrypoints(config):
+    """Import the modules containing the entrypoints of jobs.
+
+    Jobs with an entrypoint are run in the process that is forked from the
+    dispatcher for each job, so importing their modules (and everything those
+    modules import) once here means that this doesn't need to be done each time a
+    job is run.
+    """
+    for job_type, job_config in config["jobs"].items():
+        if job_config["entrypoint"] is None:
+            continue
+        try:
+            load_entrypoint(job_config["entrypoint"])
+        except Exception as error:
+            # The error will be reported when the job is run
+            logger.error("Could not load entrypoint", job_type=job_type, error=error)
+
+
+def load_entrypoint(entrypoint):
+    """Return the function referred to by an entrypoint such as "package.module:fn"."""
+    module_name, function_name = entrypoint.split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
 class JobDispatcher:
-    def __init__(self, slack_client, job_id, config):
-        logger.info("starting job", job_id=job_id)
+    def __init__(self, slack_client, job, config):
+        logger.info("starting job", job_id=job["id"])
         self.slack_client = slack_client
-        self.job = scheduler.get_job(job_id)
+        self.job = job
         self.job_config = config["jobs"][self.job["type"]]
 
         self.namespace = self.job["type"].split("_")[0]
@@ -75,8 +132,11 @@ class JobDispatcher:
         self.set_up_log_dir()
         self.notify_start()
         rc = self.run_command()
-        scheduler.mark_job_done(self.job["id"])
+        scheduler.mark_job_done(self.job["id"], rc=rc)
         self.notify_end(rc)
+        # The job's process exits without running atexit handlers, so metrics that
+        # it has buffered would otherwise be lost
+        metrics.flush()
 
     def run_command(self):
         """Run the command, writing stdout/stderr to separate files."""
@@ -92,30 +152,99 @@ class JobDispatcher:
 
         with open(self.stdout_path, "w") as stdout, open(
             self.stderr_path, "w"
-        ) as stderr:
-            try:
-                rv = subprocess.run(
-                    self.run_args,
-                    cwd=self.cwd,
-                    stdout=stdout,
-                    stderr=stderr,
-                    env={**os.environ, "PYTHONPATH": settings.APPLICATION_ROOT},
-                    shell=True,
-                )
-                rc = rv.returncode
-            except Exception:  # pragma: no cover
-                traceback.print_exception(*sys.exc_info(), file=stderr)
-                rc = -1
+        ) as stderr, self.report_progress():
+            if self.job_config["entrypoint"] is not None:
+                rc = self.run_entrypoint(stdout, stderr)
+            else:
+                rc = self.run_shell_command(stdout, stderr)
 
         logger.info("run_command", rc=rc)
         logger.info("run_command }")
         return rc
 
+    def run_shell_command(self, stdout, stderr):
+        """Run the command in a shell."""
+
+        try:
+            rv = subprocess.run(
+                self.run_args,
+                cwd=self.cwd,
+                stdout=stdout,
+                stderr=stderr,
+                env={**os.environ, "PYTHONPATH": settings.APPLICATION_ROOT},
+                shell=True,
+            )
+            return rv.returncode
+        except Exception:  # pragma: no cover
+            traceback.print_exception(*sys.exc_info(), file=stderr)
+            return -1
+
+    def run_entrypoint(self, stdout, stderr):
+        """Call the job's entrypoint function in this process.
+
+        This avoids starting a shell and a new Python interpreter, and importing
+        the job's dependencies, which for short jobs takes much longer than the job
+        itself.  The function is called with the arguments in run_args, in the same
+        way that a command line program's main() would be, and its return value is
+        used as the return code, with None meaning success.
+        """
+
+        with _redirect_output(stdout, stderr), contextlib.chdir(self.cwd):
+            try:
+                fn = load_entrypoint(self.job_config["entrypoint"])
+                rv = fn(shlex.split(self.run_args))
+            except SystemExit as e:
+                rv = e.code
+            except Exception:
+                traceback.print_exception(*sys.exc_info(), file=sys.stderr)
+                rv = 1
+
+            if rv is None:
+                return 0
+            if isinstance(rv, int):
+                return rv
+            # As with sys.exit(), any other value is printed, and indicates failure
+            print(rv, file=sys.stderr)
+            return 1
+
     def notify_start(self):
         """Send notification that command is about to start."""
 
         msg = f"Command `{self.job['type']}` about to start"
-        notify_slack(self.slack_client, settings.SLACK_LOGS_CHANNEL, msg)
+        outbox.enqueue_message(settings.SLACK_LOGS_CHANNEL, msg)
+
+    @contextlib.contextmanager
+    def report_progress(self):
+        """If the job is configured to report progress, post a message to Slack,
+        and keep it updated with the latest output while the job runs."""
+
+        if not self.job_config["report_progress"]:
+            yield
+            return
+
+        slack_message = notify_slack(
+            self.slack_client,
+            self.job["channel"],
+            f"Command `{self.job['type']}` is running",
+            thread_ts=self.job["thread_ts"],
+        )
+        if slack_message is None:
+            # We couldn't post the message, so there's nothing to update
+            yield
+            return
+
+        reporter = ProgressReporter(
+            self.slack_client,
+            slack_message["channel"],
+            slack_message["ts"],
+            self.job["type"],
+            self.stdout_path,
+        )
+        reporter.start()
+        try:
+            yield
+        finally:
+            reporter.stop()
 
     def notify_end(self, rc):
         """Send notification that command has ended, reporting stdout if
@@ -147,25 +276,19 @@ class JobDispatcher:
                 msg += "\nCalling tech-support."
             error = True
 
-        slack_message = notify_slack(
-            self.slack_client,
+        # If the command failed, repost it to tech-support
+        # Don't repost to tech-support if we're in a DM with the bot, because no-one
+        # else will be able to read the reposted message
+        # Note that the bot won't register messages from itself, so we can't just
+        # rely on the tech-support listener
+        repost = error and not self.job["is_im"]
+        outbox.enqueue_message(
             self.job["channel"],
             msg,
             thread_ts=self.job["thread_ts"],
             message_format=self.job_config["report_format"] if rc == 0 else "text",
+            repost_to=settings.SLACK_TECH_SUPPORT_CHANNEL if repost else None,
         )
-        if error and not self.job["is_im"]:
-            # If the command failed, repost it to tech-support
-            # Don't repost to tech-support if we're in a DM with the bot, because no-one
-            # else will be able to read the reposted message
-            # Note that the bot won't register messages from itself, so we can't just
-            # rely on the tech-support listener
-            message_url = self.slack_client.chat_getPermalink(
-                channel=slack_message["channel"], message_ts=slack_message["ts"]
-            )["permalink"]
-            self.slack_client.chat_postMessage(
-                channel=settings.SLACK_TECH_SUPPORT_CHANNEL, text=message_url
-            )
 
     def set_up_cwd(self):
         """Ensure cwd exists, and maybe refresh fabfile."""
@@ -185,7 +308,7 @@ class JobDispatcher:
             rsp.raise_for_status()
         except requests.RequestException as e:
             msg = f"Could not refresh {self.fabfile_url}: {e}"
-            notify_slack(self.slack_client, settings.SLACK_LOGS_CHANNEL, msg)
+            outbox.enqueue_message(settings.SLACK_LOGS_CHANNEL, msg)
             return
 
         with open(self.cwd / "fabfile.py", "w") as f:
@@ -202,6 +325,86 @@ class JobDispatcher:
         self.log_dir.mkdir(parents=True, exist_ok=True)
 
 
+class ProgressReporter:
+    """Update a Slack message with the end of a running job's stdout.
+
+    New output is read from the stdout file every JOB_PROGRESS_INTERVAL seconds,
+    and only the last JOB_PROGRESS_MAX_BYTES bytes are kept, so memory use
+    doesn't depend on how much the job writes.  The message is only updated if the
+    output has changed.
+    """
+
+    def __init__(self, slack_client, channel, ts, job_type, stdout_path):
+        self.slack_client = slack_client
+        self.channel = channel
+        self.ts = ts
+        self.job_type = job_type
+        self.stdout_path = stdout_path
+        self.position = 0
+        self.tail = b""
+        self.reported_text = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Stop updating the message, after reporting the job's final output."""
+        self.stopped.set()
+        self.thread.join()
+        self.update(finished=True)
+
+    def run(self):
+        while not self.stopped.wait(settings.JOB_PROGRESS_INTERVAL):
+            self.update()
+
+    def update(self, finished=False):
+        self.read_new_output()
+        # Since we may have cut a multi-byte character in half, replace anything we
+        # can't decode
+        output = self.tail.decode(errors="replace")
+        if finished:
+            text = f"Command `{self.job_type}` finished"
+        else:
+            text = f"Command `{self.job_type}` is running"
+        if output:
+            text += f"; latest output:\n```{output}```"
+        if text == self.reported_text:
+            return
+        if update_slack_message(self.slack_client, self.channel, self.ts, text):
+            self.reported_text = text
+
+    def read_new_output(self):
+        with open(self.stdout_path, "rb") as f:
+            f.seek(self.position)
+            while chunk := f.read(64 * 1024):
+                self.position += len(chunk)
+                self.tail = (self.tail + chunk)[-settings.JOB_PROGRESS_MAX_BYTES :]
+
+
+@contextlib.contextmanager
+def _redirect_output(stdout, stderr):
+    """Redirect stdout and stderr to the given files, both for Python code and at
+    the file descriptor level, so that output from subprocesses and extension
+    modules is captured too."""
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(1), os.dup(2)]
+    os.dup2(stdout.fileno(), 1)
+    os.dup2(stderr.fileno(), 2)
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            yield
+    finally:
+        stdout.flush()
+        stderr.flush()
+        for fd, saved_fd in zip([1, 2], saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+
+
 class MessageChecker:
     def __init__(self, bot_slack_client, user_slack_client):
         # The MessageChecker needs both a slack client with a bot token
@@ -228,27 +431,62 @@ class MessageChecker:
         p.start()
         return p
 
-    def do_check(self, run_fn=lambda: True, delay=10):  # pragma: no branch
+    def do_check(self, run_fn=lambda: True):  # pragma: no branch
         # In production, we want this check to run forever. Using a
         # function means that we can test it on a finite number of loops.
         # Note that the message search endpoint is a tier2 endpoint and is
         # rate limited at around 20 calls per min
         # https://api.slack.com/apis/rate-limits#tier_t2
-        # A 10s delay should be safe for our 2 calls per loop
+        # We make 2 calls per loop, and wait at least MESSAGE_CHECK_MIN_INTERVAL
+        # seconds between loops, and the slack client will wait (and retry if we
+        # are rate limited) if that's not enough
+        interval = None
         while run_fn():
-            # check for messages from today and yesterday; sometimes it seems to
-            # take a while for slack to return messages in search results, so
-            # make sure that messages sent late in the day still get picked up
-            today = datetime.today()
-            check_from = (today - timedelta(days=2)).strftime("%Y-%m-%d")
+            found = 0
             for keyword in self.config:
-                self.check_messages(keyword, check_from)
-            time.sleep(delay)
+                found += self.check_messages(keyword, self.get_check_from(keyword))
+            interval = self.get_next_interval(interval, found)
+            time.sleep(interval)
+
+    def get_next_interval(self, interval, found):
+        """Return the number of seconds to wait after a check, given how long we
+        waited after the previous one (if there was one).
+
+        We check again soon after finding messages, since there may be more, and
+        back off while there are none.
+        """
+        if found or interval is None:
+            return settings.MESSAGE_CHECK_MIN_INTERVAL
+        return min(interval * 2, settings.MESSAGE_CHECK_MAX_INTERVAL)
+
+    def get_check_from(self, keyword):
+        """Return the date to search for messages after.
+
+        We search for messages sent since MESSAGE_SEARCH_GRACE before the last
+        successful check, so while the dispatcher is running we usually only search
+        today's messages, and after it has stopped for a while we search from when
+        it stopped.  If there hasn't been a successful check, we search the last two
+        days.  (Slack returns messages from the days *after* the date.)
+        """
+        conn = connection.get_connection()
+        row = conn.execute(
+            "SELECT last_checked_at FROM message_check WHERE keyword = ?", [keyword]
+        ).fetchone()
+        if row is None:
+            check_from = datetime.today() - timedelta(days=1)
+        else:
+            check_from = (
+                datetime.fromisoformat(row["last_checked_at"]) - MESSAGE_SEARCH_GRACE
+            )
+        return (check_from - timedelta(days=1)).strftime("%Y-%m-%d")
 
     def check_messages(self, keyword, after):
+        """Handle messages with the keyword that haven't been reacted to, returning
+        the number of messages handled."""
         logger.debug("Checking %s messages", keyword)
         reaction = self.config[keyword]["reaction"]
         channel = self.config[keyword]["channel"]
+        checked_at = datetime.today()
         messages = self.user_slack_client.search_messages(
             query=(
                 # Search for messages with the keyword but without the expected reaction
@@ -261,10 +499,11 @@ class MessageChecker:
                 f"-from:@{settings.SLACK_APP_USERNAME} "
                 # exclude DMs as the auto-responders don't respond to these anyway
                 f"-is:dm "
-                # only include messages from today and yesterday
+                # only include recent messages
                 f"after:{after}"
             )
         )["messages"]["matches"]
+        handled = 0
         for message in messages:
             # remove any URLs from the message text; we don't want to match these
             text = re.sub(r"<http.+>", "", message["text"])
@@ -275,18 +514,79 @@ class MessageChecker:
                 # The re-posted text appears in a search, but we only want to
                 # react to original messages.
                 continue
+            # Until the search index shows our reaction, searches will keep finding
+            # messages that we've already handled
+            if self._is_checked(keyword, message):
+                continue
             logger.info(
                 "Found unreacted message", keyword=keyword, message=message["text"]
             )
             # add reaction
-            self.bot_slack_client.reactions_add(
-                channel=message["channel"]["id"], timestamp=message["ts"], name=reaction
+            try:
+                self.bot_slack_client.reactions_add(
+                    channel=message["channel"]["id"],
+                    timestamp=message["ts"],
+                    name=reaction,
+                )
+            except SlackApiError as error:
+                if error.response["error"] != "already_reacted":
+                    raise
+                # The bot has handled this message since it was indexed
+                self._mark_checked(keyword, message)
+                continue
+            # repost the message url to relevant channel; search results usually
+            # include the url
+            message_url = (
+                message.get("permalink")
+                or (
+                    self.bot_slack_client.chat_getPermalink(
+                        channel=message["channel"]["id"], message_ts=message["ts"]
+                    )["permalink"]
+                )
             )
-            # repost the message url to relevant channel
-            message_url = self.bot_slack_client.chat_getPermalink(
-                channel=message["channel"]["id"], message_ts=message["ts"]
-            )["permalink"]
             notify_slack(self.bot_slack_client, channel, message_url)
+            self._mark_checked(keyword, message)
+            handled += 1
+
+        self._record_check(keyword, after, checked_at)
+        return handled
+
+    def _is_checked(self, keyword, message):
+        conn = connection.get_connection()
+        row = conn.execute(
+            "SELECT 1 FROM checked_message WHERE keyword = ? AND channel = ? AND ts = ?",
+            [keyword, message["channel"]["id"], message["ts"]],
+        ).fetchone()
+        return row is not None
+
+    def _mark_checked(self, keyword, message):
+        with connection.get_connection() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO checked_message (keyword, channel, ts) VALUES (?, ?, ?)",
+                [keyword, message["channel"]["id"], message["ts"]],
+            )
+
+    def _record_check(self, keyword, after, checked_at):
+        """Record a successful check, and forget messages that are too old to be
+        found by future checks."""
+        # Future checks search from this check's date or later, so won't find
+        # messages sent before it.  (Slack's dates may be in a different timezone
+        # from ours, so we keep a day's grace.)
+        oldest_ts = (
+            datetime.strptime(after, "%Y-%m-%d") - timedelta(days=1)
+        ).timestamp()
+        with connection.get_connection() as conn:
+            conn.execute(
+                """
+                INSERT INTO message_check (keyword, last_checked_at) VALUES (?, ?)
+                ON CONFLICT (keyword) DO UPDATE SET last_checked_at = excluded.last_checked_at
+                """,
+                [keyword, checked_at.isoformat()],
+            )
+            conn.execute(
+                "DELETE FROM checked_message WHERE keyword = ? AND CAST(ts AS REAL) < ?",
+                [keyword, oldest_ts],
+            )
 
 
 if __name__ == "__main__":
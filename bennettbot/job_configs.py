@@ -107,6 +107,8 @@ raw_config = {
             "deploy": {
                 "run_args_template": "fab deploy:production",
                 "report_success": False,
+                "report_progress": True,
+                "priority": 10,
             },
             "restart": {
                 "run_args_template": "fab restart:production",
@@ -302,24 +304,29 @@ raw_config = {
     "workflows": {
         "restricted": True,
         "description": "Report GitHub Actions workflow runs",
+        "max_concurrent_jobs": 3,
         "jobs": {
             "display_emoji_key": {
-                "run_args_template": "python jobs.py key",
+                "run_args_template": "key",
+                "entrypoint": "workspace.workflows.jobs:run_from_command_line",
                 "report_stdout": True,
                 "report_format": "blocks",
             },
             "show_all": {
-                "run_args_template": "python jobs.py show --target all",
+                "run_args_template": "show --target all",
+                "entrypoint": "workspace.workflows.jobs:run_from_command_line",
                 "report_stdout": True,
                 "report_format": "blocks",
             },
             "show_failed": {
-                "run_args_template": "python jobs.py show --target all --skip-successful",
+                "run_args_template": "show --target all --skip-successful",
+                "entrypoint": "workspace.workflows.jobs:run_from_command_line",
                 "report_stdout": True,
                 "report_format": "blocks",
             },
             "show": {
-                "run_args_template": "python jobs.py show --target {target}",
+                "run_args_template": "show --target {target}",
+                "entrypoint": "workspace.workflows.jobs:run_from_command_line",
                 "report_stdout": True,
                 "report_format": "blocks",
             },
@@ -357,19 +364,23 @@ raw_config = {
         "description": "Tech Support out of office and rota",
         "jobs": {
             "out_of_office_on": {
-                "run_args_template": "python jobs.py on {start_date} {end_date}",
+                "run_args_template": "on {start_date} {end_date}",
+                "entrypoint": "workspace.techsupport.jobs:run_from_command_line",
                 "report_stdout": True,
             },
             "out_of_office_off": {
-                "run_args_template": "python jobs.py off",
+                "run_args_template": "off",
+                "entrypoint": "workspace.techsupport.jobs:run_from_command_line",
                 "report_stdout": True,
             },
             "out_of_office_status": {
-                "run_args_template": "python jobs.py status",
+                "run_args_template": "status",
+                "entrypoint": "workspace.techsupport.jobs:run_from_command_line",
                 "report_stdout": True,
             },
             "rota_report": {
-                "run_args_template": "python jobs.py rota",
+                "run_args_template": "rota",
+                "entrypoint": "workspace.techsupport.jobs:run_from_command_line",
                 "report_stdout": True,
                 "report_format": "blocks",
             },
@@ -501,6 +512,9 @@ def build_config(raw_config):
         "workspace_dir": {},
         "restricted": {},
         "default_channel": {},
+        "max_concurrent_jobs": {},
+        "command_trie": {},
+        "help_commands": {},
     }
 
     for namespace in raw_config:
@@ -512,6 +526,10 @@ def build_config(raw_config):
         config["default_channel"][namespace] = raw_config[namespace].get(
             "default_channel", "#tech"
         )
+        if "max_concurrent_jobs" in raw_config[namespace]:
+            config["max_concurrent_jobs"][namespace] = raw_config[namespace][
+                "max_concurrent_jobs"
+            ]
 
         helps = []
 
@@ -519,6 +537,9 @@ def build_config(raw_config):
             job_config["report_stdout"] = job_config.get("report_stdout", False)
             job_config["report_format"] = job_config.get("report_format", "text")
             job_config["report_success"] = job_config.get("report_success", True)
+            job_config["priority"] = job_config.get("priority", 0)
+            job_config["entrypoint"] = job_config.get("entrypoint")
+            job_config["report_progress"] = job_config.get("report_progress", False)
             namespaced_job_type = f"{namespace}_{job_type}"
             validate_job_config(namespaced_job_type, job_config)
             config["jobs"][namespaced_job_type] = job_config
@@ -537,6 +558,8 @@ def build_config(raw_config):
             helps.append([command, slack_config["help"]])
 
         config["help"][namespace] = sorted(helps)
+        config["help_commands"][f"{namespace} help"] = namespace
+        config["help_commands"][f"help {namespace}"] = namespace
 
         if "fabfile" in raw_config[namespace]:
             config["fabfiles"][namespace] = raw_config[namespace]["fabfile"]
@@ -547,6 +570,7 @@ def build_config(raw_config):
             config["workspace_dir"][namespace] = settings.WRITEABLE_WORKSPACE_DIR
 
     config["slack"] = sorted(config["slack"], key=itemgetter("command"))
+    config["command_trie"] = build_command_trie(config["slack"])
 
     for slack_config in config["slack"]:
         if slack_config["job_type"] not in config["jobs"]:
@@ -567,6 +591,59 @@ def build_regex_from_command(command):
     return re.compile(pattern)
 
 
+def build_command_trie(slack_configs):
+    """Build a trie of the words that Slack commands start with, so that a message
+    only needs to be matched against the commands that could match it.
+
+    Each node maps a word to a child node under "children", and lists under
+    "commands" the indexes into slack_configs of the commands whose leading words
+    end at that node.  A command's leading words are the words before its first
+    parameter (or other word that isn't matched literally by its regex).
+
+    >>> build_command_trie([{"command": "say [greeting]"}, {"command": "say hi"}])
+    {"children": {"say": {"children": {"hi": {"children": {}, "commands": [1]}},
+                          "commands": [0]}},
+     "commands": []}
+    """
+
+    trie = {"children": {}, "commands": []}
+    for ix, slack_config in enumerate(slack_configs):
+        node = trie
+        for word in slack_config["command"].split():
+            if not _is_literal(word):
+                break
+            node = node["children"].setdefault(word, {"children": {}, "commands": []})
+        node["commands"].append(ix)
+    return trie
+
+
+def _is_literal(word):
+    return not any(c in r".^$*+?{}[]\|()" for c in word)
+
+
+def find_slack_config(config, text):
+    """Return the first Slack command (in the order of config["slack"]) whose regex
+    matches text, or None.
+
+    Only the commands whose leading words are the same as text's are tried.
+    """
+
+    candidates = []
+    node = config["command_trie"]
+    for word in text.split():
+        candidates.extend(node["commands"])
+        if (node := node["children"].get(word)) is None:
+            break
+    else:
+        candidates.extend(node["commands"])
+
+    for ix in sorted(candidates):
+        slack_config = config["slack"][ix]
+        if slack_config["regex"].match(text):
+            return slack_config
+    return None
+
+
 def get_template_params(command):
     """Extract parameters from Slack command.
 
@@ -585,6 +662,9 @@ def validate_job_config(job_type, job_config):
         "report_stdout",
         "report_format",
         "report_success",
+        "priority",
+        "entrypoint",
+        "report_progress",
     }
 
     if missing_keys := (expected_keys - job_config.keys()):
@@ -602,6 +682,18 @@ def validate_job_config(job_type, job_config):
         )
         raise RuntimeError(msg)
 
+    if not isinstance(job_config["priority"], int):
+        msg = f"Job {job_type} has an invalid priority; must be an integer"
+        raise RuntimeError(msg)
+
+    entrypoint = job_config["entrypoint"]
+    if entrypoint is not None and not re.match(r"^[\w.]+:\w+$", entrypoint):
+        msg = (
+            f"Job {job_type} has an invalid entrypoint; must be in the form "
+            "'package.module:function'"
+        )
+        raise RuntimeError(msg)
+
 
 def validate_slack_config(slack_config):
     """Validate that slack_config contains expected keys."""
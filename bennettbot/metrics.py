@@ -0,0 +1,249 @@
+"""Metrics exposed at /metrics in the Prometheus text format.
+
+The bot, the dispatcher, job processes and each of the webserver's workers all
+record metrics, so counters and histograms are accumulated in the metric table of
+the shared database rather than in memory.  To keep writes to the database
+infrequent, each process buffers its samples and flushes them in a single
+transaction at most every FLUSH_INTERVAL seconds.  Gauges describing the state of
+the job queue are read from the job and suppression tables when metrics are
+requested.
+
+See https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+import atexit
+import math
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from time import monotonic
+
+from .connection import get_connection
+from .logger import logger
+
+
+# Number of seconds that samples may be buffered in each process before they are
+# flushed to the database.  Metrics are also flushed when they are rendered, when a
+# job finishes and when the process exits.
+FLUSH_INTERVAL = 10
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+JOB_DURATION_BUCKETS = [1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 21600]
+
+# name -> (type, help text, histogram buckets)
+METRICS = {
+    "bennettbot_job_duration_seconds": (
+        "histogram",
+        "Time taken to run jobs",
+        JOB_DURATION_BUCKETS,
+    ),
+    "bennettbot_slack_api_duration_seconds": (
+        "histogram",
+        "Time taken by calls to the Slack API to send and update messages",
+        LATENCY_BUCKETS,
+    ),
+    "bennettbot_slack_api_retries_total": (
+        "counter",
+        "Calls to the Slack API to send messages that failed and were retried",
+        None,
+    ),
+    "bennettbot_slack_api_failures_total": (
+        "counter",
+        "Messages that could not be sent to Slack after retrying",
+        None,
+    ),
+    "bennettbot_slack_api_throttled_total": (
+        "counter",
+        "Calls to the Slack API that were delayed to stay within rate limits",
+        None,
+    ),
+    "bennettbot_slack_api_rate_limited_total": (
+        "counter",
+        "Calls to the Slack API that were rate limited by Slack and retried",
+        None,
+    ),
+    "bennettbot_slack_event_dedup_total": (
+        "counter",
+        "Slack events and support requests checked against those already handled, "
+        "by whether they had been handled (hit) or not (miss)",
+        None,
+    ),
+    "bennettbot_webhook_duration_seconds": (
+        "histogram",
+        "Time taken to handle webhooks",
+        LATENCY_BUCKETS,
+    ),
+}
+
+# name -> (help text, query returning job_type and value columns)
+GAUGES = {
+    "bennettbot_queued_jobs": (
+        "Jobs that have been scheduled but have not started",
+        "SELECT type AS job_type, COUNT(*) AS value FROM job WHERE started_at IS NULL GROUP BY type",
+    ),
+    "bennettbot_running_jobs": (
+        "Jobs that are running",
+        "SELECT type AS job_type, COUNT(*) AS value FROM job WHERE started_at IS NOT NULL GROUP BY type",
+    ),
+    "bennettbot_active_suppressions": (
+        "Suppressions that are in effect",
+        "SELECT job_type, COUNT(*) AS value FROM suppression WHERE start_at < :now AND end_at > :now GROUP BY job_type",
+    ),
+}
+
+
+def inc(name, amount=1, conn=None, **labels):
+    """Increment the counter with the given name and labels."""
+
+    _check_type(name, "counter")
+    _record([(name, _format_labels(labels), "", 0, amount)], conn)
+
+
+def observe(name, value, conn=None, **labels):
+    """Record an observation of the histogram with the given name and labels.
+
+    If conn is given, the observation is recorded as part of the transaction
+    that is in progress on that connection.
+    """
+
+    _check_type(name, "histogram")
+    labels = _format_labels(labels)
+    buckets = METRICS[name][2] + [math.inf]
+    samples = [(name, labels, "_bucket", le, int(value <= le)) for le in buckets]
+    samples.append((name, labels, "_sum", 0, value))
+    samples.append((name, labels, "_count", 0, 1))
+    _record(samples, conn)
+
+
+def _check_type(name, type_):
+    assert METRICS[name][0] == type_, f"{name} is not a {type_}"
+
+
+_INSERT_SQL = """
+INSERT INTO metric (name, labels, suffix, le, value)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (name, labels, suffix, le) DO UPDATE SET value = value + excluded.value
+"""
+
+# (name, labels, suffix, le) -> value of samples that haven't been flushed
+_buffer = {}
+_buffer_lock = threading.Lock()
+_flushed_at = monotonic()
+
+
+def _record(samples, conn):
+    """Add samples to the metric table.
+
+    If conn is given, the samples are added as part of the transaction that is in
+    progress on that connection.  Otherwise they are buffered, and flushed once
+    FLUSH_INTERVAL seconds have passed since the last flush.
+    """
+
+    if conn is not None:
+        conn.executemany(_INSERT_SQL, samples)
+        return
+
+    _buffer_samples(samples)
+    if monotonic() - _flushed_at >= FLUSH_INTERVAL:
+        flush()
+
+
+def _buffer_samples(samples):
+    with _buffer_lock:
+        for name, labels, suffix, le, value in samples:
+            key = (name, labels, suffix, le)
+            _buffer[key] = _buffer.get(key, 0) + value
+
+
+def flush():
+    """Add the samples buffered by this process to the metric table.
+
+    Metrics are recorded alongside other work (e.g. just after a message has been
+    sent to Slack), so if they can't be added (e.g. because the database is
+    locked), the error is logged rather than raised, so that the caller doesn't
+    treat its work as having failed, and the samples are kept for the next flush.
+    """
+
+    global _flushed_at
+    with _buffer_lock:
+        samples = [(*key, value) for key, value in _buffer.items()]
+        _buffer.clear()
+        _flushed_at = monotonic()
+    if not samples:
+        return
+
+    try:
+        with get_connection() as conn:
+            conn.executemany(_INSERT_SQL, samples)
+    except sqlite3.Error as error:
+        logger.error("Could not record metrics", count=len(samples), error=error)
+        _buffer_samples(samples)
+
+
+def reset_buffer():
+    """Forget samples that haven't been flushed.
+
+    This is called in processes forked from a process that has buffered samples, so
+    that they are only flushed by the process that recorded them, and in tests.
+    """
+
+    global _buffer_lock
+    _buffer.clear()
+    _buffer_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_buffer)
+atexit.register(flush)
+
+
+def render():
+    """Return all metrics in the Prometheus text format."""
+
+    flush()
+    conn = get_connection()
+    now = datetime.now(timezone.utc)
+    lines = []
+
+    for name, (help_text, sql) in GAUGES.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for row in conn.execute(sql, {"now": now}):
+            labels = _format_labels({"job_type": row["job_type"]})
+            lines.append(f"{name}{{{labels}}} {_format_value(row['value'])}")
+
+    samples_by_name = {}
+    for row in conn.execute("SELECT * FROM metric ORDER BY name, labels, suffix, le"):
+        samples_by_name.setdefault(row["name"], []).append(row)
+
+    for name, (type_, help_text, _) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {type_}")
+        for row in samples_by_name.get(name, []):
+            labels = row["labels"]
+            if row["suffix"] == "_bucket":
+                le = f'le="{_format_value(row["le"])}"'
+                labels = f"{labels},{le}" if labels else le
+            labels = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}{row['suffix']}{labels} {_format_value(row['value'])}")
+
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    return ",".join(
+        f'{key}="{_escape_label_value(str(value))}"'
+        for key, value in sorted(labels.items())
+    )
+
+
+def _escape_label_value(value):
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
@@ -0,0 +1,294 @@
+"""A durable queue of messages to be sent to Slack.
+
+Job processes add messages to the outbox table rather than calling Slack
+themselves, so that they can exit as soon as their job has finished, and so that
+messages aren't lost if Slack is unavailable.  A single sender process, started by
+the dispatcher, sends the messages in order for each channel or thread, combining
+consecutive plain text messages, and retries messages that fail.
+"""
+
+import json
+from datetime import datetime, timedelta, timezone
+from http.client import HTTPException
+from multiprocessing import Process
+from time import sleep
+
+from slack_sdk.errors import SlackApiError
+
+from . import connection, metrics, settings
+from .connection import get_connection
+from .logger import logger
+from .slack import (
+    get_message_method,
+    report_slack_error,
+    send_message,
+    slack_web_client,
+)
+
+
+# Consecutive plain text messages to the same channel or thread are combined
+# into one message of at most this many characters
+MAX_COMBINED_LENGTH = 3000
+
+# Errors returned by the Slack API that may succeed if the call is retried.  Other
+# errors (e.g. channel_not_found, invalid_blocks, msg_too_long) will fail however
+# many times we retry, and would hold up later messages to the same channel while
+# we did, so we give up on the message straight away.
+RETRYABLE_SLACK_ERRORS = {
+    "fatal_error",
+    "internal_error",
+    "ratelimited",
+    "request_timeout",
+    "service_unavailable",
+}
+
+# Number of seconds to wait after an unexpected error before trying again
+ERROR_DELAY = 1
+
+# The sender waits for changes with this name (see connection.wait_for_change),
+# which are recorded whenever a message is added to the outbox
+CHANGE_NAME = "outbox"
+
+
+def run():  # pragma: no cover
+    """Send messages from the outbox as they are added."""
+    slack_client = slack_web_client(token_type="bot")
+    while True:
+        run_once(slack_client)
+
+
+def run_once(slack_client):
+    """Send any messages that are due, and wait for more.
+
+    This is the only process that sends messages from jobs, so any unexpected error
+    (e.g. if the database is locked) is logged, rather than being allowed to stop
+    the sender.
+    """
+
+    try:
+        change_count = connection.get_change_count(CHANGE_NAME)
+        send_messages(slack_client)
+        wait_for_messages(change_count)
+    except Exception:
+        logger.exception("Error sending messages from outbox")
+        sleep(ERROR_DELAY)
+
+
+def start_sender():  # pragma: no cover
+    """Start sending messages in a new subprocess."""
+    p = Process(target=run)
+    p.start()
+    return p
+
+
+def enqueue_message(
+    channel, message_text, thread_ts=None, message_format=None, repost_to=None
+):
+    """Add message to the outbox.
+
+    The arguments are as for slack.notify_slack().  If repost_to is given, a link
+    to the message is posted to that channel once the message has been sent.
+    """
+
+    with get_connection() as conn:
+        conn.execute(
+            """
+            INSERT INTO outbox (
+                channel, thread_ts, message, message_format, repost_to, send_after
+            )
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [
+                channel,
+                thread_ts,
+                json.dumps(message_text),
+                message_format,
+                repost_to,
+                _now(),
+            ],
+        )
+        connection.record_change(conn, CHANGE_NAME)
+
+
+def send_messages(slack_client):
+    """Send all messages that are due, returning the number of messages sent.
+
+    Only the earliest message for each channel or thread is considered at a time,
+    so that if it fails, later messages to the same channel or thread wait for it
+    to be retried.
+    """
+
+    sent = 0
+    while messages := _get_due_messages():
+        for message in messages:
+            sent += _send(slack_client, message)
+    return sent
+
+
+def wait_for_messages(change_count):
+    """Sleep until a message needs retrying, or until another process adds a message
+    after change_count was retrieved."""
+
+    timeout = settings.DISPATCHER_MAX_SLEEP
+    conn = get_connection()
+    next_send_after = conn.execute(
+        "SELECT MIN(send_after) AS send_after FROM outbox"
+    ).fetchone()["send_after"]
+    if next_send_after is not None:
+        seconds_until_due = (
+            datetime.fromisoformat(next_send_after) - _now()
+        ).total_seconds()
+        timeout = max(min(timeout, seconds_until_due), 0)
+    connection.wait_for_change(
+        CHANGE_NAME, change_count, timeout, settings.DISPATCHER_POLL_INTERVAL
+    )
+
+
+def get_messages():
+    """Retrieve all messages from the outbox."""
+
+    conn = get_connection()
+    messages = list(conn.execute("SELECT * FROM outbox ORDER BY id"))
+    for message in messages:
+        message["message"] = json.loads(message["message"])
+    return messages
+
+
+def _get_due_messages():
+    """Return the earliest message to each channel or thread, if it is due, with
+    any messages that can be combined with it."""
+
+    sql = """
+    SELECT * FROM outbox
+    WHERE id IN (SELECT MIN(id) FROM outbox GROUP BY channel, thread_ts)
+    AND send_after <= ?
+    ORDER BY id
+    """
+
+    conn = get_connection()
+    messages = list(conn.execute(sql, [_now()]))
+    for message in messages:
+        message["message"] = json.loads(message["message"])
+        message["ids"] = [message["id"]]
+        if _can_combine(message):
+            _combine_following_messages(conn, message)
+    return messages
+
+
+def _can_combine(message):
+    return (
+        message["message_format"] in [None, "text"]
+        and message["repost_to"] is None
+        and isinstance(message["message"], str)
+    )
+
+
+def _combine_following_messages(conn, message):
+    following_messages = conn.execute(
+        """
+        SELECT * FROM outbox
+        WHERE channel = ? AND thread_ts IS ? AND id > ?
+        ORDER BY id
+        """,
+        [message["channel"], message["thread_ts"], message["id"]],
+    )
+    for following_message in following_messages:
+        following_message["message"] = json.loads(following_message["message"])
+        if not _can_combine(following_message):
+            break
+        text = message["message"] + "\n" + following_message["message"]
+        if len(text) > MAX_COMBINED_LENGTH:
+            break
+        message["message"] = text
+        message["ids"].append(following_message["id"])
+
+
+def _send(slack_client, message):
+    """Try to send message, returning the number of messages from the outbox that
+    were sent."""
+
+    try:
+        resp = send_message(
+            slack_client,
+            message["channel"],
+            message["message"],
+            thread_ts=message["thread_ts"],
+            message_format=message["message_format"],
+        )
+    except Exception as error:
+        _mark_failed(slack_client, message, error)
+        return 0
+
+    _delete(message["ids"])
+    if message["repost_to"] is not None:
+        _repost(slack_client, resp, message["repost_to"])
+    return len(message["ids"])
+
+
+def _repost(slack_client, resp, channel):
+    """Post a link to the message that was sent with response resp to channel."""
+
+    try:
+        message_url = slack_client.chat_getPermalink(
+            channel=resp["channel"], message_ts=resp["ts"]
+        )["permalink"]
+    except Exception as error:
+        # The message has been sent, so we don't want to retry it
+        logger.error("Could not repost message", channel=channel, error=error)
+        return
+    enqueue_message(channel, message_url)
+
+
+def _is_retryable(error):
+    """Return whether sending a message that failed with error may succeed if it is
+    retried."""
+
+    if isinstance(error, SlackApiError):
+        return (
+            error.response.status_code >= 500
+            or error.response.get("error") in RETRYABLE_SLACK_ERRORS
+        )
+    # Network errors
+    return isinstance(error, (OSError, HTTPException))
+
+
+def _mark_failed(slack_client, message, error):
+    """Record that sending message failed, giving up if the error isn't one that a
+    retry may fix, or if it has been tried SLACK_OUTBOX_MAX_ATTEMPTS times."""
+
+    method = get_message_method(message["message"], message["message_format"])
+    attempts = message["attempts"] + 1
+    if not _is_retryable(error) or attempts >= settings.SLACK_OUTBOX_MAX_ATTEMPTS:
+        metrics.inc("bennettbot_slack_api_failures_total", method=method)
+        report_slack_error(
+            slack_client,
+            message["channel"],
+            message["message"],
+            message["thread_ts"],
+            error,
+        )
+        _delete(message["ids"])
+        return
+
+    metrics.inc("bennettbot_slack_api_retries_total", method=method)
+    delay = min(2**attempts, settings.SLACK_OUTBOX_MAX_RETRY_DELAY)
+    with get_connection() as conn:
+        conn.execute(
+            "UPDATE outbox SET attempts = ?, send_after = ? WHERE id = ?",
+            [attempts, _now() + timedelta(seconds=delay), message["id"]],
+        )
+
+
+def _delete(ids):
+    placeholders = ", ".join("?" for _ in ids)
+    with get_connection() as conn:
+        conn.execute(f"DELETE FROM outbox WHERE id IN ({placeholders})", ids)
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+if __name__ == "__main__":
+    logger.info("running bennettbot.outbox")
+    run()
@@ -1,10 +1,19 @@
 import json
+import math
+from collections import Counter
 from datetime import datetime, timedelta, timezone
 
-from .connection import get_connection
+from . import job_configs, metrics, settings
+from .connection import get_connection, record_change
 from .logger import log_call
 
 
+# The dispatcher waits for changes with this name (see connection.wait_for_change),
+# which are recorded whenever a job is scheduled, cancelled or done, or a
+# suppression is added or removed
+CHANGE_NAME = "job"
+
+
 @log_call
 def schedule_job(type_, args, channel, thread_ts, delay_seconds, is_im=False):
     """Schedule job to be run.
@@ -30,44 +39,48 @@ def schedule_job(type_, args, channel, thread_ts, delay_seconds, is_im=False):
     start_after = _now() + timedelta(seconds=delay_seconds)
     args = json.dumps(args)
 
-    existing_jobs = list(conn.execute(sql, [type_]))
-    existing_job_running = False
-    if len(existing_jobs) == 0:
-        _create_job(type_, args, channel, thread_ts, start_after, is_im)
-    elif len(existing_jobs) == 1:
-        job = existing_jobs[0]
-        if job["has_started"]:
+    with conn:
+        # Take the write lock before looking for existing jobs, so that two
+        # processes scheduling a job of the same type at the same time can't both
+        # decide to create a new job
+        conn.execute("BEGIN IMMEDIATE")
+        existing_jobs = list(conn.execute(sql, [type_]))
+        existing_job_running = False
+        if len(existing_jobs) == 0:
+            _create_job(conn, type_, args, channel, thread_ts, start_after, is_im)
+        elif len(existing_jobs) == 1:
+            job = existing_jobs[0]
+            if job["has_started"]:
+                existing_job_running = True
+                _create_job(conn, type_, args, channel, thread_ts, start_after, is_im)
+            else:
+                id_ = job["id"]
+                _update_job(conn, id_, args, channel, thread_ts, start_after)
+        elif len(existing_jobs) == 2:
+            assert not existing_jobs[0]["has_started"]
+            assert existing_jobs[1]["has_started"]
             existing_job_running = True
-            _create_job(type_, args, channel, thread_ts, start_after, is_im)
+            id_ = existing_jobs[0]["id"]
+            _update_job(conn, id_, args, channel, thread_ts, start_after)
         else:
-            id_ = job["id"]
-            _update_job(id_, args, channel, thread_ts, start_after)
-    elif len(existing_jobs) == 2:
-        assert not existing_jobs[0]["has_started"]
-        assert existing_jobs[1]["has_started"]
-        existing_job_running = True
-        id_ = existing_jobs[0]["id"]
-        _update_job(id_, args, channel, thread_ts, start_after)
-    else:
-        assert False
+            assert False
+        record_change(conn, CHANGE_NAME)
 
     return existing_job_running
 
 
-def _create_job(type_, args, channel, thread_ts, start_after, is_im):
-    with get_connection() as conn:
-        conn.execute(
-            "INSERT INTO job (type, args, channel, thread_ts, start_after, is_im) VALUES (?, ?, ?, ?, ?, ?)",
-            [type_, args, channel, thread_ts, start_after, is_im],
-        )
+def _create_job(conn, type_, args, channel, thread_ts, start_after, is_im):
+    conn.execute(
+        "INSERT INTO job (type, args, channel, thread_ts, start_after, is_im) VALUES (?, ?, ?, ?, ?, ?)",
+        [type_, args, channel, thread_ts, start_after, is_im],
+    )
 
 
-def _update_job(id_, args, channel, thread_ts, start_after):
-    with get_connection() as conn:
-        conn.execute(
-            "UPDATE job SET args = ?, channel = ?, thread_ts = ?, start_after = ? WHERE id = ?",
-            [args, channel, thread_ts, start_after, id_],
-        )
+def _update_job(conn, id_, args, channel, thread_ts, start_after):
+    conn.execute(
+        "UPDATE job SET args = ?, channel = ?, thread_ts = ?, start_after = ? WHERE id = ?",
+        [args, channel, thread_ts, start_after, id_],
+    )
 
 
 @log_call
@@ -76,6 +89,7 @@ def cancel_job(type_):
 
     with get_connection() as conn:
         conn.execute("DELETE FROM job WHERE type = ? AND started_at IS NULL", [type_])
+        record_change(conn, CHANGE_NAME)
 
 
 @log_call
@@ -87,6 +101,7 @@ def schedule_suppression(job_type, start_at, end_at):
             "INSERT INTO suppression (job_type, start_at, end_at) VALUES (?, ?, ?)",
             [job_type, start_at, end_at],
         )
+        record_change(conn, CHANGE_NAME)
 
 
 @log_call
@@ -95,6 +110,7 @@ def cancel_suppressions(job_type):
 
     with get_connection() as conn:
         conn.execute("DELETE FROM suppression WHERE job_type = ?", [job_type])
+        record_change(conn, CHANGE_NAME)
 
 
 # @log_call
@@ -109,22 +125,86 @@ def remove_expired_suppressions():
 
 
 # @log_call
-def reserve_job():
-    """Reserve a job and return its id.
+def reserve_job(config=None):
+    """Reserve a job and return it, or return None if there is no job to reserve.
+
+    See reserve_jobs() for which jobs can be reserved.
+    """
+
+    jobs = reserve_jobs(limit=1, config=config)
+    if not jobs:
+        return None
+    return jobs[0]
+
+
+# @log_call
+def reserve_jobs(limit=None, config=None):
+    """Reserve and return up to limit jobs.
 
-    The first job where:
+    Jobs where:
 
         * there is not a running job of the same type
         * there is no active suppression
 
-    is reserved.  This updates the started_at column on the database record.
+    are reserved, with at most one job of each type, so long as no more than
+    MAX_CONCURRENT_JOBS jobs (or max_concurrent_jobs jobs from the job's
+    namespace) would then be running.  Jobs with a higher priority are reserved
+    first, and jobs with the same priority are reserved in the order they became
+    due.  Priorities and namespace limits are taken from config, which defaults to
+    job_configs.config.  This updates the started_at column on the database
+    records.
 
-    This is not logged because it is called every second by the dispatcher.
+    The jobs are selected and reserved in a single transaction, so several
+    dispatchers can safely reserve jobs from the same database at once.
+
+    This is not logged because it is called by the dispatcher every time it
+    wakes up.
     """
 
     conn = get_connection()
+    now = _now()
 
-    sql = """
+    with conn:
+        # Take the write lock before looking for due jobs, so that two dispatchers
+        # can't reserve the same job, or between them exceed the limits
+        conn.execute("BEGIN IMMEDIATE")
+        reservable_jobs, _ = _apply_concurrency_limits(conn, now, config)
+        ids = [job["id"] for job in reservable_jobs][:limit]
+        placeholders = ", ".join("?" for _ in ids)
+        jobs = list(
+            conn.execute(
+                f"UPDATE job SET started_at = ? WHERE id IN ({placeholders}) RETURNING *",
+                [now, *ids],
+            )
+        )
+
+    # The order of rows returned by RETURNING is arbitrary
+    jobs.sort(key=lambda job: ids.index(job["id"]))
+    for job in jobs:
+        _convert_job_args_from_json(job)
+    return jobs
+
+
+# @log_call
+def get_capped_jobs(config=None):
+    """Return dict mapping the ids of jobs that are due, but which are waiting for
+    other jobs to finish because of the limits on how many jobs may run at once,
+    to a description of the limit that has been reached.
+
+    This is not logged because config is large.
+    """
+
+    _, capped_jobs = _apply_concurrency_limits(get_connection(), _now(), config)
+    return capped_jobs
+
+
+def _apply_concurrency_limits(conn, now, config):
+    """Return the jobs that could be reserved now, in the order they should be
+    reserved, and a dict mapping the ids of jobs that can't be reserved because of
+    the limits on how many jobs may run at once to a description of the limit.
+    """
+
+    due_jobs_sql = """
     WITH running_job_types AS (
         SELECT type
         FROM job
@@ -135,38 +215,160 @@ def reserve_job():
         SELECT job_type
         FROM suppression
         WHERE start_at < ?
+    ),
+
+    due_jobs AS (
+        SELECT
+            id,
+            type,
+            start_after,
+            ROW_NUMBER() OVER (PARTITION BY type ORDER BY start_after, id) AS position
+        FROM job
+        WHERE
+              type NOT IN (SELECT * FROM suppressed_job_types)
+          AND type NOT IN (SELECT * FROM running_job_types)
+          AND started_at IS NULL
+          AND start_after <= ?
     )
 
-    SELECT id
-    FROM job
-    WHERE
-          type NOT IN (SELECT * FROM suppressed_job_types)
-      AND type NOT IN (SELECT * FROM running_job_types)
-      AND started_at IS NULL
-      AND start_after <= ?
-    ORDER BY start_after
-    LIMIT 1
+    SELECT id, type, start_after
+    FROM due_jobs
+    WHERE position = 1
     """
 
-    now = _now()
-    results = list(conn.execute(sql, [now, now]))
+    if config is None:
+        config = job_configs.config
 
-    if not results:
-        return None
+    def priority(job):
+        return config["jobs"].get(job["type"], {}).get("priority", 0)
 
-    job_id = results[0]["id"]
-    with conn:
-        conn.execute("UPDATE job SET started_at = ? WHERE id = ?", [now, job_id])
+    def namespace(job):
+        return job["type"].split("_")[0]
+
+    due_jobs = list(conn.execute(due_jobs_sql, [now, now]))
+    due_jobs.sort(key=lambda job: (-priority(job), job["start_after"], job["id"]))
+
+    running_jobs = list(
+        conn.execute("SELECT type FROM job WHERE started_at IS NOT NULL")
+    )
+    num_running = len(running_jobs)
+    num_running_by_namespace = Counter(namespace(job) for job in running_jobs)
+
+    reservable_jobs = []
+    capped_jobs = {}
+    for job in due_jobs:
+        ns = namespace(job)
+        max_for_namespace = config["max_concurrent_jobs"].get(ns)
+        if num_running >= settings.MAX_CONCURRENT_JOBS:
+            capped_jobs[job["id"]] = (
+                f"limit of {settings.MAX_CONCURRENT_JOBS} running jobs reached"
+            )
+        elif (
+            max_for_namespace is not None
+            and num_running_by_namespace[ns] >= max_for_namespace
+        ):
+            capped_jobs[job["id"]] = (
+                f"limit of {max_for_namespace} running {ns} jobs reached"
+            )
+        else:
+            reservable_jobs.append(job)
+            num_running += 1
+            num_running_by_namespace[ns] += 1
+
+    return reservable_jobs, capped_jobs
+
+
+# @log_call
+def get_next_due_time():
+    """Return the earliest time at which either a job will become due, or an
+    active suppression will expire, or None if there is no such time.
+
+    Jobs that are already due but haven't been reserved are ignored.  These are
+    waiting for a running job of the same type to finish (which will change the
+    database) or for a suppression to expire.
+
+    This is not logged because it is called by the dispatcher every time it
+    wakes up.
+    """
+
+    conn = get_connection()
+
+    sql = """
+    SELECT MIN(due_time) AS due_time
+    FROM (
+        SELECT MIN(start_after) AS due_time
+        FROM job
+        WHERE started_at IS NULL AND start_after > ?
+
+        UNION ALL
+
+        SELECT MIN(end_at) AS due_time
+        FROM suppression
+        WHERE end_at > ?
+    )
+    """
 
-    return job_id
+    now = _now()
+    due_time = list(conn.execute(sql, [now, now]))[0]["due_time"]
+    if due_time is None:
+        return None
+    return datetime.fromisoformat(due_time)
 
 
 @log_call
-def mark_job_done(job_id):
-    """Remove job from job table."""
+def mark_job_done(job_id, rc=None):
+    """Remove job from job table.
+
+    If the job has been run, rc is its return code, and the run is recorded in
+    the job_run table and the job duration metric.  Records of runs older than
+    JOB_RUN_RETENTION_DAYS are removed at the same time.
+    """
+
+    sql = """
+    INSERT INTO job_run (
+        job_id,
+        type,
+        args,
+        channel,
+        start_after,
+        started_at,
+        finished_at,
+        queue_seconds,
+        duration_seconds,
+        rc
+    )
+    SELECT
+        id,
+        type,
+        args,
+        channel,
+        start_after,
+        started_at,
+        ?,
+        (julianday(started_at) - julianday(start_after)) * 86400,
+        (julianday(?) - julianday(started_at)) * 86400,
+        ?
+    FROM job
+    WHERE id = ?
+    RETURNING type, duration_seconds
+    """
 
     with get_connection() as conn:
+        if rc is not None:
+            now = _now()
+            for job_run in list(conn.execute(sql, [now, now, rc, job_id])):
+                metrics.observe(
+                    "bennettbot_job_duration_seconds",
+                    job_run["duration_seconds"],
+                    conn=conn,
+                    job_type=job_run["type"],
+                )
+            conn.execute(
+                "DELETE FROM job_run WHERE finished_at < ?",
+                [now - timedelta(days=settings.JOB_RUN_RETENTION_DAYS)],
+            )
         conn.execute("DELETE FROM job WHERE id = ?", [job_id])
+        record_change(conn, CHANGE_NAME)
 
 
 @log_call
@@ -209,6 +411,68 @@ def get_suppressions():
     return list(conn.execute("SELECT * FROM suppression ORDER BY id"))
 
 
+@log_call
+def get_job_runs(type_, limit=10):
+    """Retrieve the most recent runs of jobs of given type from job_run table."""
+
+    conn = get_connection()
+    job_runs = list(
+        conn.execute(
+            "SELECT * FROM job_run WHERE type = ? ORDER BY finished_at DESC, id DESC LIMIT ?",
+            [type_, limit],
+        )
+    )
+    for job_run in job_runs:
+        _convert_job_args_from_json(job_run)
+    return job_runs
+
+
+@log_call
+def get_job_run_stats(type_=None):
+    """Summarise runs of jobs of each type (or of given type) in job_run table.
+
+    Returns a list of dicts, one per job type, with the number of runs, the number
+    of failed runs, and the 50th and 95th percentiles of the time jobs spent
+    queued and the time they took to run.
+    """
+
+    conn = get_connection()
+    sql = "SELECT type, queue_seconds, duration_seconds, rc FROM job_run"
+    params = []
+    if type_ is not None:
+        sql += " WHERE type = ?"
+        params.append(type_)
+
+    runs_by_type = {}
+    for job_run in conn.execute(sql, params):
+        runs_by_type.setdefault(job_run["type"], []).append(job_run)
+
+    stats = []
+    for job_type, job_runs in sorted(runs_by_type.items()):
+        queue_seconds = [job_run["queue_seconds"] for job_run in job_runs]
+        duration_seconds = [job_run["duration_seconds"] for job_run in job_runs]
+        stats.append(
+            {
+                "type": job_type,
+                "runs": len(job_runs),
+                "failures": sum(job_run["rc"] != 0 for job_run in job_runs),
+                "queue_p50": _percentile(queue_seconds, 50),
+                "queue_p95": _percentile(queue_seconds, 95),
+                "duration_p50": _percentile(duration_seconds, 50),
+                "duration_p95": _percentile(duration_seconds, 95),
+            }
+        )
+    return stats
+
+
+def _percentile(values, percent):
+    """Return the given percentile of values, using the nearest-rank method."""
+
+    values = sorted(values)
+    rank = math.ceil(percent / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+
 def _now():
     return datetime.now(timezone.utc)
 
@@ -14,6 +14,27 @@ WRITEABLE_DIR = env.path("WRITEABLE_DIR", default=APPLICATION_ROOT)
 
 DB_PATH = env.path("DB_PATH", default=WRITEABLE_DIR / "bennettbot.db")
 
+# SQLite pragmas applied to every connection to the database at DB_PATH.  The bot,
+# the dispatcher, each job process and each webserver worker all write to this
+# database, so we use WAL mode (which lets readers carry on while another process
+# is writing) and wait up to DB_BUSY_TIMEOUT_MS for a lock rather than failing.
+# See https://www.sqlite.org/pragma.html
+DB_JOURNAL_MODE = env.str(
+    "DB_JOURNAL_MODE",
+    default="wal",
+    validate=lambda value: value in ["delete", "truncate", "persist", "wal"],
+)
+DB_SYNCHRONOUS = env.str(
+    "DB_SYNCHRONOUS",
+    default="normal",
+    validate=lambda value: value in ["off", "normal", "full", "extra"],
+)
+DB_BUSY_TIMEOUT_MS = env.int("DB_BUSY_TIMEOUT_MS", default=5000)
+# Maximum number of bytes of the database file to memory-map
+DB_MMAP_SIZE = env.int("DB_MMAP_SIZE", default=16 * 1024 * 1024)
+# Page cache size; a negative number is interpreted as a size in KiB
+DB_CACHE_SIZE = env.int("DB_CACHE_SIZE", default=-2000)
+
 # location of job workspaces that live in this repo
 WORKSPACE_DIR = env.path("WORKSPACE_DIR", default=APPLICATION_ROOT / "workspace")
 
@@ -46,6 +67,19 @@ BOT_CHECK_FILE = env.path(
     "BOT_CHECK_FILE", default=APPLICATION_ROOT / ".bot_startup_check"
 )
 
+# Maximum number of Slack events that the bot handles at once.  This is the size of
+# the pool of threads that Bolt runs listeners in (Bolt's default is 5).
+BOT_MAX_CONCURRENT_EVENTS = env.int(
+    "BOT_MAX_CONCURRENT_EVENTS", default=10, validate=lambda n: n > 0
+)
+
+# Slack may deliver an event more than once, and edits to a support request arrive
+# as new events.  The bot remembers the events and support requests that it has
+# handled for BOT_DEDUP_TTL seconds (up to BOT_DEDUP_MAX_SIZE of them), and ignores
+# them if they arrive again.
+BOT_DEDUP_TTL = env.float("BOT_DEDUP_TTL", default=3600)
+BOT_DEDUP_MAX_SIZE = env.int("BOT_DEDUP_MAX_SIZE", default=10000)
+
 # Should match "Payload URL" from
 # https://github.com/ebmdatalab/openprescribing/settings/hooks/85994427
 WEBHOOK_ORIGIN = env.str("WEBHOOK_ORIGIN")
@@ -57,5 +91,53 @@ GITHUB_WEBHOOK_SECRET = env.str("GITHUB_WEBHOOK_SECRET").encode("ascii")
 GCP_CREDENTIALS_PATH = env.path("GCP_CREDENTIALS_PATH")
 
 
+# The dispatcher sleeps until the next job is due, but wakes early if another
+# process changes the database (e.g. by scheduling a job).  It checks for changes
+# every DISPATCHER_POLL_INTERVAL seconds, and never sleeps for longer than
+# DISPATCHER_MAX_SLEEP seconds.
+DISPATCHER_POLL_INTERVAL = env.float("DISPATCHER_POLL_INTERVAL", default=0.05)
+DISPATCHER_MAX_SLEEP = env.float("DISPATCHER_MAX_SLEEP", default=60)
+
+# Maximum number of jobs that the dispatcher will run at once.  Namespaces may set
+# a lower limit for their own jobs with max_concurrent_jobs (see job_configs.py).
+MAX_CONCURRENT_JOBS = env.int(
+    "MAX_CONCURRENT_JOBS", default=10, validate=lambda n: n > 0
+)
+
+# Jobs with report_progress update a Slack message with the end of their output
+# while they run.  chat.update is a Tier 3 method (around 50 calls per minute per
+# workspace), so each job updates its message at most every
+# JOB_PROGRESS_INTERVAL seconds, and shows at most the last JOB_PROGRESS_MAX_BYTES
+# bytes of output (Slack truncates messages at 40,000 characters).
+JOB_PROGRESS_INTERVAL = env.float("JOB_PROGRESS_INTERVAL", default=5)
+JOB_PROGRESS_MAX_BYTES = env.int("JOB_PROGRESS_MAX_BYTES", default=3000)
+
+# Number of days to keep records of job runs for
+JOB_RUN_RETENTION_DAYS = env.int("JOB_RUN_RETENTION_DAYS", default=90)
+
+# The dispatcher searches Slack for support requests that the bot missed.  It
+# waits MESSAGE_CHECK_MIN_INTERVAL seconds after its first search and after each
+# search that finds a request, and twice as long as last time after each other
+# search, up to MESSAGE_CHECK_MAX_INTERVAL seconds.  search.messages is a Tier 2 method (around
+# 20 calls per minute), and we make one call for each keyword.
+MESSAGE_CHECK_MIN_INTERVAL = env.float("MESSAGE_CHECK_MIN_INTERVAL", default=10)
+MESSAGE_CHECK_MAX_INTERVAL = env.float("MESSAGE_CHECK_MAX_INTERVAL", default=60)
+
 # Number of times to retry sending messages to slack
 MAX_SLACK_NOTIFY_RETRIES = env.int("MAX_SLACK_NOTIFY_RETRIES", default=2)
+
+# Messages from jobs are sent by a single process (see outbox.py), which retries
+# messages that fail with errors that may be transient (e.g. network errors or
+# rate limiting), waiting twice as long after each failure up to
+# SLACK_OUTBOX_MAX_RETRY_DELAY seconds, until SLACK_OUTBOX_MAX_ATTEMPTS attempts
+# have been made.
+SLACK_OUTBOX_MAX_ATTEMPTS = env.int("SLACK_OUTBOX_MAX_ATTEMPTS", default=20)
+SLACK_OUTBOX_MAX_RETRY_DELAY = env.float("SLACK_OUTBOX_MAX_RETRY_DELAY", default=300)
+
+# Number of times to retry a call to the Slack API that was rate limited
+SLACK_MAX_RATE_LIMIT_RETRIES = env.int("SLACK_MAX_RATE_LIMIT_RETRIES", default=3)
+
+# The bot keeps a directory of the workspace's users (see users.py), which is
+# updated from team_join and user_change events, and reloaded from users.list
+# once it is SLACK_USERS_TTL seconds old in case any events were missed.
+SLACK_USERS_TTL = env.float("SLACK_USERS_TTL", default=3600)
@@ -1,13 +1,48 @@
-from time import sleep
+import random
+import threading
+from time import monotonic, sleep
 
 from slack_sdk import WebClient
+from slack_sdk.http_retry import ConnectionErrorRetryHandler, RetryHandler
 
 from bennettbot import settings
 from workspace.utils.blocks import get_basic_header_and_text_blocks, truncate_text
 
+from . import metrics
 from .logger import logger
 
 
+# Slack limits how often each API method may be called by an app in a workspace,
+# with methods grouped into tiers.  See https://api.slack.com/apis/rate-limits
+# tier -> (calls per minute, number of calls that may be made in a burst)
+TIER_LIMITS = {
+    1: (1, 1),
+    2: (20, 5),
+    3: (50, 10),
+    4: (100, 20),
+}
+METHOD_TIERS = {
+    "chat.getPermalink": 4,
+    "chat.update": 3,
+    "conversations.join": 3,
+    "conversations.list": 2,
+    "files.completeUploadExternal": 4,
+    "files.getUploadURLExternal": 4,
+    "reactions.add": 3,
+    "search.messages": 2,
+    "users.conversations": 3,
+    "users.info": 4,
+    "users.list": 2,
+}
+DEFAULT_TIER = 3
+# chat.postMessage isn't in a tier; instead, apps may post about one message per
+# second to each channel, with short bursts allowed
+PER_CHANNEL_METHODS = {"chat.postMessage": (60, 5)}
+
+# token type -> RateLimiter
+_rate_limiters = {}
+
+
 def slack_web_client(token_type="bot"):
     match token_type:
         case "bot":
@@ -21,7 +56,150 @@ def slack_web_client(token_type="bot"):
         if token_type == "bot"
         else settings.SLACK_BOT_USER_TOKEN
     )
-    return WebClient(token=token)
+    # Rate limits apply to each token, so clients for the same token share a
+    # rate limiter.  Each process has its own rate limiters.
+    rate_limiter = _rate_limiters.setdefault(token_type, RateLimiter())
+    return RateLimitedWebClient(
+        token=token,
+        rate_limiter=rate_limiter,
+        retry_handlers=[
+            ConnectionErrorRetryHandler(),
+            RateLimitRetryHandler(
+                rate_limiter, max_retry_count=settings.SLACK_MAX_RATE_LIMIT_RETRIES
+            ),
+        ],
+    )
+
+
+class RateLimitedWebClient(WebClient):
+    """A WebClient that waits before calling a method if doing so would exceed the
+    method's rate limit."""
+
+    def __init__(self, *args, rate_limiter, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+
+    def api_call(self, api_method, **kwargs):
+        self._acquire(api_method, kwargs)
+        return super().api_call(api_method, **kwargs)
+
+    def _request_for_pagination(self, api_url, req_args):
+        # SlackResponse fetches the second and later pages of paginated responses
+        # with this method rather than with api_call
+        self._acquire(api_url.rsplit("/", 1)[-1], req_args)
+        return super()._request_for_pagination(api_url, req_args)
+
+    def _acquire(self, api_method, req_args):
+        args = (
+            req_args.get("json") or req_args.get("params") or req_args.get("data") or {}
+        )
+        self.rate_limiter.acquire(api_method, channel=args.get("channel"))
+
+
+class RateLimiter:
+    """Token buckets for each Slack API method (and for chat.postMessage, each
+    channel), which are refilled at the rate allowed by the method's tier."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.paused_until = {}
+
+    def acquire(self, method, channel=None):
+        """Wait until method may be called, returning the number of seconds waited."""
+        if method in PER_CHANNEL_METHODS:
+            key = (method, channel)
+            per_minute, burst = PER_CHANNEL_METHODS[method]
+        else:
+            key = (method, None)
+            per_minute, burst = TIER_LIMITS[METHOD_TIERS.get(method, DEFAULT_TIER)]
+
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(per_minute / 60, burst)
+            bucket = self.buckets[key]
+            pause = max(self.paused_until.get(method, 0) - monotonic(), 0)
+
+        if pause > 0:
+            sleep(pause)
+        wait = bucket.take()
+        if wait > 0:
+            sleep(wait)
+        if pause + wait > 0:
+            metrics.inc("bennettbot_slack_api_throttled_total", method=method)
+        return pause + wait
+
+    def pause(self, method, seconds):
+        """Stop calls to method for the given number of seconds."""
+        with self.lock:
+            self.paused_until[method] = max(
+                self.paused_until.get(method, 0), monotonic() + seconds
+            )
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token, returning the number of seconds until it is available.
+
+        The token is reserved straight away (so the number of tokens may become
+        negative), which means callers don't have to compete for tokens once
+        they've waited.
+        """
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(
+                self.tokens + (now - self.updated_at) * self.rate, self.capacity
+            )
+            self.updated_at = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class RateLimitRetryHandler(RetryHandler):
+    """Retry calls that are rate limited by Slack.
+
+    We wait for the number of seconds given by the Retry-After header, or for an
+    exponentially increasing interval if that's longer, plus some jitter so that
+    calls that were rate limited at the same time aren't retried at the same time.
+    Other calls to the same method from this process are paused too.
+    """
+
+    def __init__(self, rate_limiter, max_retry_count):
+        super().__init__(max_retry_count=max_retry_count)
+        self.rate_limiter = rate_limiter
+
+    def _can_retry(self, *, state, request, response=None, error=None):
+        return response is not None and response.status_code == 429
+
+    def prepare_for_next_attempt(self, *, state, request, response=None, error=None):
+        method = request.url.rsplit("/", 1)[-1]
+        retry_after = 1
+        for header, values in response.headers.items():
+            if header.lower() == "retry-after":
+                retry_after = int(values[0])
+        backoff = 2**state.current_attempt
+        duration = max(retry_after, backoff) + random.random()
+
+        logger.info("Rate limited by Slack", method=method, retry_after=duration)
+        metrics.inc("bennettbot_slack_api_rate_limited_total", method=method)
+        self.rate_limiter.pause(method, duration)
+        state.next_attempt_requested = True
+        sleep(duration)
+        state.increment_current_attempt()
+
+
+def reset_rate_limiters():
+    """Forget about calls made in this process; used in tests."""
+    _rate_limiters.clear()
 
 
 def notify_slack(
@@ -33,6 +211,39 @@ def notify_slack(
     retry_delay=1,
 ):
     """Send message to Slack."""
+
+    # In case of any unexpected transient exception posting to slack, retry up to
+    # MAX_SLACK_NOTIFY_RETRIES times (default 2) and then report and log the error,
+    # to avoid errors in scheduled jobs.  (Calls that are rate limited are retried
+    # by the client; see RateLimitRetryHandler.)
+    method = get_message_method(message_text, message_format)
+    retry_attempt = 0
+    error = None
+    while True:
+        try:
+            return send_message(
+                slack_client, channel, message_text, thread_ts, message_format
+            )
+        except Exception as err:
+            retry_attempt += 1
+            error = err
+
+        if retry_attempt > settings.MAX_SLACK_NOTIFY_RETRIES:
+            break
+        metrics.inc("bennettbot_slack_api_retries_total", method=method)
+        # Back off exponentially, with some jitter
+        delay = retry_delay * 2 ** (retry_attempt - 1)
+        sleep(delay + random.uniform(0, delay))
+
+    metrics.inc("bennettbot_slack_api_failures_total", method=method)
+    report_slack_error(slack_client, channel, message_text, thread_ts, error)
+
+
+def send_message(
+    slack_client, channel, message_text, thread_ts=None, message_format=None
+):
+    """Make a single attempt to send message to Slack, raising an exception if it
+    fails."""
     # The message text can be either a string or blocks (a list of dicts),
     # so stringify it for text arg and logs
     message_string = str(message_text)
@@ -51,44 +262,46 @@ def notify_slack(
         message=log_message_text,
         thread_ts=thread_ts,
     )
+    method = get_message_method(message_text, message_format)
+    if message_format == "code" and method == "chat.postMessage":
+        msg_kwargs["text"] = f"```{msg_kwargs['text']}```"
+
+    start = monotonic()
+    try:
+        if method == "files.upload":
+            resp = slack_client.files_upload_v2(content=message_text, **msg_kwargs)
+        else:
+            resp = slack_client.chat_postMessage(**msg_kwargs)
+    except Exception:
+        _observe_slack_call(method, start, "error")
+        raise
+    _observe_slack_call(method, start, "ok")
+    return resp.data
+
+
+def get_message_method(message_text, message_format):
+    """Return the Slack API method used to send a message in the given format."""
     # If messages are longer than 4000 characters, Slack will split them over
     # multiple messages. This breaks code formatting, so if a message with code
     # format is long, we upload it as a file snippet instead
-    if message_format == "code":
-        if len(message_text) > 3990:
-            message_format = "file"
-        else:
-            msg_kwargs["text"] = f"```{msg_kwargs['text']}```"
+    if message_format == "file" or (
+        message_format == "code" and len(message_text) > 3990
+    ):
+        return "files.upload"
+    return "chat.postMessage"
 
-    # In case of any unexpected transient exception posting to slack, retry up to
-    # MAX_SLACK_NOTIFY_RETRIES times (default 2) and then report and log the error,
-    # to avoid errors in scheduled jobs.
-    retry_attempt = 0
-    error = None
-    while True:
-        try:
-            if message_format == "file":
-                resp = slack_client.files_upload_v2(content=message_text, **msg_kwargs)
-            else:
-                resp = slack_client.chat_postMessage(**msg_kwargs)
-            return resp.data
-        except Exception as err:
-            retry_attempt += 1
-            error = err
-
-        if retry_attempt > settings.MAX_SLACK_NOTIFY_RETRIES:
-            break
-        sleep(retry_delay)
 
-    # The message has failed to post.
-    # Modify the Slack message to report the error and try posting it to the channel
+def report_slack_error(slack_client, channel, message_text, thread_ts, error):
+    """Report that a message could not be sent, and try posting the report to the
+    channel the message was for."""
     header_text = "Could not notify slack"
     try:
-        msg_kwargs["text"] = header_text
-        msg_kwargs["blocks"] = get_slack_error_blocks(
-            header_text, message_text, error=error
+        slack_client.chat_postMessage(
+            channel=channel,
+            thread_ts=thread_ts,
+            text=header_text,
+            blocks=get_slack_error_blocks(header_text, message_text, error=error),
         )
-        slack_client.chat_postMessage(**msg_kwargs)
     except Exception:
         # Not even the error message could not be posted to Slack, so
         pass
@@ -103,6 +316,34 @@ def notify_slack(
         )
 
 
+def update_slack_message(slack_client, channel, ts, message_text):
+    """Replace the text of a message that has already been sent to Slack.
+
+    This is used for messages that are updated repeatedly (e.g. to report the
+    progress of a job), so we don't retry on failure: the error is logged, and the
+    next update will replace the message anyway.  Returns True if the message
+    was updated.
+    """
+    start = monotonic()
+    try:
+        slack_client.chat_update(channel=channel, ts=ts, text=message_text)
+    except Exception as error:
+        _observe_slack_call("chat.update", start, "error")
+        logger.error("Could not update message", channel=channel, ts=ts, error=error)
+        return False
+    _observe_slack_call("chat.update", start, "ok")
+    return True
+
+
+def _observe_slack_call(method, start, outcome):
+    metrics.observe(
+        "bennettbot_slack_api_duration_seconds",
+        monotonic() - start,
+        method=method,
+        outcome=outcome,
+    )
+
+
 def get_slack_error_blocks(header_text, message_text, error):
     return get_basic_header_and_text_blocks(
         header_text=header_text,
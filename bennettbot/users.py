@@ -0,0 +1,99 @@
+"""An in-memory directory of the users in the Slack workspace.
+
+The bot uses the directory to decide whether a user may run commands in restricted
+namespaces.  It is loaded from users.list when the bot starts, kept up to date from
+team_join and user_change events, and reloaded in the background once it is
+SLACK_USERS_TTL seconds old, so that permission checks don't need to call Slack.
+"""
+
+import threading
+from time import monotonic
+
+from . import settings
+from .logger import logger
+
+
+# Number of users to request in each page of users.list.  Slack recommends no more
+# than 200.
+PAGE_SIZE = 200
+# Number of seconds to wait before trying again after the users couldn't be
+# reloaded, so that we don't keep calling users.list while Slack is unavailable
+RELOAD_RETRY_INTERVAL = 60
+
+
+class UserDirectory:
+    def __init__(self, client):
+        self.client = client
+        self._users = {}
+        self._reload_at = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._reload_thread = None
+
+    def load(self):
+        """Load all users from users.list, following its pagination."""
+
+        users = {}
+        for page in self.client.users_list(limit=PAGE_SIZE):
+            for user in page["members"]:
+                users[user["id"]] = user
+        with self._lock:
+            self._users = users
+            self._reload_at = monotonic() + settings.SLACK_USERS_TTL
+        logger.info("Loaded users", count=len(users))
+
+    def update(self, user):
+        """Add or replace a user, as received in a team_join or user_change event."""
+
+        with self._lock:
+            self._users[user["id"]] = user
+
+    def get(self, user_id):
+        """Return the user with the given id.
+
+        If the directory is older than SLACK_USERS_TTL it is reloaded in the
+        background, and in the meantime the users we already know about are used.
+        If the user is unknown (e.g. because we've not yet received their team_join
+        event) they are retrieved with users.info.
+        """
+
+        if self._reload_at is None:
+            # There are no users to use in the meantime
+            self._load_or_log_error()
+        elif monotonic() >= self._reload_at:
+            self._reload_in_background()
+        if (user := self._users.get(user_id)) is None:
+            user = self.client.users_info(user=user_id)["user"]
+            self.update(user)
+        return user
+
+    def get_id_by_name(self, name):
+        for user in self._users.values():
+            if user["name"] == name:
+                return user["id"]
+        raise KeyError(name)
+
+    def is_guest(self, user_id):
+        return self.get(user_id).get("is_restricted", True)
+
+    def _reload_in_background(self):
+        if not self._reload_lock.acquire(blocking=False):
+            return  # Another thread is already reloading the directory
+        self._reload_thread = threading.Thread(
+            target=self._reload, name="bennettbot-users-reload", daemon=True
+        )
+        self._reload_thread.start()
+
+    def _reload(self):
+        try:
+            self._load_or_log_error()
+        finally:
+            self._reload_lock.release()
+
+    def _load_or_log_error(self):
+        try:
+            self.load()
+        except Exception as error:
+            # Carry on with the users we already know about, and try again later
+            logger.error("Could not reload users", error=error)
+            self._reload_at = monotonic() + RELOAD_RETRY_INTERVAL
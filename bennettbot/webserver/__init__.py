@@ -1,5 +1,6 @@
-from flask import Flask
+from flask import Flask, Response
 
+from .. import metrics
 from .github import handle_github_webhook
 
 
@@ -7,6 +8,11 @@ def check():
     return "ok"
 
 
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 app = Flask(__name__)
 app.route("/check/", methods=["GET"])(check)
+app.route("/metrics", methods=["GET"])(get_metrics)
 app.route("/github/<project>/", methods=["POST"])(handle_github_webhook)
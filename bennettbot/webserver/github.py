@@ -1,8 +1,9 @@
 import json
+from time import monotonic
 
 from flask import Response, abort, request
 
-from .. import scheduler, settings
+from .. import metrics, scheduler, settings
 from ..job_configs import config
 from ..logger import logger
 from ..signatures import InvalidHMAC, validate_hmac
@@ -18,13 +19,17 @@ def handle_github_webhook(project):
         https://github.com/ebmdatalab/openprescribing/settings/hooks/85994427
     """
 
-    verify_signature(request)
-    logger.info("Received webhook", project=project)
+    start = monotonic()
+    try:
+        verify_signature(request)
+        logger.info("Received webhook", project=project)
 
-    if should_deploy(request):
-        schedule_deploy(project)
+        if should_deploy(request):
+            schedule_deploy(project)
 
-    return ""
+        return ""
+    finally:
+        metrics.observe("bennettbot_webhook_duration_seconds", monotonic() - start)
 
 
 def verify_signature(request):
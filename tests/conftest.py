@@ -6,7 +6,7 @@ import os
 
 import pytest
 
-from bennettbot import settings
+from bennettbot import connection, metrics, settings, slack
 
 
 pytest.register_assert_rewrite("tests.assertions")
@@ -14,7 +14,19 @@ pytest.register_assert_rewrite("tests.assertions")
 
 @pytest.fixture(autouse=True)
 def reset_db():
-    try:
-        os.remove(settings.DB_PATH)
-    except FileNotFoundError:
-        pass
+    connection.reset_connections()
+    for suffix in ["", "-wal", "-shm"]:
+        try:
+            os.remove(f"{settings.DB_PATH}{suffix}")
+        except FileNotFoundError:
+            pass
+
+
+@pytest.fixture(autouse=True)
+def reset_rate_limiters():
+    slack.reset_rate_limiters()
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics_buffer():
+    metrics.reset_buffer()
@@ -62,6 +62,28 @@ raw_config = {
                 "report_format": "code",
                 "report_stdout": True,
             },
+            "good_entrypoint_job": {
+                "run_args_template": "hello_world --name {name}",
+                "entrypoint": "tests.workspace.test.jobs:main",
+                "report_stdout": True,
+            },
+            "bad_entrypoint_job": {
+                "run_args_template": "hello_world_blocks_error",
+                "entrypoint": "tests.workspace.test.jobs:main",
+                "report_stdout": True,
+            },
+            "entrypoint_job_with_exit_message": {
+                "run_args_template": "exit_with_message",
+                "entrypoint": "tests.workspace.test.jobs:main",
+            },
+            "entrypoint_job_with_bad_args": {
+                "run_args_template": "unknown_command",
+                "entrypoint": "tests.workspace.test.jobs:main",
+            },
+            "progress_job": {
+                "run_args_template": "cat poem",
+                "report_progress": True,
+            },
             "good_job_with_code": {
                 "run_args_template": "cat poem",
                 "report_stdout": True,
@@ -113,11 +113,10 @@ def register_bot_uris():
                     ],
                 }
             ],
-            # called to find out if bot is in channel
-            "conversations.members": [
+            # called to find out which channels the bot is in
+            "users.conversations": [
                 # mock bot membership of one channel
-                {"ok": True, "members": ["U1234"]},
-                {"ok": True, "members": []},
+                {"ok": True, "channels": [{"id": "C0000"}]},
             ],
             # join channels bot isn't already in
             "conversations.join": [{"ok": True}],
@@ -143,6 +142,7 @@ def register_dispatcher_uris():
     httpretty_register(
         {
             "chat.postMessage": [{"ok": True, "ts": TS, "channel": "channel"}],
+            "chat.update": [{"ok": True, "ts": TS, "channel": "channel"}],
             "chat.getPermalink": [
                 {"ok": True, "channel": "channel", "permalink": "http://example.com"}
             ],
@@ -157,7 +157,7 @@ def get_mock_received_requests():
     httpretty.
     Note that the slack_sdk uses params for its api calls for most methods.
     It uses json for calls that use (or can use) blocks. For our purposes, this
-    if just the chat.postMessage calls.
+    is just the chat.postMessage and chat.update calls.
     param values are converted to lists during the api call, so e.g. for a
     reactions.add call, a call using
         client.reactions_add(channel="C1", name=":sos:", timestamp=123.45)
@@ -169,7 +169,7 @@ def get_mock_received_requests():
     requests_by_path = {}
     for request in httpretty.latest_requests():
         body = request.parsed_body
-        if request.path == "/api/chat.postMessage":
+        if request.path in ["/api/chat.postMessage", "/api/chat.update"]:
             body = json.loads(body)
         requests_by_path.setdefault(request.path, []).append(body)
     return requests_by_path
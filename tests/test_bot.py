@@ -1,16 +1,18 @@
+import itertools
 import json
+import threading
 import time
 from datetime import datetime, timedelta
-from unittest.mock import Mock, patch
+from unittest.mock import DEFAULT, Mock, patch
 
 import httpretty
 import pytest
-from slack_bolt import App
 from slack_bolt.request import BoltRequest
 from slack_sdk.errors import SlackApiError
 from slack_sdk.signature import SignatureVerifier
 
-from bennettbot import bot, scheduler
+from bennettbot import bot, metrics, scheduler, settings
+from bennettbot.slack import slack_web_client
 
 from .assertions import (
     assert_call_counts,
@@ -21,20 +23,30 @@ from .assertions import (
     assert_suppression_matches,
 )
 from .job_configs import config
-from .mock_http_request import USERS, get_mock_received_requests, register_bot_uris
+from .mock_http_request import (
+    USERS,
+    get_mock_received_requests,
+    httpretty_register,
+    register_bot_uris,
+)
 from .time_helpers import T0, TS, T
 
 
 # Make sure all tests run when datetime.now() returning T0
 pytestmark = pytest.mark.freeze_time(T0)
 
+EVENT_IDS = itertools.count()
+
 
+# httpretty doesn't reliably record requests that are made concurrently, so we join
+# channels one at a time in tests
+@patch("bennettbot.bot.MAX_CONCURRENT_JOINS", 1)
 def get_mock_app():
-    app = App(raise_error_for_unhandled_request=True)
+    app = bot.build_app()
     channels = bot.get_channels(app.client)
-    bot_user_id, internal_user_ids = bot.get_users_info(app.client)
+    bot_user_id, users = bot.get_users_info(app.client)
     bot.join_all_channels(app.client, channels, bot_user_id)
-    bot.register_listeners(app, config, channels, bot_user_id, internal_user_ids)
+    bot.register_listeners(app, config, channels, bot_user_id, users)
     return app
 
 
@@ -49,11 +61,66 @@ def mock_app():
 
 
 def test_joined_channels(mock_app):
-    # conversations.members called for each channel (4) (to check if bot is already a
-    # member) and conversations.join 3 times to join the channels it's not already in
+    # users.conversations called once to find the channels the bot is already a
+    # member of, and conversations.join 3 times to join the channels it's not
+    # already in
     assert_call_counts(
-        {"/api/conversations.members": 4, "/api/conversations.join": 3},
+        {"/api/users.conversations": 1, "/api/conversations.join": 3},
     )
+    joined = {
+        request["channel"][0]
+        for request in get_mock_received_requests()["/api/conversations.join"]
+    }
+    assert joined == {"C0001", "C0002", "C0003"}
+
+
+@patch("bennettbot.bot.MAX_CONCURRENT_JOINS", 1)
+def test_join_all_channels_with_thousands_of_channels():
+    # A benchmark for a large workspace: the number of requests made grows with
+    # the number of pages of channels, rather than the number of channels
+    channels = [
+        {"name": f"channel{i}", "id": f"C{i:05}", "is_archived": False}
+        for i in range(5000)
+    ]
+    pages = [channels[i : i + 1000] for i in range(0, len(channels), 1000)]
+
+    def paginated(key, pages):
+        return [
+            {
+                "ok": True,
+                key: page,
+                "response_metadata": {"next_cursor": f"page{i + 1}"},
+            }
+            for i, page in enumerate(pages[:-1])
+        ] + [{"ok": True, key: pages[-1], "response_metadata": {"next_cursor": ""}}]
+
+    with httpretty.enabled(allow_net_connect=False):
+        # The bot is already a member of all but the last 5 channels
+        member_channels = [{"id": c["id"]} for c in channels[:-5]]
+        httpretty_register(
+            {
+                "conversations.list": paginated("channels", pages),
+                "users.conversations": paginated(
+                    "channels",
+                    [member_channels[i : i + 1000] for i in range(0, 5000, 1000)],
+                ),
+                "conversations.join": [{"ok": True}],
+            }
+        )
+        client = slack_web_client()
+
+        channel_ids = bot.get_channels(client)
+        joined = bot.join_all_channels(client, channel_ids, "U1234")
+
+        assert len(channel_ids) == 5000
+        assert sorted(joined) == [f"channel{i}" for i in range(4995, 5000)]
+        assert_call_counts(
+            {
+                "/api/conversations.list": 5,
+                "/api/users.conversations": 5,
+                "/api/conversations.join": 5,
+            }
+        )
 
 
 def test_schedule_job(mock_app):
@@ -260,6 +327,63 @@ def test_status(mock_app):
     )
 
 
+def test_status_history(mock_app):
+    handle_message(mock_app, "<@U1234> status history", reaction_count=0)
+    assert_slack_client_sends_messages(
+        messages_kwargs=[{"channel": "channel", "text": "No job runs found"}],
+    )
+
+
+def test_status_history_for_job_type(mock_app):
+    handle_message(mock_app, "<@U1234> status history test_good_job", reaction_count=0)
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "channel", "text": "No runs of test_good_job found"}
+        ],
+    )
+
+
+def test_build_status_history(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    job = scheduler.reserve_job()
+    freezer.move_to(T(30))
+    scheduler.mark_job_done(job["id"], rc=0)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 10)
+    freezer.move_to(T(45))
+    job = scheduler.reserve_job()
+    freezer.move_to(T(47))
+    scheduler.mark_job_done(job["id"], rc=1)
+
+    assert (
+        bot._build_status_history(None)
+        == """
+Job runs in the last 90 days (time queued and time taken are shown as p50 / p95):
+
+* good_job: 1 run (0 failed), queued 0.0s / 0.0s, took 30.0s / 30.0s
+* odd_job: 1 run (1 failed), queued 5.0s / 5.0s, took 2.0s / 2.0s
+""".strip()
+    )
+
+    assert (
+        bot._build_status_history("odd_job")
+        == """
+Job runs in the last 90 days (time queued and time taken are shown as p50 / p95):
+
+* odd_job: 1 run (1 failed), queued 5.0s / 5.0s, took 2.0s / 2.0s
+
+Most recent runs:
+
+* [1] started at 2019-12-10 11:12:58+00:00, took 2.0s, return code 1
+""".strip()
+    )
+
+
+def test_pluralise_count():
+    assert bot._pluralise_count(0, "run") == "0 runs"
+    assert bot._pluralise_count(1, "run") == "1 run"
+    assert bot._pluralise_count(2, "run") == "2 runs"
+
+
 @pytest.mark.parametrize(
     "pre_message,message",
     [
@@ -376,6 +500,20 @@ There is 1 scheduled suppression:
     )
 
 
+@patch("bennettbot.scheduler.settings.MAX_CONCURRENT_JOBS", 1)
+def test_build_status_with_capped_job():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    scheduler.reserve_job()
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 0)
+
+    status = bot._build_status()
+
+    assert (
+        "* [2] odd_job (due since 2019-12-10 11:12:13+00:00; "
+        "waiting because limit of 1 running jobs reached)"
+    ) in status
+
+
 def test_pluralise():
     assert bot._pluralise(0, "bot") == "There are 0 bots"
     assert bot._pluralise(1, "bot") == "There is 1 bot"
@@ -540,6 +678,38 @@ def test_tech_support_edited_message(mock_app):
     assert_tech_support_paths_called()
 
 
+def test_tech_support_edited_message_after_error(mock_app):
+    # If we fail to react to a tech-support message, we don't remember it, so
+    # editing the message reposts it
+    error = SlackApiError(message="Error", response=Mock(data={"error": "fatal_error"}))
+    with patch.object(mock_app.client, "reactions_add", side_effect=[error, DEFAULT]):
+        handle_message(
+            mock_app,
+            "get tech-support",
+            channel="C0002",
+            reaction_count=0,
+            event_type="message",
+            event_kwargs={"subtype": "message_changed"},
+        )
+
+    assert "/api/chat.getPermalink" not in get_mock_received_requests()
+
+    handle_message(
+        mock_app,
+        "get tech-support now",
+        channel="C0002",
+        reaction_count=1,
+        event_type="message",
+        event_kwargs={"subtype": "message_changed"},
+    )
+
+    received_requests = get_mock_received_requests()
+    assert len(received_requests["/api/chat.getPermalink"]) == 1
+    post_message = received_requests["/api/chat.postMessage"][-1]
+    assert ("text", "http://example.com") in post_message.items()
+    assert ("channel", "C0001") in post_message.items()
+
+
 @patch("bennettbot.bot.get_tech_support_dates")
 def test_tech_support_out_of_office_listener(tech_support_dates, mock_app):
     start = (datetime.today() - timedelta(1)).date()
@@ -650,6 +820,27 @@ def test_tech_support_listener_in_direct_message(mock_app):
     assert ("channel", "IM0001") in post_message.items()
 
 
+@patch("bennettbot.bot.settings.BOT_MAX_CONCURRENT_EVENTS", 3)
+def test_build_app_uses_configured_listener_pool(mock_app):
+    app = bot.build_app()
+
+    # Bolt's default pool has 5 threads
+    assert app.listener_runner.listener_executor._max_workers == 3
+
+
+def test_listeners_run_in_listener_pool(mock_app):
+    thread_names = []
+
+    with patch(
+        "bennettbot.bot.tech_support_out_of_office",
+        side_effect=lambda: thread_names.append(threading.current_thread().name),
+    ):
+        handle_message(mock_app, "tech-support", channel="C0002", event_type="message")
+
+    assert len(thread_names) == 1
+    assert thread_names[0].startswith("bennettbot-listener")
+
+
 def test_no_listener_found(mock_app):
     # A message must either start with "<@U1234>" (i.e. a user @'d the bot) OR must contain
     # the tech-support pattern
@@ -687,6 +878,104 @@ def test_unexpected_error(mock_app):
     )
 
 
+@patch("bennettbot.bot.DEDUP_METRICS_INTERVAL", 0)
+def test_duplicate_event_ignored(mock_app):
+    request = get_mock_request(
+        "app_mention", {"channel": "channel", "text": "<@U1234> test do job 10"}
+    )
+    mock_app.dispatch(request)
+    time.sleep(0.1)
+
+    # Slack delivers the same event again
+    resp = mock_app.dispatch(get_mock_request_from_body(request.raw_body))
+    time.sleep(0.1)
+
+    assert resp.body == "Duplicate event"
+    assert len(scheduler.get_jobs_of_type("test_good_job")) == 1
+    assert_slack_client_reacts_to_message(1)
+    assert (
+        'bennettbot_slack_event_dedup_total{kind="event",result="hit"} 1\n'
+        in metrics.render()
+    )
+
+
+@patch("bennettbot.bot.DEDUP_METRICS_INTERVAL", 0)
+def test_tech_support_listener_ignores_edits_to_handled_messages(mock_app, freezer):
+    handle_message(
+        mock_app,
+        "Calling tech-support",
+        channel="C0002",
+        event_type="message",
+        event_kwargs={},
+    )
+    # Editing the message doesn't react to or repost it again
+    handle_message(
+        mock_app,
+        "Calling tech-support again",
+        channel="C0002",
+        event_type="message",
+        event_kwargs={"subtype": "message_changed"},
+    )
+    assert len(get_mock_received_requests()["/api/chat.getPermalink"]) == 1
+    assert (
+        'bennettbot_slack_event_dedup_total{kind="support_request",result="hit"} 1\n'
+        in metrics.render()
+    )
+
+    # Once we've forgotten the message, an edit is handled again
+    freezer.tick(settings.BOT_DEDUP_TTL)
+    handle_message(
+        mock_app,
+        "Calling tech-support once more",
+        channel="C0002",
+        reaction_count=2,
+        event_type="message",
+        event_kwargs={"subtype": "message_changed"},
+    )
+    assert len(get_mock_received_requests()["/api/chat.getPermalink"]) == 2
+
+
+def test_recently_seen_records_metrics_periodically(freezer):
+    recently_seen = bot.RecentlySeen()
+
+    recently_seen.check("event", 1)
+    recently_seen.check("event", 1)
+    assert "bennettbot_slack_event_dedup_total{" not in metrics.render()
+
+    freezer.tick(bot.DEDUP_METRICS_INTERVAL)
+    recently_seen.check("event", 2)
+    rendered = metrics.render()
+    assert (
+        'bennettbot_slack_event_dedup_total{kind="event",result="hit"} 1\n' in rendered
+    )
+    assert (
+        'bennettbot_slack_event_dedup_total{kind="event",result="miss"} 2\n' in rendered
+    )
+
+    # The counts are reset once they've been recorded
+    freezer.tick(bot.DEDUP_METRICS_INTERVAL)
+    recently_seen.check("event", 2)
+    rendered = metrics.render()
+    assert (
+        'bennettbot_slack_event_dedup_total{kind="event",result="hit"} 2\n' in rendered
+    )
+    assert (
+        'bennettbot_slack_event_dedup_total{kind="event",result="miss"} 2\n' in rendered
+    )
+
+
+@patch("bennettbot.bot.settings.BOT_DEDUP_MAX_SIZE", 2)
+def test_recently_seen_forgets_oldest_keys():
+    recently_seen = bot.RecentlySeen()
+
+    assert not recently_seen.check("event", 1)
+    assert not recently_seen.check("event", 2)
+    assert recently_seen.check("event", 1)
+    assert not recently_seen.check("event", 3)
+    assert not recently_seen.check("event", 1)
+    assert recently_seen.check("event", 3)
+
+
 def test_already_reacted_to_tech_support_error(mock_app):
     # mock an error from a method that's called during the tech-support
     # handling to return an "already reacted" SlackApiError
@@ -814,6 +1103,29 @@ def test_restricted_jobs_only_scheduled_for_internal_users(
         assert_slack_client_sends_messages(
             messages_kwargs=[{"channel": "channel", "text": ":no_entry:"}],
         )
+    # users.info is only called for users who weren't returned by users.list when
+    # the bot started
+    users_info_requests = get_mock_received_requests().get("/api/users.info", [])
+    assert len(users_info_requests) == (1 if user.startswith("NEW") else 0)
+
+
+@pytest.mark.parametrize("event_type", ["team_join", "user_change"])
+def test_user_events_update_users(mock_app, event_type):
+    # A user who was internal becomes a guest
+    handle_event(
+        mock_app,
+        event_type=event_type,
+        event_kwargs={"user": {**USERS["UINT"], "is_restricted": True}},
+    )
+
+    handle_message(
+        mock_app,
+        "<@U1234> testrestricted do job",
+        event_kwargs={"user": "UINT"},
+        reaction_count=0,
+    )
+    assert not scheduler.get_jobs()
+    assert "/api/users.info" not in get_mock_received_requests()
 
 
 def handle_message(
@@ -861,6 +1173,20 @@ def handle_event(mock_app, event_type, event_kwargs, expected_status=200):
     return resp
 
 
+def get_mock_request_from_body(body):
+    timestamp = str(int(time.time()))
+    signature = SignatureVerifier("secret").generate_signature(
+        body=body,
+        timestamp=timestamp,
+    )
+    headers = {
+        "content-type": ["application/json"],
+        "x-slack-signature": [signature],
+        "x-slack-request-timestamp": [timestamp],
+    }
+    return BoltRequest(body=body, headers=headers)
+
+
 def get_mock_request(event_type, event_kwargs):
     body = {
         "token": "verification_token",
@@ -877,18 +1203,9 @@ def get_mock_request(event_type, event_kwargs):
             "channel_type": "channel",
         },
         "type": "event_callback",
-        "event_id": "Ev111",
+        # Give each event a unique id so that it isn't ignored as a duplicate
+        "event_id": f"Ev{next(EVENT_IDS)}",
         "event_time": 1596183880,
     }
     body["event"].update(event_kwargs)
-    timestamp, body = str(int(time.time())), json.dumps(body)
-    signature = SignatureVerifier("secret").generate_signature(
-        body=body,
-        timestamp=timestamp,
-    )
-    headers = {
-        "content-type": ["application/json"],
-        "x-slack-signature": [signature],
-        "x-slack-request-timestamp": [timestamp],
-    }
-    return BoltRequest(body=body, headers=headers)
+    return get_mock_request_from_body(json.dumps(body))
@@ -0,0 +1,226 @@
+import re
+import sqlite3
+from threading import Barrier, Thread
+from unittest.mock import patch
+
+from bennettbot import connection, metrics, scheduler, settings
+
+from .time_helpers import TS, T
+
+
+def test_get_connection_reuses_connection():
+    conn = connection.get_connection()
+    stats = connection.connection_stats()
+
+    assert connection.get_connection() is conn
+    assert connection.connection_stats() == {
+        "opened": stats["opened"],
+        "reused": stats["reused"] + 1,
+    }
+
+
+def test_get_connection_creates_tables():
+    conn = connection.get_connection()
+    tables = {
+        row["name"]
+        for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    }
+    assert {"job", "suppression"} <= tables
+
+
+def test_reset_connections_opens_new_connection():
+    conn = connection.get_connection()
+    connection.reset_connections()
+
+    assert connection.get_connection() is not conn
+
+
+def test_get_connection_in_another_thread():
+    conn = connection.get_connection()
+    thread_conns = []
+    thread = Thread(target=lambda: thread_conns.append(connection.get_connection()))
+    thread.start()
+    thread.join()
+
+    assert thread_conns[0] is not conn
+
+
+def test_get_connection_in_forked_process():
+    conn = connection.get_connection()
+
+    # A forked process has a different pid, so doesn't reuse its parent's connection
+    with patch("bennettbot.connection.os.getpid", return_value=-1):
+        assert connection.get_connection() is not conn
+
+
+def test_connection_stats_reset_in_forked_process():
+    connection.get_connection()
+    connection.get_connection()
+
+    # This is registered to be called in the child after a fork
+    connection._after_fork_in_child()
+
+    assert connection.connection_stats() == {"opened": 0, "reused": 0}
+
+
+def test_pragmas_applied():
+    conn = connection.get_connection()
+
+    assert conn.execute("PRAGMA journal_mode").fetchone()["journal_mode"] == "wal"
+    assert conn.execute("PRAGMA synchronous").fetchone()["synchronous"] == 1
+    assert conn.execute("PRAGMA busy_timeout").fetchone()["timeout"] == 5000
+    assert conn.execute("PRAGMA cache_size").fetchone()["cache_size"] == -2000
+
+
+def test_concurrent_writers():
+    # Each thread gets its own connection, just as the bot, the dispatcher, job
+    # processes and webserver workers each have their own connection in
+    # production.  None of them should fail to get a lock.
+    def bot_writer(i):
+        scheduler.schedule_job(f"test_job_{i % 5}", {"i": i}, "channel", TS, 0)
+        scheduler.schedule_suppression(f"test_job_{i % 7}", T(-10), T(-5))
+        scheduler.cancel_job(f"test_job_{i % 3}")
+
+    def dispatcher_writer(i):
+        scheduler.remove_expired_suppressions()
+        job = scheduler.reserve_job()
+        if job is not None:
+            scheduler.mark_job_done(job["id"])
+
+    def webserver_writer(i):
+        scheduler.schedule_job("test_deploy", {}, "channel", "", delay_seconds=60)
+        scheduler.get_suppressions()
+
+    writers = [bot_writer, dispatcher_writer, webserver_writer] * 3
+    barrier = Barrier(len(writers))
+    errors = []
+
+    def run(writer):
+        barrier.wait()
+        try:
+            for i in range(30):
+                writer(i)
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    threads = [Thread(target=run, args=(writer,)) for writer in writers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+
+def test_wait_for_change_when_database_changed():
+    change_count = connection.get_change_count(scheduler.CHANGE_NAME)
+    thread = Thread(
+        target=scheduler.schedule_job, args=("good_job", {}, "channel", TS, 0)
+    )
+    thread.start()
+
+    assert connection.wait_for_change(
+        scheduler.CHANGE_NAME, change_count, timeout=5, poll_interval=0.01
+    )
+    thread.join()
+
+
+def test_wait_for_change_ignores_other_changes():
+    change_count = connection.get_change_count(scheduler.CHANGE_NAME)
+
+    def record_metric():
+        metrics.inc("bennettbot_slack_api_retries_total")
+        metrics.flush()
+
+    thread = Thread(target=record_metric)
+    thread.start()
+    thread.join()
+
+    assert not connection.wait_for_change(
+        scheduler.CHANGE_NAME, change_count, timeout=0.05, poll_interval=0.01
+    )
+
+
+def test_wait_for_change_times_out():
+    change_count = connection.get_change_count(scheduler.CHANGE_NAME)
+
+    assert not connection.wait_for_change(
+        scheduler.CHANGE_NAME, change_count, timeout=0.05, poll_interval=0.01
+    )
+
+
+def test_get_change_count():
+    assert connection.get_change_count(scheduler.CHANGE_NAME) == 0
+
+    scheduler.schedule_job("good_job", {}, "channel", TS, 0)
+    scheduler.cancel_job("good_job")
+
+    assert connection.get_change_count(scheduler.CHANGE_NAME) == 2
+
+
+def get_user_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()["user_version"]
+
+
+def test_migrations_applied():
+    conn = connection.get_connection()
+
+    assert get_user_version(conn) == len(connection.MIGRATIONS)
+
+
+def test_migrate_applies_only_new_migrations():
+    conn = connection.get_connection()
+    migrations = connection.MIGRATIONS + [["CREATE TABLE extra (id INTEGER)"]]
+
+    with patch("bennettbot.connection.MIGRATIONS", migrations):
+        connection.migrate(conn)
+        # Nothing to do the second time round; if the new migration were applied
+        # again this would raise an error as the table already exists
+        connection.migrate(conn)
+
+    assert get_user_version(conn) == len(migrations)
+
+
+def test_migrate_database_created_before_migrations():
+    # Databases created before we had migrations have the tables from the first
+    # migration, but no user_version
+    conn = sqlite3.connect(settings.DB_PATH)
+    for statement in connection.MIGRATIONS[0]:
+        conn.execute(statement)
+    conn.execute("INSERT INTO job (type, args) VALUES ('good_job', '{}')")
+    conn.commit()
+    conn.close()
+
+    conn = connection.get_connection()
+
+    assert get_user_version(conn) == len(connection.MIGRATIONS)
+    assert [job["type"] for job in scheduler.get_jobs()] == ["good_job"]
+
+
+def test_dispatcher_queries_use_indexes():
+    scheduler.schedule_job("good_job", {}, "channel", TS, 0)
+    scheduler.schedule_job("odd_job", {}, "channel", TS, 10)
+    scheduler.schedule_suppression("odd_job", T(-5), T(5))
+
+    conn = connection.get_connection()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    scheduler.schedule_job("good_job", {}, "channel", TS, 0)
+    scheduler.remove_expired_suppressions()
+    scheduler.reserve_job()
+    scheduler.get_next_due_time()
+    conn.set_trace_callback(None)
+
+    queries = [
+        statement
+        for statement in statements
+        if statement.split()[0].upper() in ["SELECT", "WITH", "UPDATE", "DELETE"]
+    ]
+    assert queries
+    for query in queries:
+        plan = [row["detail"] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}")]
+        # A table scan that doesn't use an index looks like "SCAN job"
+        assert not any(re.match(r"SCAN (job|suppression)$", step) for step in plan), (
+            query,
+            plan,
+        )
@@ -1,13 +1,22 @@
 import json
 import os
 import shutil
+import time
 from unittest.mock import Mock, patch
 
 import httpretty
 import pytest
-
-from bennettbot import scheduler, settings
-from bennettbot.dispatcher import JobDispatcher, MessageChecker, run_once
+from slack_sdk.errors import SlackApiError
+
+from bennettbot import job_configs, outbox, scheduler, settings
+from bennettbot.dispatcher import (
+    JobDispatcher,
+    MessageChecker,
+    ProgressReporter,
+    preload_entrypoints,
+    run_once,
+    wait_for_work,
+)
 from bennettbot.slack import slack_web_client
 
 from .assertions import assert_call_counts, assert_slack_client_sends_messages
@@ -57,6 +66,22 @@ def test_run_once():
     assert not os.path.exists(build_log_dir("test_really_bad_job"))
 
 
+@patch("bennettbot.dispatcher.connection.wait_for_change")
+def test_wait_for_work_with_nothing_scheduled(wait_for_change):
+    wait_for_work(1)
+
+    wait_for_change.assert_called_once_with("job", 1, 60, 0.05)
+
+
+@patch("bennettbot.dispatcher.connection.wait_for_change")
+def test_wait_for_work_until_job_due(wait_for_change):
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 30)
+
+    wait_for_work(1)
+
+    wait_for_change.assert_called_once_with("job", 1, 30, 0.05)
+
+
 def test_job_success_with_unsafe_shell_args():
     log_dir = build_log_dir("test_parameterised_job_2")
 
@@ -101,6 +126,18 @@ def test_job_success():
         assert f.read() == ""
 
 
+def test_job_run_recorded():
+    scheduler.schedule_job("test_good_job", {}, "channel", TS, 0)
+    scheduler.schedule_job("test_bad_job", {}, "channel", TS, 0)
+
+    for job in scheduler.reserve_jobs():
+        do_job(slack_web_client(), job)
+
+    assert scheduler.get_job_runs("test_good_job")[0]["rc"] == 0
+    assert scheduler.get_job_runs("test_bad_job")[0]["rc"] == 1
+    assert not scheduler.get_jobs()
+
+
 def test_job_success_with_parameterised_args():
     log_dir = build_log_dir("test_parameterised_job")
 
@@ -189,6 +226,113 @@ def test_job_success_with_slack_exception():
         assert f.read() == ""
 
 
+def test_job_with_progress():
+    scheduler.schedule_job("test_progress_job", {}, "channel", TS, 0)
+    job = scheduler.reserve_job()
+
+    do_job(slack_web_client(), job)
+
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            # the progress message is sent straight away, and the others are sent
+            # from the outbox
+            {"channel": "channel", "text": "`test_progress_job` is running"},
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "succeeded"},
+        ],
+    )
+    assert get_mock_received_requests()["/api/chat.update"] == [
+        {
+            "channel": "channel",
+            "ts": TS,
+            "text": (
+                "Command `test_progress_job` finished; latest output:\n"
+                "```the owl and the pussycat\n```"
+            ),
+        }
+    ]
+
+
+@patch("bennettbot.dispatcher.notify_slack", return_value=None)
+def test_job_with_progress_with_slack_exception(notify_slack):
+    # notify_slack returns None if it couldn't post the message
+    log_dir = build_log_dir("test_progress_job")
+
+    scheduler.schedule_job("test_progress_job", {}, "channel", TS, 0)
+    job = scheduler.reserve_job()
+
+    do_job(slack_web_client(), job)
+
+    assert "/api/chat.update" not in get_mock_received_requests()
+    with open(os.path.join(log_dir, "stdout")) as f:
+        assert f.read() == "the owl and the pussycat\n"
+
+
+@patch("bennettbot.dispatcher.settings.JOB_PROGRESS_INTERVAL", 0.01)
+def test_progress_reporter_updates_while_running(tmp_path):
+    stdout_path = tmp_path / "stdout"
+    stdout_path.write_text("line 1\n")
+    reporter = ProgressReporter(
+        slack_web_client(), "channel", TS, "test_job", stdout_path
+    )
+
+    reporter.start()
+    while reporter.reported_text is None:
+        time.sleep(0.01)
+    with open(stdout_path, "a") as f:
+        f.write("line 2\n")
+    reporter.stop()
+
+    texts = [r["text"] for r in get_mock_received_requests()["/api/chat.update"]]
+    assert texts[0] == "Command `test_job` is running; latest output:\n```line 1\n```"
+    assert texts[-1] == (
+        "Command `test_job` finished; latest output:\n```line 1\nline 2\n```"
+    )
+
+
+@patch("bennettbot.dispatcher.settings.JOB_PROGRESS_MAX_BYTES", 10)
+def test_progress_reporter_keeps_end_of_output(tmp_path):
+    stdout_path = tmp_path / "stdout"
+    stdout_path.write_text("x" * 1000 + "0123456789")
+    reporter = ProgressReporter(
+        slack_web_client(), "channel", TS, "test_job", stdout_path
+    )
+
+    reporter.update()
+    reporter.update()
+
+    assert reporter.tail == b"0123456789"
+    assert_call_counts({"/api/chat.update": 1})
+
+
+def test_progress_reporter_with_no_output(tmp_path):
+    stdout_path = tmp_path / "stdout"
+    stdout_path.touch()
+    reporter = ProgressReporter(
+        slack_web_client(), "channel", TS, "test_job", stdout_path
+    )
+
+    reporter.update(finished=True)
+
+    assert reporter.reported_text == "Command `test_job` finished"
+
+
+def test_progress_reporter_with_slack_exception(tmp_path):
+    httpretty_register({"chat.update": [{"ok": False, "error": "error"}] * 2})
+    stdout_path = tmp_path / "stdout"
+    stdout_path.write_text("line 1\n")
+    reporter = ProgressReporter(
+        slack_web_client(), "channel", TS, "test_job", stdout_path
+    )
+
+    reporter.update()
+    reporter.update()
+
+    # We try again, since the previous update failed
+    assert_call_counts({"/api/chat.update": 2})
+    assert reporter.reported_text is None
+
+
 def test_job_failure():
     log_dir = build_log_dir("test_bad_job")
 
@@ -434,6 +578,168 @@ def test_python_job_with_no_output():
         assert f.read() == ""
 
 
+def test_entrypoint_job_success():
+    log_dir = build_log_dir("test_good_entrypoint_job")
+
+    scheduler.schedule_job(
+        "test_good_entrypoint_job", {"name": "Fred Bloggs"}, "channel", TS, 0
+    )
+    job = scheduler.reserve_job()
+
+    do_job(slack_web_client(), job)
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "Hello Fred Bloggs!\n"},
+        ],
+    )
+
+    with open(os.path.join(log_dir, "stdout")) as f:
+        assert f.read() == "Hello Fred Bloggs!\n"
+
+    with open(os.path.join(log_dir, "stderr")) as f:
+        assert f.read() == ""
+
+
+def test_entrypoint_job_failure():
+    log_dir = build_log_dir("test_bad_entrypoint_job")
+
+    scheduler.schedule_job("test_bad_entrypoint_job", {}, "channel", TS, 0)
+    job = scheduler.reserve_job()
+
+    do_job(slack_web_client(), job)
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": "failed"},
+            # failed message url reposted to tech support channel
+            {
+                "channel": settings.SLACK_TECH_SUPPORT_CHANNEL,
+                "text": "http://example.com",
+            },
+        ],
+    )
+    assert scheduler.get_job_runs("test_bad_entrypoint_job")[0]["rc"] == 1
+
+    with open(os.path.join(log_dir, "stdout")) as f:
+        assert f.read() == ""
+
+    with open(os.path.join(log_dir, "stderr")) as f:
+        stderr = f.read()
+        assert "Traceback (most recent call last):" in stderr
+        assert "An error was found!" in stderr
+
+
+def test_entrypoint_job_with_exit_message():
+    log_dir = build_log_dir("test_entrypoint_job_with_exit_message")
+
+    scheduler.schedule_job(
+        "test_entrypoint_job_with_exit_message", {}, "channel", TS, 0
+    )
+    job = scheduler.reserve_job()
+
+    do_job(slack_web_client(), job)
+    runs = scheduler.get_job_runs("test_entrypoint_job_with_exit_message")
+    assert runs[0]["rc"] == 1
+
+    with open(os.path.join(log_dir, "stderr")) as f:
+        assert f.read() == "Something went wrong\n"
+
+
+def test_entrypoint_job_with_bad_args():
+    log_dir = build_log_dir("test_entrypoint_job_with_bad_args")
+
+    scheduler.schedule_job("test_entrypoint_job_with_bad_args", {}, "channel", TS, 0)
+    job = scheduler.reserve_job()
+
+    do_job(slack_web_client(), job)
+    runs = scheduler.get_job_runs("test_entrypoint_job_with_bad_args")
+    assert runs[0]["rc"] == 2
+
+    with open(os.path.join(log_dir, "stderr")) as f:
+        assert "invalid choice: 'unknown_command'" in f.read()
+
+
+def test_configured_entrypoint_job(tmp_path):
+    # Run a job from the bot's own config, whose entrypoint parses run_args as its
+    # command line
+    log_dir = build_log_dir("techsupport_out_of_office_on")
+    config_path = tmp_path / "techsupport_ooo.json"
+
+    scheduler.schedule_job(
+        "techsupport_out_of_office_on",
+        {"start_date": "2019-12-20", "end_date": "2019-12-31"},
+        "channel",
+        TS,
+        0,
+    )
+    job = scheduler.reserve_job()
+
+    with patch("workspace.techsupport.jobs.config_file", return_value=config_path):
+        JobDispatcher(slack_web_client(), job, job_configs.config).do_job()
+    outbox.send_messages(slack_web_client())
+
+    assert json.loads(config_path.read_text()) == {
+        "start": "2019-12-20",
+        "end": "2019-12-31",
+    }
+    output = "Tech support out of office scheduled from 2019-12-20 until 2019-12-31\n"
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "about to start"},
+            {"channel": "channel", "text": output},
+        ],
+    )
+    assert scheduler.get_job_runs("techsupport_out_of_office_on")[0]["rc"] == 0
+
+    with open(os.path.join(log_dir, "stdout")) as f:
+        assert f.read() == output
+
+    with open(os.path.join(log_dir, "stderr")) as f:
+        assert f.read() == ""
+
+
+def test_configured_entrypoint_job_failure():
+    log_dir = build_log_dir("techsupport_out_of_office_on")
+
+    scheduler.schedule_job(
+        "techsupport_out_of_office_on",
+        {"start_date": "tomorrow", "end_date": "2019-12-31"},
+        "channel",
+        TS,
+        0,
+    )
+    job = scheduler.reserve_job()
+
+    JobDispatcher(slack_web_client(), job, job_configs.config).do_job()
+
+    assert scheduler.get_job_runs("techsupport_out_of_office_on")[0]["rc"] == 1
+
+    with open(os.path.join(log_dir, "stdout")) as f:
+        assert f.read() == ""
+
+    with open(os.path.join(log_dir, "stderr")) as f:
+        assert "Invalid isoformat string: 'tomorrow'" in f.read()
+
+
+@patch("bennettbot.dispatcher.logger")
+def test_preload_entrypoints(logger):
+    bad_config = {
+        "jobs": {
+            **config["jobs"],
+            "test_missing_entrypoint_job": {
+                **config["jobs"]["test_good_entrypoint_job"],
+                "entrypoint": "tests.workspace.test.missing:main",
+            },
+        }
+    }
+
+    preload_entrypoints(bad_config)
+
+    logger.error.assert_called_once()
+    assert logger.error.call_args.kwargs["job_type"] == "test_missing_entrypoint_job"
+
+
 def test_job_success_config_with_no_python_file():
     log_dir = build_log_dir("test1_good_job")
 
@@ -516,6 +822,7 @@ def test_job_with_long_code_output_is_uploaded_as_file():
 def do_job(client, job):
     job_dispatcher = JobDispatcher(client, job, config)
     job_dispatcher.do_job()
+    outbox.send_messages(client)
 
 
 def build_log_dir(job_type_with_namespace):
@@ -553,14 +860,61 @@ def test_message_checker_run(freezer):
 
     # Mock the run function so the checker runs twice, not forever
     run_fn = Mock(side_effect=[True, True, False])
-    checker.do_check(run_fn, delay=0.1)
+    with patch("bennettbot.dispatcher.time.sleep") as sleep:
+        checker.do_check(run_fn)
 
     # search.messages is called twice for each run of the checker
     # no matches, so no reactions or messages reposted.
     assert len(httpretty.latest_requests()) == 4
     requests_by_path = get_mock_received_requests()
     last_search_query = requests_by_path["/api/search.messages"][-1]["query"][0]
-    assert "after:2024-10-06" in last_search_query
+    # the first search was from two days ago, and the second was only from the day
+    # of the first search
+    first_search_query = requests_by_path["/api/search.messages"][0]["query"][0]
+    assert "after:2024-10-06" in first_search_query
+    assert "after:2024-10-07" in last_search_query
+    # nothing was found, so the checker waits longer each time
+    assert [c.args for c in sleep.call_args_list] == [(10,), (20,)]
+
+
+def test_message_checker_run_after_finding_messages(freezer):
+    freezer.move_to("2024-10-08 23:30")
+    httpretty_register(
+        {
+            "search.messages": [
+                {
+                    "ok": True,
+                    "messages": {
+                        "matches": [
+                            {
+                                "text": "Calling tech-support",
+                                "channel": {"id": "C4444"},
+                                "ts": str(time.time()),
+                            }
+                        ]
+                    },
+                },
+                {"ok": True, "messages": {"matches": []}},
+            ],
+            "reactions.add": [{"ok": True}],
+        }
+    )
+
+    checker = MessageChecker(slack_web_client("bot"), slack_web_client("user"))
+
+    run_fn = Mock(side_effect=[True, True, True, True, True, False])
+    with patch("bennettbot.dispatcher.time.sleep") as sleep:
+        checker.do_check(run_fn)
+
+    # the checker checks again soon after finding a message, then backs off until
+    # it reaches the maximum interval
+    assert [c.args for c in sleep.call_args_list] == [
+        (10,),
+        (20,),
+        (40,),
+        (60,),
+        (60,),
+    ]
 
 
 @pytest.mark.parametrize(
@@ -658,3 +1012,148 @@ def test_message_checker_matched_messages(keyword, support_channel, reaction):
             "timestamp": ["100.3"],
         },
     ]
+
+
+def _search_response(*messages):
+    return {
+        "ok": True,
+        "messages": {
+            "matches": [
+                {"text": "Calling tech-support", "channel": {"id": "C4444"}, **m}
+                for m in messages
+            ]
+        },
+    }
+
+
+def test_message_checker_skips_handled_messages():
+    httpretty_register(
+        {
+            "search.messages": [_search_response({"ts": str(time.time())})],
+            "reactions.add": [{"ok": True}],
+        }
+    )
+    checker = MessageChecker(slack_web_client("bot"), slack_web_client("user"))
+
+    assert checker.check_messages("tech-support", "2019-12-08") == 1
+    # The search index doesn't show our reaction yet, so the message is found
+    # again, but not handled again
+    assert checker.check_messages("tech-support", "2019-12-08") == 0
+
+    assert_call_counts(
+        {
+            "/api/search.messages": 2,
+            "/api/reactions.add": 1,
+            "/api/chat.getPermalink": 1,
+            "/api/chat.postMessage": 1,
+        }
+    )
+
+
+def test_message_checker_forgets_old_messages(freezer):
+    freezer.move_to("2024-10-08 12:00")
+    message = {"channel": {"id": "C4444"}, "ts": str(time.time())}
+    httpretty_register(
+        {
+            "search.messages": [_search_response(message)],
+            "reactions.add": [{"ok": True}],
+        }
+    )
+    checker = MessageChecker(slack_web_client("bot"), slack_web_client("user"))
+
+    checker.check_messages("tech-support", "2024-10-06")
+    assert checker._is_checked("tech-support", message)
+
+    # Messages from more than a day before the day that's searched from are
+    # forgotten
+    httpretty_register({"search.messages": [_search_response()]})
+    checker.check_messages("tech-support", "2024-10-08")
+    assert checker._is_checked("tech-support", message)
+    checker.check_messages("tech-support", "2024-10-09")
+    assert checker._is_checked("tech-support", message)
+    checker.check_messages("tech-support", "2024-10-10")
+    assert not checker._is_checked("tech-support", message)
+
+
+def test_message_checker_get_check_from(freezer):
+    freezer.move_to("2024-10-08 12:00")
+    httpretty_register({"search.messages": [_search_response()]})
+    checker = MessageChecker(slack_web_client("bot"), slack_web_client("user"))
+
+    # There hasn't been a successful check, so we search the last two days
+    assert checker.get_check_from("tech-support") == "2024-10-06"
+    checker.check_messages("tech-support", "2024-10-06")
+
+    # While the dispatcher is running, we only search today's messages
+    freezer.move_to("2024-10-08 12:01")
+    assert checker.get_check_from("tech-support") == "2024-10-07"
+
+    # The dispatcher wasn't running for a few days, so we search from the last
+    # successful check
+    freezer.move_to("2024-10-12 12:00")
+    assert checker.get_check_from("tech-support") == "2024-10-07"
+    assert checker.get_check_from("bennett-admins") == "2024-10-10"
+
+
+def test_message_checker_get_check_from_after_midnight(freezer):
+    freezer.move_to("2024-10-08 23:59")
+    httpretty_register({"search.messages": [_search_response()]})
+    checker = MessageChecker(slack_web_client("bot"), slack_web_client("user"))
+    checker.check_messages("tech-support", "2024-10-06")
+
+    # Messages sent just before midnight may not have been in the search index
+    # when we last checked, so we still search yesterday's messages
+    freezer.move_to("2024-10-09 00:00")
+    assert checker.get_check_from("tech-support") == "2024-10-07"
+
+
+def test_message_checker_uses_permalink_from_search():
+    httpretty_register(
+        {
+            "search.messages": [
+                _search_response({"ts": TS, "permalink": "http://example.com/1"})
+            ],
+            "reactions.add": [{"ok": True}],
+        }
+    )
+    checker = MessageChecker(slack_web_client("bot"), slack_web_client("user"))
+
+    checker.check_messages("tech-support", "2019-12-08")
+
+    assert "/api/chat.getPermalink" not in get_mock_received_requests()
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {
+                "channel": settings.SLACK_TECH_SUPPORT_CHANNEL,
+                "text": "http://example.com/1",
+            }
+        ]
+    )
+
+
+def test_message_checker_already_reacted():
+    httpretty_register(
+        {
+            "search.messages": [_search_response({"ts": TS})],
+            "reactions.add": [{"ok": False, "error": "already_reacted"}],
+        }
+    )
+    checker = MessageChecker(slack_web_client("bot"), slack_web_client("user"))
+
+    # The bot has handled the message since it was indexed, so we don't repost it
+    assert checker.check_messages("tech-support", "2019-12-08") == 0
+    assert checker._is_checked("tech-support", {"channel": {"id": "C4444"}, "ts": TS})
+    assert "/api/chat.postMessage" not in get_mock_received_requests()
+
+
+def test_message_checker_reaction_error():
+    httpretty_register(
+        {
+            "search.messages": [_search_response({"ts": TS})],
+            "reactions.add": [{"ok": False, "error": "channel_not_found"}],
+        }
+    )
+    checker = MessageChecker(slack_web_client("bot"), slack_web_client("user"))
+
+    with pytest.raises(SlackApiError):
+        checker.check_messages("tech-support", "2019-12-08")
@@ -3,7 +3,7 @@ import re
 import pytest
 
 from bennettbot import settings
-from bennettbot.job_configs import build_config
+from bennettbot.job_configs import build_config, find_slack_config
 
 
 def test_build_config():
@@ -12,8 +12,9 @@ def test_build_config():
             "description": "ns1 jobs",
             "restricted": True,
             "default_channel": "#some-channel",
+            "max_concurrent_jobs": 2,
             "jobs": {
-                "good_job": {"run_args_template": "cat [poem]"},
+                "good_job": {"run_args_template": "cat [poem]", "priority": 5},
                 "bad_job": {"run_args_template": "dog [poem]"},
             },
             "slack": [
@@ -80,42 +81,63 @@ def test_build_config():
                 "report_stdout": False,
                 "report_format": "text",
                 "report_success": True,
+                "priority": 5,
+                "entrypoint": None,
+                "report_progress": False,
             },
             "ns1_bad_job": {
                 "run_args_template": "dog [poem]",
                 "report_stdout": False,
                 "report_format": "text",
                 "report_success": True,
+                "priority": 0,
+                "entrypoint": None,
+                "report_progress": False,
             },
             "ns2_good_job": {
                 "run_args_template": "cat [poem]",
                 "report_stdout": True,
                 "report_format": "text",
                 "report_success": True,
+                "priority": 0,
+                "entrypoint": None,
+                "report_progress": False,
             },
             "ns2_bad_job": {
                 "run_args_template": "dog [poem]",
                 "report_stdout": False,
                 "report_format": "text",
                 "report_success": False,
+                "priority": 0,
+                "entrypoint": None,
+                "report_progress": False,
             },
             "ns3_good_python_job": {
                 "run_args_template": "python jobs.py",
                 "report_stdout": True,
                 "report_format": "text",
                 "report_success": True,
+                "priority": 0,
+                "entrypoint": None,
+                "report_progress": False,
             },
             "ns3_bad_python_job": {
                 "run_args_template": "python jobs.py",
                 "report_stdout": True,
                 "report_format": "text",
                 "report_success": True,
+                "priority": 0,
+                "entrypoint": None,
+                "report_progress": False,
             },
             "test_good_job": {
                 "run_args_template": "echo Hello",
                 "report_stdout": False,
                 "report_format": "text",
                 "report_success": True,
+                "priority": 0,
+                "entrypoint": None,
+                "report_progress": False,
             },
         },
         "slack": [
@@ -178,6 +200,49 @@ def test_build_config():
             "ns3": "#tech",
             "test": "#tech",
         },
+        "max_concurrent_jobs": {"ns1": 2},
+        "command_trie": {
+            "children": {
+                "ns1": {
+                    "children": {
+                        "read": {
+                            "children": {"poem": {"children": {}, "commands": [0]}},
+                            "commands": [],
+                        }
+                    },
+                    "commands": [],
+                },
+                "ns2": {
+                    "children": {
+                        "read": {
+                            "children": {"poem": {"children": {}, "commands": [1]}},
+                            "commands": [],
+                        }
+                    },
+                    "commands": [],
+                },
+                "ns3": {
+                    "children": {
+                        "hello": {
+                            "children": {"world": {"children": {}, "commands": [2]}},
+                            "commands": [],
+                        }
+                    },
+                    "commands": [],
+                },
+            },
+            "commands": [],
+        },
+        "help_commands": {
+            "ns1 help": "ns1",
+            "help ns1": "ns1",
+            "ns2 help": "ns2",
+            "help ns2": "ns2",
+            "ns3 help": "ns3",
+            "help ns3": "ns3",
+            "test help": "test",
+            "help test": "test",
+        },
     }
 
 
@@ -303,3 +368,126 @@ def test_build_config_with_invalid_report_format():
     with pytest.raises(RuntimeError) as e:
         build_config(raw_config)
     assert "invalid report_format" in str(e)
+
+
+def test_build_config_with_invalid_priority():
+    # fmt: off
+    raw_config = {
+        "ns": {
+            "jobs": {
+                "good_job": {
+                    "run_args_template": "cat [poem]",
+                    "priority": "high"
+                }
+            },
+            "slack": []
+        }
+    }
+    # fmt: on
+
+    with pytest.raises(RuntimeError) as e:
+        build_config(raw_config)
+    assert "invalid priority" in str(e)
+
+
+def test_build_config_with_invalid_entrypoint():
+    # fmt: off
+    raw_config = {
+        "ns": {
+            "jobs": {
+                "good_job": {
+                    "run_args_template": "hello",
+                    "entrypoint": "workspace/ns/jobs.py"
+                }
+            },
+            "slack": []
+        }
+    }
+    # fmt: on
+
+    with pytest.raises(RuntimeError) as e:
+        build_config(raw_config)
+    assert "invalid entrypoint" in str(e)
+
+
+def _build_raw_config(namespaces, commands):
+    return {
+        namespace: {
+            "jobs": {"job": {"run_args_template": "echo"}},
+            "slack": [
+                {
+                    "command": command,
+                    "help": "",
+                    "action": "schedule_job",
+                    "job_type": "job",
+                }
+                for command in commands
+            ],
+        }
+        for namespace in namespaces
+    }
+
+
+@pytest.mark.parametrize(
+    "text,expected_command",
+    [
+        # "ns say [greeting]" sorts before "ns say hi", so takes precedence
+        ("ns say hi", "ns say [greeting]"),
+        ("ns say hello there", "ns say [greeting]"),
+        ("ns say hi to [name]", "ns say [greeting]"),
+        ("ns wave", "ns wave"),
+        ("ns wave[n]", "ns wave[n]"),
+        ("ns wave.x", "ns wave.x"),
+        # the parameter isn't preceded by a space, so it captures " 2"
+        ("ns wave 2", "ns wave[n]"),
+        ("ns", None),
+        ("other say hi", None),
+        ("", None),
+    ],
+)
+def test_find_slack_config(text, expected_command):
+    config = build_config(
+        _build_raw_config(
+            ["ns"], ["say hi", "say [greeting]", "wave", "wave[n]", "wave.x"]
+        )
+    )
+
+    slack_config = find_slack_config(config, text)
+
+    if expected_command is None:
+        assert slack_config is None
+    else:
+        assert slack_config["command"] == expected_command
+    # We find the same command as trying every command in order would
+    assert slack_config == next(
+        (c for c in config["slack"] if c["regex"].match(text)), None
+    )
+
+
+class CountingRegex:
+    def __init__(self, regex, counter):
+        self.regex = regex
+        self.counter = counter
+
+    def match(self, text):
+        self.counter.append(self.regex.pattern)
+        return self.regex.match(text)
+
+
+@pytest.mark.parametrize("num_namespaces,num_commands", [(1, 1), (100, 100)])
+def test_find_slack_config_cost_doesnt_grow_with_number_of_commands(
+    num_namespaces, num_commands
+):
+    # A microbenchmark: the number of regexes tried to find a command stays the
+    # same as commands are added, whether in the same namespace or in others
+    namespaces = [f"ns{i}" for i in range(num_namespaces)]
+    commands = ["do job [n]"] + [f"do job{i} [n]" for i in range(num_commands - 1)]
+    config = build_config(_build_raw_config(namespaces, commands))
+    tried = []
+    for slack_config in config["slack"]:
+        slack_config["regex"] = CountingRegex(slack_config["regex"], tried)
+
+    slack_config = find_slack_config(config, "ns0 do job 10")
+
+    assert slack_config["command"] == "ns0 do job [n]"
+    assert tried == ["^ns0 do job (.+?)$"]
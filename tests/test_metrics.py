@@ -0,0 +1,203 @@
+import math
+import multiprocessing
+import sqlite3
+from threading import Thread
+from unittest.mock import patch
+
+import pytest
+
+from bennettbot import connection, metrics, scheduler
+
+from .time_helpers import T0, TS, T
+
+
+# Make sure all tests run when datetime.now() returning T0
+pytestmark = pytest.mark.freeze_time(T0)
+
+
+def get_samples(name):
+    """Return dict mapping sample names (with labels) to values for lines in
+    rendered metrics that start with name."""
+
+    return {
+        line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+        for line in metrics.render().splitlines()
+        if line.startswith(name)
+    }
+
+
+def test_inc():
+    metrics.inc("bennettbot_slack_api_retries_total", method="chat.postMessage")
+    metrics.inc("bennettbot_slack_api_retries_total", 2, method="chat.postMessage")
+    metrics.inc("bennettbot_slack_api_retries_total", method="files.upload")
+
+    assert get_samples("bennettbot_slack_api_retries_total") == {
+        'bennettbot_slack_api_retries_total{method="chat.postMessage"}': 3,
+        'bennettbot_slack_api_retries_total{method="files.upload"}': 1,
+    }
+
+
+def test_observe():
+    metrics.observe("bennettbot_job_duration_seconds", 10, job_type="good_job")
+    metrics.observe("bennettbot_job_duration_seconds", 100, job_type="good_job")
+    metrics.observe("bennettbot_job_duration_seconds", 30000, job_type="good_job")
+
+    buckets = {1: 0, 5: 0, 15: 1, 60: 1, 300: 2, 900: 2, 1800: 2, 3600: 2}
+    buckets.update({7200: 2, 21600: 2, "+Inf": 3})
+    expected = {
+        f'bennettbot_job_duration_seconds_bucket{{job_type="good_job",le="{le}"}}': n
+        for le, n in buckets.items()
+    }
+    expected['bennettbot_job_duration_seconds_count{job_type="good_job"}'] = 3
+    expected['bennettbot_job_duration_seconds_sum{job_type="good_job"}'] = 30110
+    samples = get_samples("bennettbot_job_duration_seconds")
+    assert samples == expected
+    # Buckets must be rendered in order
+    assert list(samples)[:11] == list(expected)[:11]
+
+
+def test_observe_without_labels():
+    metrics.observe("bennettbot_webhook_duration_seconds", 0.2)
+
+    samples = get_samples("bennettbot_webhook_duration_seconds")
+    assert samples['bennettbot_webhook_duration_seconds_bucket{le="0.25"}'] == 1
+    assert samples["bennettbot_webhook_duration_seconds_sum"] == 0.2
+    assert samples["bennettbot_webhook_duration_seconds_count"] == 1
+
+
+def test_observe_counter():
+    with pytest.raises(AssertionError):
+        metrics.observe("bennettbot_slack_api_retries_total", 1)
+
+
+def test_label_values_escaped():
+    metrics.inc("bennettbot_slack_api_failures_total", method='a "b"\\c\n')
+
+    assert get_samples("bennettbot_slack_api_failures_total") == {
+        'bennettbot_slack_api_failures_total{method="a \\"b\\"\\\\c\\n"}': 1
+    }
+
+
+def test_render_queue_gauges():
+    scheduler.schedule_job("good_job", {}, "channel", TS, 0)
+    scheduler.schedule_job("odd_job", {}, "channel", TS, 0)
+    scheduler.reserve_job()
+    scheduler.schedule_job("good_job", {}, "channel", TS, 0)
+    scheduler.schedule_suppression("good_job", T(-5), T(5))
+    scheduler.schedule_suppression("odd_job", T(5), T(10))
+
+    rendered = metrics.render()
+
+    assert "# TYPE bennettbot_queued_jobs gauge" in rendered
+    assert get_samples("bennettbot_queued_jobs") == {
+        'bennettbot_queued_jobs{job_type="good_job"}': 1,
+        'bennettbot_queued_jobs{job_type="odd_job"}': 1,
+    }
+    assert get_samples("bennettbot_running_jobs") == {
+        'bennettbot_running_jobs{job_type="good_job"}': 1,
+    }
+    assert get_samples("bennettbot_active_suppressions") == {
+        'bennettbot_active_suppressions{job_type="good_job"}': 1,
+    }
+
+
+def test_render_with_no_metrics():
+    rendered = metrics.render()
+
+    for name, (type_, help_text, _) in metrics.METRICS.items():
+        assert f"# HELP {name} {help_text}\n# TYPE {name} {type_}\n" in rendered
+    assert rendered.endswith("\n")
+
+
+def get_recorded_value(name):
+    """Return the total value of samples with the given name in the metric table,
+    without flushing buffered samples."""
+
+    conn = connection.get_connection()
+    row = conn.execute(
+        "SELECT SUM(value) AS value FROM metric WHERE name = ?", [name]
+    ).fetchone()
+    return row["value"] or 0
+
+
+def test_samples_flushed_periodically(freezer):
+    metrics.flush()  # Start a new interval
+    metrics.inc("bennettbot_slack_api_retries_total", method="chat.postMessage")
+    freezer.tick(metrics.FLUSH_INTERVAL - 1)
+    metrics.inc("bennettbot_slack_api_retries_total", method="chat.postMessage")
+    assert get_recorded_value("bennettbot_slack_api_retries_total") == 0
+
+    freezer.tick(1)
+    metrics.inc("bennettbot_slack_api_retries_total", method="files.upload")
+    assert get_recorded_value("bennettbot_slack_api_retries_total") == 3
+    assert get_samples("bennettbot_slack_api_retries_total") == {
+        'bennettbot_slack_api_retries_total{method="chat.postMessage"}': 2,
+        'bennettbot_slack_api_retries_total{method="files.upload"}': 1,
+    }
+
+
+def test_buffered_samples_not_flushed_by_forked_process():
+    metrics.inc("bennettbot_slack_api_retries_total", method="chat.postMessage")
+
+    process = multiprocessing.get_context("fork").Process(target=metrics.flush)
+    process.start()
+    process.join()
+
+    assert get_recorded_value("bennettbot_slack_api_retries_total") == 0
+    metrics.flush()
+    assert get_recorded_value("bennettbot_slack_api_retries_total") == 1
+
+
+def test_flush_error_is_logged():
+    metrics.inc("bennettbot_slack_api_retries_total", method="chat.postMessage")
+    metrics.observe("bennettbot_webhook_duration_seconds", 0.2)
+
+    with patch(
+        "bennettbot.metrics.get_connection",
+        side_effect=sqlite3.OperationalError("database is locked"),
+    ):
+        with patch("bennettbot.metrics.logger") as logger:
+            metrics.flush()
+
+    logger.error.assert_called_once()
+    # The samples are kept, and recorded by the next flush
+    assert get_recorded_value("bennettbot_slack_api_retries_total") == 0
+    samples = get_samples("bennettbot_")
+    assert samples['bennettbot_slack_api_retries_total{method="chat.postMessage"}'] == 1
+    assert samples["bennettbot_webhook_duration_seconds_count"] == 1
+
+
+def test_record_error_in_transaction_is_raised():
+    conn = connection.get_connection()
+    conn.execute("DROP TABLE metric")
+
+    with pytest.raises(sqlite3.OperationalError):
+        metrics.inc("bennettbot_slack_api_retries_total", conn=conn)
+
+
+def test_concurrent_updates():
+    # Each thread has its own connection, just as each process does in production
+    def record():
+        for _ in range(50):
+            metrics.inc("bennettbot_slack_api_retries_total", method="chat.postMessage")
+            metrics.observe("bennettbot_webhook_duration_seconds", 0.01)
+
+    threads = [Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    samples = get_samples("bennettbot_")
+    assert (
+        samples['bennettbot_slack_api_retries_total{method="chat.postMessage"}'] == 400
+    )
+    assert samples["bennettbot_webhook_duration_seconds_count"] == 400
+    assert samples["bennettbot_webhook_duration_seconds_sum"] == pytest.approx(4)
+
+
+@pytest.mark.parametrize(
+    "value,expected", [(1, "1"), (1.0, "1"), (0.25, "0.25"), (math.inf, "+Inf")]
+)
+def test_format_value(value, expected):
+    assert metrics._format_value(value) == expected
@@ -1,10 +1,12 @@
+import json
+import sqlite3
 from unittest.mock import patch
 
 import httpretty
 import pytest
 
-from bennettbot import settings
-from bennettbot.slack import notify_slack, slack_web_client
+from bennettbot import metrics, settings
+from bennettbot.slack import RateLimiter, notify_slack, slack_web_client
 from workspace.utils.blocks import get_text_block
 
 from .mock_http_request import get_mock_received_requests, httpretty_register
@@ -26,6 +28,22 @@ def test_notify_slack_success():
     }
 
 
+@httpretty.activate(allow_net_connect=False)
+@patch("bennettbot.metrics.get_connection")
+def test_notify_slack_metric_error(get_connection):
+    # The message is sent, so it mustn't be sent again if its metrics can't be
+    # recorded
+    get_connection.side_effect = sqlite3.OperationalError("database is locked")
+    httpretty_register(
+        {"chat.postMessage": [{"ok": True, "ts": 123.45, "channel": "test-channel"}]}
+    )
+
+    resp = notify_slack(slack_web_client(), "test-channel", "my message")
+
+    assert resp["ts"] == 123.45
+    assert len(get_mock_received_requests()["/api/chat.postMessage"]) == 1
+
+
 @httpretty.activate(allow_net_connect=False)
 def test_notify_slack_success_blocks():
     httpretty_register(
@@ -72,6 +90,20 @@ def test_notify_slack_retries():
             "text": "my message",
         }
 
+    rendered = metrics.render()
+    assert (
+        'bennettbot_slack_api_duration_seconds_count{method="chat.postMessage",outcome="error"} 1\n'
+        in rendered
+    )
+    assert (
+        'bennettbot_slack_api_duration_seconds_count{method="chat.postMessage",outcome="ok"} 1\n'
+        in rendered
+    )
+    assert (
+        'bennettbot_slack_api_retries_total{method="chat.postMessage"} 1\n' in rendered
+    )
+    assert "bennettbot_slack_api_failures_total{" not in rendered
+
 
 @httpretty.activate(allow_net_connect=False)
 @patch("bennettbot.dispatcher.settings.MAX_SLACK_NOTIFY_RETRIES", 0)
@@ -126,6 +158,14 @@ def test_notify_slack_retries_fallback_error():
     # 3rd call with failure message also errors
     assert latest_requests[2]["text"] == "Could not notify slack"
 
+    rendered = metrics.render()
+    assert (
+        'bennettbot_slack_api_retries_total{method="chat.postMessage"} 1\n' in rendered
+    )
+    assert (
+        'bennettbot_slack_api_failures_total{method="chat.postMessage"} 1\n' in rendered
+    )
+
 
 @pytest.mark.parametrize(
     "token_type,token",
@@ -146,3 +186,116 @@ def test_slack_client(token_type, token):
 def test_slack_client_with_bad_token_type():
     with pytest.raises(AssertionError, match="Unknown token type"):
         slack_web_client("unk")
+
+
+def test_rate_limiter_allows_bursts():
+    rate_limiter = RateLimiter()
+    with patch("bennettbot.slack.monotonic", return_value=100), patch(
+        "bennettbot.slack.sleep"
+    ) as sleep:
+        waits = [rate_limiter.acquire("reactions.add") for _ in range(12)]
+
+    # Tier 3 methods may be called 10 times in a burst, and then 50 times a minute
+    assert waits == [0] * 10 + [1.2, 2.4]
+    assert [c.args[0] for c in sleep.call_args_list] == [1.2, 2.4]
+    assert (
+        'bennettbot_slack_api_throttled_total{method="reactions.add"} 2\n'
+        in metrics.render()
+    )
+
+
+def test_rate_limiter_refills():
+    rate_limiter = RateLimiter()
+    with patch("bennettbot.slack.monotonic", return_value=100), patch(
+        "bennettbot.slack.sleep"
+    ):
+        for _ in range(5):
+            rate_limiter.acquire("search.messages")
+    with patch("bennettbot.slack.monotonic", return_value=106), patch(
+        "bennettbot.slack.sleep"
+    ):
+        # Tier 2 methods may be called 20 times a minute, so after 6 seconds we can
+        # make another 2 calls
+        assert rate_limiter.acquire("search.messages") == 0
+        assert rate_limiter.acquire("search.messages") == 0
+        assert rate_limiter.acquire("search.messages") == 3
+
+
+def test_rate_limiter_for_each_channel():
+    rate_limiter = RateLimiter()
+    with patch("bennettbot.slack.monotonic", return_value=100), patch(
+        "bennettbot.slack.sleep"
+    ):
+        for _ in range(5):
+            rate_limiter.acquire("chat.postMessage", channel="channel")
+        assert rate_limiter.acquire("chat.postMessage", channel="channel") == 1
+        assert rate_limiter.acquire("chat.postMessage", channel="channel1") == 0
+
+
+def test_rate_limiter_pause():
+    rate_limiter = RateLimiter()
+    with patch("bennettbot.slack.monotonic", return_value=100), patch(
+        "bennettbot.slack.sleep"
+    ) as sleep:
+        rate_limiter.pause("users.info", 10)
+        rate_limiter.pause("users.info", 5)
+        assert rate_limiter.acquire("users.info") == 10
+        assert rate_limiter.acquire("users.list") == 0
+
+    sleep.assert_called_once_with(10)
+
+
+@httpretty.activate(allow_net_connect=False)
+@pytest.mark.parametrize("headers,min_sleep", [({"Retry-After": "5"}, 5), ({}, 1)])
+def test_slack_client_retries_when_rate_limited(headers, min_sleep):
+    httpretty.register_uri(
+        httpretty.POST,
+        "https://slack.com/api/reactions.add",
+        responses=[
+            httpretty.Response(
+                body=json.dumps({"ok": False, "error": "ratelimited"}),
+                status=429,
+                adding_headers=headers,
+            ),
+            httpretty.Response(body=json.dumps({"ok": True})),
+        ],
+    )
+    client = slack_web_client()
+
+    with patch("bennettbot.slack.sleep") as sleep:
+        client.reactions_add(channel="channel", timestamp="123.45", name="x")
+
+    assert len(httpretty.latest_requests()) == 2
+    sleep.assert_called_once()
+    assert min_sleep <= sleep.call_args.args[0] < min_sleep + 1
+    # Further calls to the method wait too
+    assert client.rate_limiter.paused_until["reactions.add"] > 0
+    assert (
+        'bennettbot_slack_api_rate_limited_total{method="reactions.add"} 1\n'
+        in metrics.render()
+    )
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_slack_client_rate_limits_each_page():
+    httpretty_register(
+        {
+            "conversations.list": [
+                {
+                    "ok": True,
+                    "channels": [{"id": f"C{i}", "name": f"channel{i}"}],
+                    "response_metadata": {"next_cursor": "" if i == 2 else f"c{i}"},
+                }
+                for i in range(3)
+            ]
+        }
+    )
+    client = slack_web_client()
+
+    with patch.object(
+        client.rate_limiter, "acquire", wraps=client.rate_limiter.acquire
+    ) as acquire:
+        ids = [page["channels"][0]["id"] for page in client.conversations_list(limit=1)]
+
+    assert ids == ["C0", "C1", "C2"]
+    assert [c.args[0] for c in acquire.call_args_list] == ["conversations.list"] * 3
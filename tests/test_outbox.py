@@ -0,0 +1,258 @@
+import sqlite3
+from unittest.mock import patch
+from urllib.error import URLError
+
+import httpretty
+import pytest
+
+from bennettbot import metrics, outbox, settings
+from bennettbot.slack import slack_web_client
+
+from .assertions import assert_slack_client_sends_messages
+from .mock_http_request import (
+    get_mock_received_requests,
+    httpretty_register,
+    register_dispatcher_uris,
+)
+from .time_helpers import T0, TS
+
+
+pytestmark = pytest.mark.freeze_time(T0)
+
+
+@pytest.fixture(autouse=True)
+def mock_http():
+    httpretty.enable(allow_net_connect=False)
+    register_dispatcher_uris()
+    yield
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_send_messages():
+    outbox.enqueue_message("channel", "first message", thread_ts=TS)
+    outbox.enqueue_message("logs", "second message")
+    outbox.enqueue_message(
+        "channel", [{"type": "divider"}], thread_ts=TS, message_format="blocks"
+    )
+
+    assert outbox.send_messages(slack_web_client()) == 3
+
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "channel", "text": "first message", "thread_ts": TS},
+            {"channel": "logs", "text": "second message"},
+            {"channel": "channel", "blocks": [{"type": "divider"}], "thread_ts": TS},
+        ],
+        message_format="blocks",
+    )
+    assert outbox.get_messages() == []
+
+
+def test_send_messages_combines_text_messages():
+    outbox.enqueue_message("logs", "first message")
+    outbox.enqueue_message("logs", "second message", message_format="text")
+    outbox.enqueue_message("logs", "third message", message_format="code")
+    outbox.enqueue_message("logs", "fourth message")
+
+    assert outbox.send_messages(slack_web_client()) == 4
+
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "first message\nsecond message"},
+            {"channel": "logs", "text": "```third message```"},
+            {"channel": "logs", "text": "fourth message"},
+        ],
+    )
+
+
+@patch("bennettbot.outbox.MAX_COMBINED_LENGTH", 20)
+def test_send_messages_combines_text_messages_up_to_max_length():
+    outbox.enqueue_message("logs", "first message")
+    outbox.enqueue_message("logs", "second message")
+
+    outbox.send_messages(slack_web_client())
+
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "logs", "text": "first message"},
+            {"channel": "logs", "text": "second message"},
+        ],
+    )
+
+
+def test_send_messages_with_repost():
+    outbox.enqueue_message(
+        "channel", "failure message", thread_ts=TS, repost_to="techsupport"
+    )
+
+    assert outbox.send_messages(slack_web_client()) == 2
+
+    assert_slack_client_sends_messages(
+        messages_kwargs=[
+            {"channel": "channel", "text": "failure message"},
+            {"channel": "techsupport", "text": "http://example.com"},
+        ],
+    )
+    assert get_mock_received_requests()["/api/chat.getPermalink"] == [
+        {"channel": ["channel"], "message_ts": [TS]}
+    ]
+
+
+def test_send_messages_with_repost_error():
+    httpretty_register({"chat.getPermalink": [{"ok": False, "error": "error"}]})
+    outbox.enqueue_message(
+        "channel", "failure message", thread_ts=TS, repost_to="techsupport"
+    )
+
+    assert outbox.send_messages(slack_web_client()) == 1
+
+    assert_slack_client_sends_messages(
+        messages_kwargs=[{"channel": "channel", "text": "failure message"}],
+    )
+    assert outbox.get_messages() == []
+
+
+def test_send_messages_retries_failed_messages(freezer):
+    httpretty_register(
+        {
+            "chat.postMessage": [
+                {"ok": False, "error": "internal_error"},
+                {"ok": True, "ts": TS, "channel": "logs"},
+            ]
+        }
+    )
+    outbox.enqueue_message("channel", "first message")
+    outbox.enqueue_message("logs", "second message")
+    outbox.enqueue_message("channel", [{"type": "divider"}], message_format="blocks")
+
+    # The first message fails, so the third (to the same channel) waits for it
+    assert outbox.send_messages(slack_web_client()) == 1
+    messages = outbox.get_messages()
+    assert [m["message"] for m in messages] == ["first message", [{"type": "divider"}]]
+    assert messages[0]["attempts"] == 1
+    assert (
+        'bennettbot_slack_api_retries_total{method="chat.postMessage"} 1\n'
+        in metrics.render()
+    )
+
+    # The first message isn't retried until 2 seconds have passed
+    freezer.tick(1)
+    assert outbox.send_messages(slack_web_client()) == 0
+    freezer.tick(1)
+    assert outbox.send_messages(slack_web_client()) == 2
+    assert outbox.get_messages() == []
+
+
+@patch("bennettbot.outbox.settings.SLACK_OUTBOX_MAX_ATTEMPTS", 1)
+def test_send_messages_gives_up_on_failed_messages():
+    httpretty_register(
+        {"chat.postMessage": [{"ok": False, "error": "internal_error"}] * 2}
+    )
+    outbox.enqueue_message("channel", "my message")
+
+    assert outbox.send_messages(slack_web_client()) == 0
+
+    requests = get_mock_received_requests()["/api/chat.postMessage"]
+    assert [r["text"] for r in requests] == ["my message", "Could not notify slack"]
+    assert outbox.get_messages() == []
+    assert (
+        'bennettbot_slack_api_failures_total{method="chat.postMessage"} 1\n'
+        in metrics.render()
+    )
+
+
+def test_send_messages_gives_up_on_permanent_errors():
+    httpretty_register(
+        {
+            "chat.postMessage": [
+                {"ok": False, "error": "channel_not_found"},
+                {"ok": True, "ts": TS, "channel": "channel"},
+            ]
+        }
+    )
+    outbox.enqueue_message("channel", "first message", message_format="code")
+    outbox.enqueue_message("channel", "second message")
+
+    # The first message will never be sent, so it's reported straight away, and
+    # doesn't hold up the second
+    assert outbox.send_messages(slack_web_client()) == 1
+
+    requests = get_mock_received_requests()["/api/chat.postMessage"]
+    assert [r["text"] for r in requests] == [
+        "```first message```",
+        "Could not notify slack",
+        "second message",
+    ]
+    assert outbox.get_messages() == []
+    assert (
+        'bennettbot_slack_api_failures_total{method="chat.postMessage"} 1\n'
+        in metrics.render()
+    )
+
+
+def test_send_messages_retries_server_errors():
+    httpretty.register_uri(
+        httpretty.POST,
+        "https://slack.com/api/chat.postMessage",
+        status=503,
+        body='{"ok": false}',
+    )
+    outbox.enqueue_message("channel", "my message")
+
+    assert outbox.send_messages(slack_web_client()) == 0
+
+    assert outbox.get_messages()[0]["attempts"] == 1
+
+
+@patch("bennettbot.outbox.send_message", side_effect=URLError("timed out"))
+def test_send_messages_retries_network_errors(send_message):
+    outbox.enqueue_message("channel", "my message")
+
+    assert outbox.send_messages(slack_web_client()) == 0
+
+    assert outbox.get_messages()[0]["attempts"] == 1
+
+
+@patch("bennettbot.outbox.sleep")
+@patch("bennettbot.outbox.send_messages")
+def test_run_once_logs_unexpected_errors(send_messages, sleep):
+    send_messages.side_effect = sqlite3.OperationalError("database is locked")
+
+    with patch("bennettbot.outbox.logger") as logger:
+        outbox.run_once(slack_web_client())
+
+    logger.exception.assert_called_once()
+    sleep.assert_called_once_with(outbox.ERROR_DELAY)
+
+
+@patch("bennettbot.outbox.wait_for_messages")
+def test_run_once(wait_for_messages):
+    outbox.enqueue_message("channel", "my message")
+
+    outbox.run_once(slack_web_client())
+
+    assert outbox.get_messages() == []
+    wait_for_messages.assert_called_once()
+
+
+@patch("bennettbot.outbox.connection.wait_for_change")
+def test_wait_for_messages_with_no_messages(wait_for_change):
+    outbox.wait_for_messages(1)
+
+    wait_for_change.assert_called_once_with(
+        "outbox", 1, settings.DISPATCHER_MAX_SLEEP, settings.DISPATCHER_POLL_INTERVAL
+    )
+
+
+@patch("bennettbot.outbox.connection.wait_for_change")
+def test_wait_for_messages_until_retry(wait_for_change):
+    httpretty_register({"chat.postMessage": [{"ok": False, "error": "internal_error"}]})
+    outbox.enqueue_message("channel", "my message")
+    outbox.send_messages(slack_web_client())
+
+    outbox.wait_for_messages(1)
+
+    wait_for_change.assert_called_once_with(
+        "outbox", 1, 2, settings.DISPATCHER_POLL_INTERVAL
+    )
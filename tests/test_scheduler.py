@@ -1,11 +1,16 @@
+from datetime import timedelta
+from threading import Barrier, Thread
+from unittest.mock import patch
+
 import pytest
 
-from bennettbot import scheduler
+from bennettbot import metrics, scheduler, settings
 
 from .assertions import (
     assert_job_matches,
     assert_no_running_job,
     assert_running_job,
+    assert_subdict,
     assert_suppression_matches,
 )
 from .time_helpers import T0, TS, T
@@ -195,8 +200,7 @@ def test_reserve_job_with_one_job_due_to_run(freezer):
     scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 5)
     freezer.move_to(T(10))
 
-    job_id = scheduler.reserve_job()
-    job = scheduler.get_job(job_id)
+    job = scheduler.reserve_job()
     assert_job_matches(job, "good_job", {"k": "v"}, "channel", T(5), T(10))
 
 
@@ -205,12 +209,10 @@ def test_reserve_job_with_two_jobs_due_to_run(freezer):
     scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 6)
     freezer.move_to(T(10))
 
-    job_id = scheduler.reserve_job()
-    job = scheduler.get_job(job_id)
+    job = scheduler.reserve_job()
     assert_job_matches(job, "good_job", {"k": "v"}, "channel", T(5), T(10))
 
-    job_id = scheduler.reserve_job()
-    job = scheduler.get_job(job_id)
+    job = scheduler.reserve_job()
     assert_job_matches(job, "odd_job", {"k": "v"}, "channel", T(6), T(10))
 
 
@@ -231,8 +233,7 @@ def test_reserve_job_with_another_job_running(freezer):
     scheduler.schedule_job("odd_job", {"k": "w"}, "channel1", TS, 5)
     freezer.move_to(T(20))
 
-    job_id = scheduler.reserve_job()
-    job = scheduler.get_job(job_id)
+    job = scheduler.reserve_job()
     assert_job_matches(job, "odd_job", {"k": "w"}, "channel1", T(15), T(20))
 
 
@@ -249,8 +250,7 @@ def test_reserve_job_with_suppression_in_progress_for_another_job_type(freezer):
     scheduler.schedule_suppression("odd_job", T(10), T(20))
     freezer.move_to(T(15))
 
-    job_id = scheduler.reserve_job()
-    job = scheduler.get_job(job_id)
+    job = scheduler.reserve_job()
     assert_job_matches(job, "good_job", {"k": "v"}, "channel", T(5), T(15))
 
 
@@ -259,16 +259,313 @@ def test_reserve_job_with_suppression_in_future(freezer):
     scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 5)
     freezer.move_to(T(10))
 
-    job_id = scheduler.reserve_job()
-    job = scheduler.get_job(job_id)
+    job = scheduler.reserve_job()
     assert_job_matches(job, "good_job", {"k": "v"}, "channel", T(5), T(10))
 
 
+def test_reserve_jobs_with_no_jobs_scheduled():
+    assert scheduler.reserve_jobs() == []
+
+
+def test_reserve_jobs(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 6)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 5)
+    scheduler.schedule_job("bad_job", {"k": "v"}, "channel", TS, 7)
+    scheduler.schedule_job("future_job", {"k": "v"}, "channel", TS, 20)
+    freezer.move_to(T(10))
+
+    jobs = scheduler.reserve_jobs()
+    assert len(jobs) == 3
+    assert_job_matches(jobs[0], "odd_job", {"k": "v"}, "channel", T(5), T(10))
+    assert_job_matches(jobs[1], "good_job", {"k": "v"}, "channel", T(6), T(10))
+    assert_job_matches(jobs[2], "bad_job", {"k": "v"}, "channel", T(7), T(10))
+
+    assert scheduler.reserve_jobs() == []
+
+
+def test_reserve_jobs_with_limit(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 6)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 5)
+    scheduler.schedule_job("bad_job", {"k": "v"}, "channel", TS, 7)
+    freezer.move_to(T(10))
+
+    jobs = scheduler.reserve_jobs(limit=2)
+    assert [job["type"] for job in jobs] == ["odd_job", "good_job"]
+
+    jobs = scheduler.reserve_jobs(limit=2)
+    assert [job["type"] for job in jobs] == ["bad_job"]
+
+
+def test_reserve_jobs_with_jobs_running_and_suppressed(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    scheduler.reserve_job()
+    scheduler.schedule_job("good_job", {"k": "w"}, "channel", TS, 5)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 5)
+    scheduler.schedule_job("bad_job", {"k": "v"}, "channel", TS, 5)
+    scheduler.schedule_suppression("bad_job", T(0), T(20))
+    freezer.move_to(T(10))
+
+    jobs = scheduler.reserve_jobs()
+    assert len(jobs) == 1
+    assert_job_matches(jobs[0], "odd_job", {"k": "v"}, "channel", T(5), T(10))
+
+
+@patch("bennettbot.scheduler.settings.MAX_CONCURRENT_JOBS", 100)
+def test_reserve_job_concurrently():
+    # Dispatchers reserving jobs from the same database at the same time, each
+    # with their own connection, are never given the same job
+    for i in range(40):
+        scheduler.schedule_job(f"job_{i}", {"k": "v"}, "channel", TS, 0)
+
+    num_dispatchers = 8
+    barrier = Barrier(num_dispatchers)
+    reserved_job_ids = []
+
+    def reserve_jobs():
+        barrier.wait()
+        while (job := scheduler.reserve_job()) is not None:
+            reserved_job_ids.append(job["id"])
+
+    threads = [Thread(target=reserve_jobs) for _ in range(num_dispatchers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(reserved_job_ids) == list(range(1, 41))
+
+
+limits_config = {
+    "jobs": {
+        "ns1_urgent_job": {"priority": 10},
+        "ns2_unimportant_job": {"priority": -1},
+    },
+    "max_concurrent_jobs": {"ns1": 2},
+}
+
+
+def test_reserve_jobs_by_priority(freezer):
+    scheduler.schedule_job("ns2_unimportant_job", {}, "channel", TS, 1)
+    scheduler.schedule_job("ns1_good_job", {}, "channel", TS, 2)
+    scheduler.schedule_job("ns1_urgent_job", {}, "channel", TS, 3)
+    scheduler.schedule_job("ns2_good_job", {}, "channel", TS, 4)
+    freezer.move_to(T(10))
+
+    jobs = scheduler.reserve_jobs(config=limits_config)
+    assert [job["type"] for job in jobs] == [
+        "ns1_urgent_job",
+        "ns1_good_job",
+        "ns2_good_job",
+        "ns2_unimportant_job",
+    ]
+
+
+@patch("bennettbot.scheduler.settings.MAX_CONCURRENT_JOBS", 3)
+def test_reserve_jobs_with_global_limit(freezer):
+    scheduler.schedule_job("ns2_job_1", {}, "channel", TS, 0)
+    scheduler.reserve_job()
+    for i in range(2, 5):
+        scheduler.schedule_job(f"ns2_job_{i}", {}, "channel", TS, i)
+    freezer.move_to(T(10))
+
+    jobs = scheduler.reserve_jobs(config=limits_config)
+    assert [job["type"] for job in jobs] == ["ns2_job_2", "ns2_job_3"]
+    assert scheduler.get_capped_jobs(limits_config) == {
+        4: "limit of 3 running jobs reached"
+    }
+
+    scheduler.mark_job_done(jobs[0]["id"])
+    jobs = scheduler.reserve_jobs(config=limits_config)
+    assert [job["type"] for job in jobs] == ["ns2_job_4"]
+    assert scheduler.get_capped_jobs(limits_config) == {}
+
+
+def test_reserve_jobs_with_namespace_limit(freezer):
+    scheduler.schedule_job("ns1_job_1", {}, "channel", TS, 0)
+    scheduler.reserve_job()
+    scheduler.schedule_job("ns1_job_2", {}, "channel", TS, 1)
+    scheduler.schedule_job("ns1_urgent_job", {}, "channel", TS, 2)
+    scheduler.schedule_job("ns2_job_1", {}, "channel", TS, 3)
+    freezer.move_to(T(10))
+
+    jobs = scheduler.reserve_jobs(config=limits_config)
+    # ns1_urgent_job takes the one remaining ns1 slot ahead of ns1_job_2
+    assert [job["type"] for job in jobs] == ["ns1_urgent_job", "ns2_job_1"]
+    assert scheduler.get_capped_jobs(limits_config) == {
+        2: "limit of 2 running ns1 jobs reached"
+    }
+
+    # The bot's own config has no limit on ns1 jobs
+    assert scheduler.get_capped_jobs() == {}
+
+
+@patch("bennettbot.scheduler.job_configs.config", limits_config)
+def test_reserve_job_uses_job_configs_by_default(freezer):
+    scheduler.schedule_job("ns1_good_job", {}, "channel", TS, 1)
+    scheduler.schedule_job("ns1_urgent_job", {}, "channel", TS, 2)
+    freezer.move_to(T(10))
+
+    job = scheduler.reserve_job()
+    assert job["type"] == "ns1_urgent_job"
+
+
+def test_get_job():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 5)
+    job_id = scheduler.get_jobs()[0]["id"]
+
+    job = scheduler.get_job(job_id)
+    assert_job_matches(job, "good_job", {"k": "v"}, "channel", T(5), None)
+
+
+def test_get_next_due_time_with_nothing_scheduled():
+    assert scheduler.get_next_due_time() is None
+
+
+def test_get_next_due_time_with_jobs_scheduled():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 10)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 5)
+
+    assert str(scheduler.get_next_due_time()) == T(5)
+
+
+def test_get_next_due_time_ignores_jobs_already_due():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 15)
+
+    assert str(scheduler.get_next_due_time()) == T(15)
+
+
+def test_get_next_due_time_with_suppression_in_progress():
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    scheduler.schedule_job("odd_job", {"k": "v"}, "channel", TS, 15)
+    scheduler.schedule_suppression("good_job", T(-5), T(10))
+
+    assert str(scheduler.get_next_due_time()) == T(10)
+
+
 def test_mark_job_done(freezer):
     scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
     freezer.move_to(T(10))
-    job_id = scheduler.reserve_job()
+    job = scheduler.reserve_job()
 
-    scheduler.mark_job_done(job_id)
+    scheduler.mark_job_done(job["id"])
 
     assert not scheduler.get_jobs()
+
+
+def test_mark_job_done_records_job_run(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 5)
+    freezer.move_to(T(10))
+    job = scheduler.reserve_job()
+    freezer.move_to(T(40))
+
+    scheduler.mark_job_done(job["id"], rc=0)
+
+    job_runs = scheduler.get_job_runs("good_job")
+    assert len(job_runs) == 1
+    assert_subdict(
+        {
+            "job_id": job["id"],
+            "type": "good_job",
+            "args": {"k": "v"},
+            "channel": "channel",
+            "start_after": T(5),
+            "started_at": T(10),
+            "finished_at": T(40),
+            "queue_seconds": pytest.approx(5, abs=0.01),
+            "duration_seconds": pytest.approx(30, abs=0.01),
+            "rc": 0,
+        },
+        job_runs[0],
+    )
+
+
+def test_mark_job_done_records_job_duration(freezer):
+    scheduler.schedule_job("good_job", {}, "channel", TS, 0)
+    job = scheduler.reserve_job()
+    freezer.move_to(T(30))
+
+    scheduler.mark_job_done(job["id"], rc=0)
+
+    rendered = metrics.render()
+    assert (
+        'bennettbot_job_duration_seconds_bucket{job_type="good_job",le="15"} 0\n'
+        in rendered
+    )
+    assert (
+        'bennettbot_job_duration_seconds_bucket{job_type="good_job",le="60"} 1\n'
+        in rendered
+    )
+
+
+def test_mark_job_done_without_rc_doesnt_record_job_run(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    job = scheduler.reserve_job()
+
+    scheduler.mark_job_done(job["id"])
+
+    assert not scheduler.get_job_runs("good_job")
+
+
+def test_mark_job_done_removes_old_job_runs(freezer):
+    scheduler.schedule_job("good_job", {"k": "v"}, "channel", TS, 0)
+    scheduler.mark_job_done(scheduler.reserve_job()["id"], rc=0)
+    freezer.move_to(T0 + timedelta(days=settings.JOB_RUN_RETENTION_DAYS, seconds=1))
+    scheduler.schedule_job("good_job", {"k": "w"}, "channel", TS, 0)
+    scheduler.mark_job_done(scheduler.reserve_job()["id"], rc=0)
+
+    job_runs = scheduler.get_job_runs("good_job")
+    assert len(job_runs) == 1
+    assert job_runs[0]["args"] == {"k": "w"}
+
+
+def test_get_job_runs_returns_most_recent_first(freezer):
+    for i in range(3):
+        freezer.move_to(T(i * 10))
+        scheduler.schedule_job("good_job", {"i": i}, "channel", TS, 0)
+        scheduler.mark_job_done(scheduler.reserve_job()["id"], rc=0)
+
+    job_runs = scheduler.get_job_runs("good_job", limit=2)
+    assert [job_run["args"] for job_run in job_runs] == [{"i": 2}, {"i": 1}]
+
+
+def test_get_job_run_stats(freezer):
+    # good_job is queued for 0s and takes 10s, 20s, ..., 100s; every third run fails
+    for i in range(1, 11):
+        freezer.move_to(T(i * 1000))
+        scheduler.schedule_job("good_job", {}, "channel", TS, 0)
+        job = scheduler.reserve_job()
+        freezer.move_to(T(i * 1000 + i * 10))
+        scheduler.mark_job_done(job["id"], rc=int(i % 3 == 0))
+    # odd_job is queued for 5s and takes 1s
+    freezer.move_to(T(20000))
+    scheduler.schedule_job("odd_job", {}, "channel", TS, 5)
+    freezer.move_to(T(20010))
+    job = scheduler.reserve_job()
+    freezer.move_to(T(20011))
+    scheduler.mark_job_done(job["id"], rc=0)
+
+    stats = scheduler.get_job_run_stats()
+    assert [s["type"] for s in stats] == ["good_job", "odd_job"]
+    assert_subdict(
+        {
+            "runs": 10,
+            "failures": 3,
+            "queue_p50": pytest.approx(0, abs=0.01),
+            "queue_p95": pytest.approx(0, abs=0.01),
+            "duration_p50": pytest.approx(50, abs=0.01),
+            "duration_p95": pytest.approx(100, abs=0.01),
+        },
+        stats[0],
+    )
+    assert_subdict(
+        {
+            "runs": 1,
+            "failures": 0,
+            "queue_p50": pytest.approx(5, abs=0.01),
+            "duration_p95": pytest.approx(1, abs=0.01),
+        },
+        stats[1],
+    )
+
+    assert scheduler.get_job_run_stats("odd_job") == [stats[1]]
@@ -0,0 +1,183 @@
+from unittest.mock import patch
+
+import httpretty
+import pytest
+
+from bennettbot import settings
+from bennettbot.slack import slack_web_client
+from bennettbot.users import RELOAD_RETRY_INTERVAL, UserDirectory
+
+from .mock_http_request import USERS, get_mock_received_requests, httpretty_register
+from .time_helpers import T0
+
+
+pytestmark = pytest.mark.freeze_time(T0)
+
+
+@pytest.fixture(autouse=True)
+def mock_http():
+    httpretty.enable(allow_net_connect=False)
+    httpretty_register(
+        {
+            "users.list": [
+                {
+                    "ok": True,
+                    "members": [USERS["U1234"], USERS["UINT"]],
+                    "response_metadata": {"next_cursor": "page2"},
+                },
+                {
+                    "ok": True,
+                    "members": [USERS["UGUEST"]],
+                    "response_metadata": {"next_cursor": ""},
+                },
+            ],
+            "users.info": [{"ok": True, "user": USERS["NEWGUEST"]}],
+        }
+    )
+    yield
+    httpretty.disable()
+    httpretty.reset()
+
+
+@pytest.fixture
+def monotonic():
+    # The directory is reloaded in another thread, which freezegun doesn't affect
+    with patch("bennettbot.users.monotonic", return_value=0) as monotonic:
+        yield monotonic
+
+
+def test_load_follows_pagination():
+    users = UserDirectory(slack_web_client())
+    users.load()
+
+    requests = get_mock_received_requests()["/api/users.list"]
+    assert [r.get("cursor") for r in requests] == [None, ["page2"]]
+    assert users.get_id_by_name("test_username") == "U1234"
+    assert not users.is_guest("UINT")
+    assert users.is_guest("UGUEST")
+    assert "/api/users.info" not in get_mock_received_requests()
+
+
+def test_get_id_by_name_for_unknown_user():
+    users = UserDirectory(slack_web_client())
+    users.load()
+
+    with pytest.raises(KeyError):
+        users.get_id_by_name("unknown")
+
+
+def test_get_unknown_user():
+    users = UserDirectory(slack_web_client())
+    users.load()
+
+    assert users.is_guest("NEWGUEST")
+    assert users.is_guest("NEWGUEST")
+
+    # The user is only retrieved once
+    assert get_mock_received_requests()["/api/users.info"] == [{"user": ["NEWGUEST"]}]
+
+
+def test_update():
+    users = UserDirectory(slack_web_client())
+    users.load()
+
+    users.update({**USERS["UGUEST"], "is_restricted": False})
+
+    assert not users.is_guest("UGUEST")
+
+
+def test_get_reloads_in_background_when_stale(monotonic):
+    users = UserDirectory(slack_web_client())
+    users.load()
+    users.update(USERS["NEWINT"])
+    httpretty_register(
+        {
+            "users.list": [{"ok": True, "members": [USERS["UGUEST"]]}],
+            "users.info": [{"ok": True, "user": USERS["NEWINT"]}],
+        }
+    )
+
+    monotonic.return_value += settings.SLACK_USERS_TTL - 1
+    assert not users.is_guest("NEWINT")
+    assert users._reload_thread is None
+
+    # The users we already know about are used while the directory is reloaded
+    monotonic.return_value += 1
+    assert not users.is_guest("NEWINT")
+    users._reload_thread.join()
+    assert len(get_mock_received_requests()["/api/users.list"]) == 3
+    assert "/api/users.info" not in get_mock_received_requests()
+
+    # Reloading forgets NEWINT, who wasn't returned by users.list, so they're
+    # retrieved with users.info
+    assert not users.is_guest("NEWINT")
+    assert len(get_mock_received_requests()["/api/users.info"]) == 1
+
+
+def test_get_loads_users_if_not_loaded():
+    users = UserDirectory(slack_web_client())
+
+    assert users.is_guest("UGUEST")
+    assert users._reload_thread is None
+    assert "/api/users.info" not in get_mock_received_requests()
+
+
+def test_get_keeps_users_if_reload_fails(monotonic):
+    users = UserDirectory(slack_web_client())
+    users.load()
+    httpretty_register({"users.list": [{"ok": False, "error": "error"}]})
+
+    monotonic.return_value += settings.SLACK_USERS_TTL
+    assert users.is_guest("UGUEST")
+    users._reload_thread.join()
+    assert users.is_guest("UGUEST")
+    assert "/api/users.info" not in get_mock_received_requests()
+
+
+def test_failed_reload_retried_later(monotonic):
+    users = UserDirectory(slack_web_client())
+    users.load()
+    httpretty_register({"users.list": [{"ok": False, "error": "error"}]})
+
+    monotonic.return_value += settings.SLACK_USERS_TTL
+    users.is_guest("UGUEST")
+    users._reload_thread.join()
+
+    # Later lookups don't call users.list again until the retry interval has passed
+    for _ in range(3):
+        monotonic.return_value += 1
+        users.is_guest("UGUEST")
+    users._reload_thread.join()
+    assert len(get_mock_received_requests()["/api/users.list"]) == 3
+
+    httpretty_register({"users.list": [{"ok": True, "members": [USERS["UGUEST"]]}]})
+    monotonic.return_value += RELOAD_RETRY_INTERVAL
+    users.is_guest("UGUEST")
+    users._reload_thread.join()
+    assert len(get_mock_received_requests()["/api/users.list"]) == 4
+
+
+def test_failed_first_load_retried_later():
+    httpretty_register(
+        {
+            "users.list": [{"ok": False, "error": "error"}],
+            "users.info": [{"ok": True, "user": USERS["UGUEST"]}],
+        }
+    )
+    users = UserDirectory(slack_web_client())
+
+    assert users.is_guest("UGUEST")
+    assert users.is_guest("UGUEST")
+    assert len(get_mock_received_requests()["/api/users.list"]) == 1
+
+
+def test_get_doesnt_reload_while_another_thread_is_reloading(monotonic):
+    users = UserDirectory(slack_web_client())
+    users.load()
+
+    monotonic.return_value += settings.SLACK_USERS_TTL
+    with users._reload_lock:
+        assert users.is_guest("UGUEST")
+
+    assert users._reload_thread is None
+    assert len(get_mock_received_requests()["/api/users.list"]) == 2
@@ -3,7 +3,7 @@ from unittest.mock import patch
 import httpretty
 import pytest
 
-from bennettbot import scheduler
+from bennettbot import metrics, scheduler
 from bennettbot.job_configs import build_config
 
 from ..assertions import assert_job_matches, assert_slack_client_sends_messages
@@ -126,3 +126,12 @@ def test_unknown_project(web_client):
     )
     assert rsp.status_code == 400
     assert rsp.data == b"Unknown project: another-name"
+
+
+def test_webhook_duration_recorded(web_client):
+    web_client.post("/github/test/", data=PAYLOAD_PR_CLOSED)
+    headers = {"X-Hub-Signature": "sha1=4cc85e5c6e7a1f3a03aeaef924f1cfa7a3d72384"}
+    web_client.post("/github/test/", data=PAYLOAD_PR_OPENED, headers=headers)
+
+    # Rejected webhooks are recorded too
+    assert "bennettbot_webhook_duration_seconds_count 2\n" in metrics.render()
@@ -0,0 +1,14 @@
+from bennettbot import metrics
+
+
+def test_metrics(web_client):
+    metrics.inc("bennettbot_slack_api_retries_total", method="chat.postMessage")
+
+    rsp = web_client.get("/metrics")
+
+    assert rsp.status_code == 200
+    assert rsp.content_type == "text/plain; version=0.0.4; charset=utf-8"
+    assert (
+        'bennettbot_slack_api_retries_total{method="chat.postMessage"} 1\n'
+        in rsp.data.decode()
+    )
@@ -1,4 +1,5 @@
 import json
+import sys
 from argparse import ArgumentParser
 
 
@@ -26,7 +27,11 @@ def long_code_output():
     return "\n".join(["Hello" * 10 for i in range(100)])
 
 
-def parse_args():
+def exit_with_message():
+    sys.exit("Something went wrong")
+
+
+def parse_args(argv=None):
     parser = ArgumentParser()
     subparsers = parser.add_subparsers(dest="subparser_name")
     h1 = subparsers.add_parser("hello_world")
@@ -40,11 +45,13 @@ def parse_args():
     h4.set_defaults(function=hello_world)
     h5 = subparsers.add_parser("long_code_output")
     h5.set_defaults(function=long_code_output)
-    return parser.parse_args()
+    h6 = subparsers.add_parser("exit_with_message")
+    h6.set_defaults(function=exit_with_message)
+    return parser.parse_args(argv)
 
 
-def main():
-    args = parse_args()
+def main(argv=None):
+    args = parse_args(argv)
     if args.subparser_name == "hello_world":
         print(args.function(args.name))
     elif args.subparser_name == "hello_world_no_output":
@@ -1,12 +1,16 @@
 import json
+from datetime import date
 from unittest.mock import patch
 
 import pytest
 
 from workspace.techsupport.jobs import (
+    CHECK_INTERVAL,
+    OutOfOfficeDates,
     out_of_office_off,
     out_of_office_on,
     out_of_office_status,
+    run_from_command_line,
 )
 
 
@@ -118,3 +122,71 @@ def test_out_of_office_on_invalid_dates(config_path, start, end):
         with pytest.raises(ValueError):
             out_of_office_on(start, end)
     assert not config_path.exists()
+
+
+def write_config(config_path, start, end, **kwargs):
+    config_path.write_text(json.dumps({"start": start, "end": end}, **kwargs))
+
+
+def test_out_of_office_dates(config_path, freezer):
+    write_config(config_path, "3033-01-01", "3033-01-02")
+    dates = OutOfOfficeDates()
+
+    with patch("workspace.techsupport.jobs.config_file", return_value=config_path):
+        assert dates.get() == (date(3033, 1, 1), date(3033, 1, 2))
+
+        # The file isn't checked again until CHECK_INTERVAL seconds have passed.
+        # (We change the file's size as well as its dates, in case its modification
+        # time doesn't change.)
+        write_config(config_path, "3033-02-01", "3033-02-28", indent=1)
+        assert dates.get() == (date(3033, 1, 1), date(3033, 1, 2))
+        freezer.tick(CHECK_INTERVAL)
+        assert dates.get() == (date(3033, 2, 1), date(3033, 2, 28))
+
+        config_path.unlink()
+        freezer.tick(CHECK_INTERVAL)
+        assert dates.get() == (None, None)
+
+
+def test_out_of_office_dates_only_reads_changed_file(config_path, freezer):
+    write_config(config_path, "3033-01-01", "3033-01-02")
+    dates = OutOfOfficeDates()
+
+    with patch("workspace.techsupport.jobs.config_file", return_value=config_path):
+        with patch.object(dates, "_read", wraps=dates._read) as read:
+            dates.get()
+            freezer.tick(CHECK_INTERVAL)
+            dates.get()
+
+    read.assert_called_once_with(config_path)
+
+
+def test_out_of_office_dates_invalidate(config_path):
+    dates = OutOfOfficeDates()
+
+    with patch("workspace.techsupport.jobs.config_file", return_value=config_path):
+        assert dates.get() == (None, None)
+        write_config(config_path, "3033-01-01", "3033-01-02")
+        dates.invalidate()
+        assert dates.get() == (date(3033, 1, 1), date(3033, 1, 2))
+
+
+def test_out_of_office_on_then_status(config_path):
+    # out_of_office_on invalidates the cached dates, so the new dates are reported
+    # straight away
+    with patch("workspace.techsupport.jobs.config_file", return_value=config_path):
+        assert out_of_office_status() == "Tech support out of office is currently OFF."
+        out_of_office_on("2020-12-01", "3033-12-01")
+        assert (
+            out_of_office_status()
+            == "Tech support out of office is currently ON until 3033-12-01."
+        )
+        out_of_office_off()
+        assert out_of_office_status() == "Tech support out of office is currently OFF."
+
+
+def test_run_from_command_line(config_path, capsys):
+    with patch("workspace.techsupport.jobs.config_file", return_value=config_path):
+        run_from_command_line(["status"])
+
+    assert capsys.readouterr().out == "Tech support out of office is currently OFF.\n"
@@ -1,9 +1,11 @@
 import json
+import threading
 from pathlib import Path
-from unittest.mock import patch
+from unittest.mock import ANY, patch
 
 import httpretty
 import pytest
+import requests
 
 from workspace.workflows import jobs
 
@@ -33,6 +35,20 @@ def cache_path(tmp_path):
     yield tmp_path / "test_cache.json"
 
 
+@pytest.fixture(autouse=True)
+def workflows_cache(cache_path):
+    workflows_cache = jobs.WorkflowsCache(cache_path)
+    with patch("workspace.workflows.jobs.workflows_cache", workflows_cache):
+        yield workflows_cache
+
+
+@pytest.fixture(autouse=True)
+def http_cache(tmp_path):
+    http_cache = jobs.HTTPCache(tmp_path / "http_cache")
+    with patch("workspace.workflows.jobs.http_cache", http_cache):
+        yield http_cache
+
+
 @pytest.fixture
 def mock_airlock_reporter():
     httpretty.enable(allow_net_connect=False)
@@ -119,6 +135,12 @@ def test_print_key():
     assert json.loads(jobs.get_text_blocks_for_key(None)) == blocks
 
 
+def test_run_from_command_line(capsys):
+    jobs.run_from_command_line(["key"])
+
+    assert capsys.readouterr().out == jobs.get_text_blocks_for_key(None) + "\n"
+
+
 @pytest.mark.parametrize("org", ["opensafely-core", "osc"])
 def test_org_as_target(org):
     args = jobs.get_command_line_parser().parse_args(f"show --target {org}".split())
@@ -170,11 +192,309 @@ def test_get_workflows():
     assert reporter.workflows == WORKFLOWS_MAIN
 
 
+def register_conditional_uri(uri, body, etag):
+    def callback(request, uri, response_headers):
+        if request.headers.get("If-None-Match") == etag:
+            return [304, response_headers, ""]
+        return [200, {**response_headers, "ETag": etag}, body]
+
+    httpretty.register_uri(httpretty.GET, uri, body=callback)
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_http_cache(http_cache, capsys):
+    uri = "https://api.github.com/repos/opensafely-core/airlock/actions/workflows"
+    register_conditional_uri(
+        uri, Path("tests/workspace/workflows.json").read_text(), '"abc"'
+    )
+
+    # The first request fetches the workflows, and the second gets a 304 response
+    # and uses the cached workflows
+    first = jobs.get_api_result_as_json(uri)
+    second = jobs.get_api_result_as_json(uri)
+
+    assert (
+        first
+        == second
+        == json.loads(Path("tests/workspace/workflows.json").read_text())
+    )
+    received = httpretty.latest_requests()
+    assert "If-None-Match" not in received[0].headers
+    assert received[1].headers["If-None-Match"] == '"abc"'
+    assert received[1].headers["Authorization"] == "Bearer dummy-token"
+    assert (http_cache.hits, http_cache.misses) == (1, 1)
+
+    http_cache.report()
+    assert capsys.readouterr().err == "GitHub API cache: 1 hits, 1 misses\n"
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_http_cache_with_different_params(http_cache):
+    uri = "https://api.github.com/repos/opensafely-core/airlock/actions/runs"
+    register_conditional_uri(
+        uri, Path("tests/workspace/runs.json").read_text(), '"abc"'
+    )
+
+    # Only the response to the most recent request to the endpoint is cached
+    jobs.get_api_result_as_json(uri, {"created": ">=2023-09-30T09:00:08Z"})
+    jobs.get_api_result_as_json(uri, {"created": ">=2023-09-30T10:00:08Z"})
+    jobs.get_api_result_as_json(uri, {"created": ">=2023-09-30T09:00:08Z"})
+
+    assert [r.headers.get("If-None-Match") for r in httpretty.latest_requests()] == [
+        None,
+        None,
+        None,
+    ]
+    assert (http_cache.hits, http_cache.misses) == (0, 3)
+    assert len(list(http_cache.cache_dir.iterdir())) == 1
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_http_cache_with_last_modified(http_cache):
+    uri = "https://api.github.com/repos/opensafely-core/airlock/actions/workflows"
+    httpretty.register_uri(
+        httpretty.GET,
+        uri,
+        responses=[
+            httpretty.Response(
+                body=Path("tests/workspace/workflows.json").read_text(),
+                last_modified="Sat, 30 Sep 2023 09:00:08 GMT",
+            ),
+            httpretty.Response(body="", status=304),
+        ],
+    )
+
+    jobs.get_api_result_as_json(uri)
+    jobs.get_api_result_as_json(uri)
+
+    request = httpretty.last_request()
+    assert request.headers["If-Modified-Since"] == "Sat, 30 Sep 2023 09:00:08 GMT"
+    assert "If-None-Match" not in request.headers
+    assert (http_cache.hits, http_cache.misses) == (1, 1)
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_http_cache_with_uncacheable_response(http_cache):
+    uri = "https://api.github.com/repos/opensafely-core/airlock/actions/workflows"
+    httpretty.register_uri(httpretty.GET, uri, body='{"workflows": []}')
+
+    jobs.get_api_result_as_json(uri)
+
+    assert not http_cache.cache_dir.exists()
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_http_cache_with_corrupt_entry(http_cache):
+    uri = "https://api.github.com/repos/opensafely-core/airlock/actions/workflows"
+    register_conditional_uri(uri, '{"workflows": []}', '"abc"')
+    http_cache.cache_dir.mkdir()
+    http_cache._get_path(uri).write_text("{")
+
+    assert jobs.get_api_result_as_json(uri) == {"workflows": []}
+    assert "If-None-Match" not in httpretty.last_request().headers
+    assert http_cache.misses == 1
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_http_cache_with_error(http_cache):
+    uri = "https://api.github.com/repos/opensafely-core/airlock/actions/workflows"
+    httpretty.register_uri(httpretty.GET, uri, status=500, body="")
+
+    with pytest.raises(requests.HTTPError):
+        jobs.get_api_result_as_json(uri)
+    assert (http_cache.hits, http_cache.misses) == (0, 0)
+
+
+def register_airlock_uris():
+    httpretty.register_uri(
+        httpretty.GET,
+        "https://api.github.com/repos/opensafely-core/airlock/actions/workflows",
+        body=Path("tests/workspace/workflows.json").read_text(),
+    )
+    httpretty.register_uri(
+        httpretty.GET,
+        "https://api.github.com/repos/opensafely-core/airlock/actions/runs",
+        body=Path("tests/workspace/runs.json").read_text(),
+    )
+
+
+def get_requested_paths():
+    return [request.path.split("?")[0] for request in httpretty.latest_requests()]
+
+
+def write_cache_with_workflows(cache_path, workflows, timestamp):
+    cache_path.write_text(
+        json.dumps(
+            {
+                "opensafely-core/airlock": {
+                    **CACHE["opensafely-core/airlock"],
+                    "workflows": {
+                        "timestamp": timestamp,
+                        "names": {str(key): name for key, name in workflows.items()},
+                    },
+                }
+            }
+        )
+    )
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_workflows_from_cache(cache_path, freezer):
+    freezer.move_to("2023-09-30 12:00:00")
+    write_cache_with_workflows(cache_path, WORKFLOWS, "2023-09-30T09:00:08Z")
+    register_airlock_uris()
+
+    reporter = jobs.RepoWorkflowReporter("opensafely-core/airlock")
+    conclusions = reporter.get_latest_conclusions()
+
+    # Only the runs are retrieved from the API
+    assert reporter.workflows == WORKFLOWS_MAIN
+    assert conclusions == {key: "success" for key in WORKFLOWS_MAIN.keys()}
+    assert get_requested_paths() == ["/repos/opensafely-core/airlock/actions/runs"]
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_workflows_from_cache_expired(cache_path, freezer):
+    freezer.move_to("2023-10-01 09:00:08")
+    write_cache_with_workflows(cache_path, {}, "2023-09-30T09:00:08Z")
+    register_airlock_uris()
+
+    reporter = jobs.RepoWorkflowReporter("opensafely-core/airlock")
+    reporter.get_latest_conclusions()
+
+    assert reporter.workflows == WORKFLOWS_MAIN
+    assert reporter.cache["workflows"]["timestamp"] == "2023-10-01T09:00:08Z"
+    assert get_requested_paths() == [
+        "/repos/opensafely-core/airlock/actions/workflows",
+        "/repos/opensafely-core/airlock/actions/runs",
+    ]
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_workflows_refreshed_for_unknown_workflow(cache_path, freezer):
+    # CI was added after the workflows were cached, and has run since
+    freezer.move_to("2023-09-30 12:00:00")
+    workflows = {k: v for k, v in WORKFLOWS.items() if v != "CI"}
+    write_cache_with_workflows(cache_path, workflows, "2023-09-30T09:00:08Z")
+    register_airlock_uris()
+
+    reporter = jobs.RepoWorkflowReporter("opensafely-core/airlock")
+    conclusions = reporter.get_latest_conclusions()
+
+    assert reporter.workflows == WORKFLOWS_MAIN
+    assert conclusions == {key: "success" for key in WORKFLOWS_MAIN.keys()}
+    assert get_requested_paths() == [
+        "/repos/opensafely-core/airlock/actions/runs",
+        "/repos/opensafely-core/airlock/actions/workflows",
+    ]
+
+
+RUNS = json.loads(Path("tests/workspace/runs.json").read_text())["workflow_runs"]
+RUNS_URI = "https://api.github.com/repos/opensafely-core/airlock/actions/runs"
+
+
+def runs_page(runs, next_page=None):
+    headers = {}
+    if next_page is not None:
+        headers["Link"] = f'<{RUNS_URI}?page={next_page}>; rel="next"'
+    return httpretty.Response(
+        body=json.dumps({"workflow_runs": runs}), adding_headers=headers
+    )
+
+
+def test_runs_retrieved_from_each_page(mock_airlock_reporter):
+    # CI and CodeQL have only run on the second page
+    httpretty.register_uri(
+        httpretty.GET,
+        RUNS_URI,
+        responses=[runs_page(RUNS[:4], next_page=2), runs_page(RUNS[4:])],
+    )
+
+    conclusions = mock_airlock_reporter.get_latest_conclusions()
+
+    assert conclusions == {key: "success" for key in WORKFLOWS_MAIN.keys()}
+    assert [r.querystring.get("page") for r in httpretty.latest_requests()[-2:]] == [
+        None,
+        ["2"],
+    ]
+
+
+def test_runs_stop_when_all_workflows_found(mock_airlock_reporter):
+    httpretty.register_uri(
+        httpretty.GET,
+        RUNS_URI,
+        responses=[runs_page(RUNS, next_page=2), runs_page([])],
+    )
+
+    conclusions = mock_airlock_reporter.get_latest_conclusions()
+
+    assert conclusions == {key: "success" for key in WORKFLOWS_MAIN.keys()}
+    assert httpretty.last_request().querystring.get("page") is None
+
+
+@patch("workspace.workflows.jobs.MAX_RUNS_PAGES", 3)
+def test_runs_stop_after_max_pages(mock_airlock_reporter):
+    # CI never runs, and there is always another page
+    runs = [run for run in RUNS if run["workflow_id"] != 82728346]
+    httpretty.register_uri(
+        httpretty.GET, RUNS_URI, responses=[runs_page(runs, next_page=2)] * 4
+    )
+
+    conclusions = mock_airlock_reporter.get_latest_conclusions()
+
+    assert conclusions[82728346] == "missing"
+    runs_requests = [
+        r
+        for r in httpretty.latest_requests()
+        if r.path.startswith("/repos/opensafely-core/airlock/actions/runs")
+    ]
+    assert len(runs_requests) == 3
+
+
+def test_runs_of_skipped_workflows_ignored(mock_airlock_reporter):
+    # Docs is skipped on main, so its runs aren't reported, and don't cause the
+    # workflows to be refreshed
+    docs_run = {**RUNS[0], "workflow_id": 94122733, "conclusion": "failure"}
+    mock_airlock_reporter.workflows_refreshed = False  # As if they were cached
+    httpretty.register_uri(
+        httpretty.GET, RUNS_URI, responses=[runs_page([docs_run, *RUNS])]
+    )
+
+    conclusions = mock_airlock_reporter.get_latest_conclusions()
+
+    assert conclusions == {key: "success" for key in WORKFLOWS_MAIN.keys()}
+    assert (
+        get_requested_paths().count("/repos/opensafely-core/airlock/actions/workflows")
+        == 1
+    )
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_http_cache_with_next_page(http_cache):
+    uri = "https://api.github.com/repos/opensafely-core/airlock/actions/runs"
+    httpretty.register_uri(
+        httpretty.GET,
+        uri,
+        responses=[
+            httpretty.Response(
+                body=json.dumps({"workflow_runs": RUNS}),
+                adding_headers={"ETag": '"abc"', "Link": f'<{uri}?page=2>; rel="next"'},
+            ),
+            httpretty.Response(body="", status=304),
+        ],
+    )
+
+    # The link to the next page is cached with the first page
+    assert jobs.get_api_result_as_json(uri) == {"workflow_runs": RUNS}
+    assert http_cache.get_page(uri, {"format": "json"}, {}) == (
+        {"workflow_runs": RUNS},
+        f"{uri}?page=2",
+    )
+
+
 def test_cache_file_does_not_exist(mock_airlock_reporter, cache_path):
     assert not cache_path.exists()
-    with patch("workspace.workflows.jobs.CACHE_PATH", cache_path):
-        assert jobs.load_cache() == {}
-        assert mock_airlock_reporter._load_cache_for_repo() == {}
+    assert mock_airlock_reporter._load_cache_for_repo() == {}
 
 
 def test_repo_not_cached(mock_airlock_reporter, cache_path):
@@ -182,7 +502,9 @@ def test_repo_not_cached(mock_airlock_reporter, cache_path):
     mock_cache = {"another/repo": CACHE["opensafely-core/airlock"]}
     with open(cache_path, "w") as f:
         json.dump(mock_cache, f)
-    with patch("workspace.workflows.jobs.CACHE_PATH", cache_path):
+    with patch(
+        "workspace.workflows.jobs.workflows_cache", jobs.WorkflowsCache(cache_path)
+    ):
         assert mock_airlock_reporter._load_cache_for_repo() == {}
 
 
@@ -190,22 +512,98 @@ def test_get_runs_since_last_retrieval(mock_airlock_reporter, cache_path):
     # Create the cache and test that it is loaded
     with open(cache_path, "w") as f:
         json.dump(CACHE, f)
-    with patch("workspace.workflows.jobs.CACHE_PATH", cache_path):
+    with patch(
+        "workspace.workflows.jobs.workflows_cache", jobs.WorkflowsCache(cache_path)
+    ):
         mock_airlock_reporter.cache = mock_airlock_reporter._load_cache_for_repo()
     assert mock_airlock_reporter.cache == CACHE["opensafely-core/airlock"]
 
-    mock_airlock_reporter.get_runs_since_last_retrieval()
+    # Runs are retrieved as they are needed, and the first page isn't filtered by
+    # the time of the last retrieval, so that it can be revalidated
+    next(mock_airlock_reporter.get_runs_since_last_retrieval())
     assert httpretty.last_request().querystring == {
         "branch": ["main"],
         "per_page": ["100"],
         "format": ["json"],
-        "created": [">=2023-09-30T09:00:08Z"],
     }
 
 
+@patch("workspace.workflows.jobs.RUNS_PER_PAGE", 4)
+def test_runs_after_first_page_filtered_by_last_retrieval(mock_airlock_reporter):
+    # CI and CodeQL have only run on the second page, and all the runs on the first
+    # page are since the last retrieval
+    mock_airlock_reporter.cache = CACHE["opensafely-core/airlock"]
+    httpretty.register_uri(
+        httpretty.GET,
+        RUNS_URI,
+        responses=[runs_page(RUNS[:4], next_page=2), runs_page(RUNS[4:])],
+    )
+
+    conclusions = mock_airlock_reporter.get_latest_conclusions()
+
+    assert conclusions == {key: "success" for key in WORKFLOWS_MAIN.keys()}
+    first, second = httpretty.latest_requests()[-2:]
+    assert "created" not in first.querystring
+    assert second.querystring["created"] == [">=2023-09-30T09:00:08Z"]
+    assert second.querystring["page"] == ["2"]
+
+
+@patch("workspace.workflows.jobs.RUNS_PER_PAGE", 4)
+def test_runs_stop_at_last_retrieval(mock_airlock_reporter):
+    # The first page goes back past the last retrieval, so the workflows that
+    # haven't run since keep their previous conclusions
+    mock_airlock_reporter.cache = {
+        "timestamp": "2024-09-14T00:00:00Z",
+        "conclusions": {"82728346": "failure", "88048829": "success"},
+    }
+    httpretty.register_uri(
+        httpretty.GET,
+        RUNS_URI,
+        responses=[runs_page(RUNS[:4], next_page=2), runs_page(RUNS[4:])],
+    )
+
+    conclusions = mock_airlock_reporter.get_latest_conclusions()
+
+    assert conclusions[82728346] == "failure"
+    assert (
+        get_requested_paths().count("/repos/opensafely-core/airlock/actions/runs") == 1
+    )
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_runs_revalidated_when_nothing_has_changed(http_cache, freezer):
+    freezer.move_to("2024-09-16 12:00:00")
+    register_conditional_uri(
+        "https://api.github.com/repos/opensafely-core/airlock/actions/workflows",
+        Path("tests/workspace/workflows.json").read_text(),
+        '"workflows"',
+    )
+    register_conditional_uri(
+        RUNS_URI, Path("tests/workspace/runs.json").read_text(), '"runs"'
+    )
+
+    first = jobs.RepoWorkflowReporter("opensafely-core/airlock")
+    first.get_latest_conclusions()
+    jobs.workflows_cache.save()
+
+    # There are no new runs when the job is run again
+    freezer.move_to("2024-09-16 13:00:00")
+    second = jobs.RepoWorkflowReporter("opensafely-core/airlock")
+    conclusions = second.get_latest_conclusions()
+
+    assert conclusions == {key: "success" for key in WORKFLOWS_MAIN.keys()}
+    runs_requests = [
+        r
+        for r in httpretty.latest_requests()
+        if r.path.startswith("/repos/opensafely-core/airlock/actions/runs")
+    ]
+    assert len(runs_requests) == 2
+    assert runs_requests[1].headers["If-None-Match"] == '"runs"'
+    assert (http_cache.hits, http_cache.misses) == (1, 2)
+
+
 def test_all_workflows_found(mock_airlock_reporter, cache_path):
-    with patch("workspace.workflows.jobs.CACHE_PATH", cache_path):
-        conclusions = mock_airlock_reporter.get_latest_conclusions()
+    conclusions = mock_airlock_reporter.get_latest_conclusions()
     assert conclusions == {key: "success" for key in WORKFLOWS_MAIN.keys()}
 
 
@@ -218,8 +616,7 @@ def test_some_workflows_not_found(mock_airlock_reporter, cache_path):
 
     mock_airlock_reporter.workflows[5678] = "Workflow that will not be found"
     mock_airlock_reporter.workflow_ids = set(mock_airlock_reporter.workflows.keys())
-    with patch("workspace.workflows.jobs.CACHE_PATH", cache_path):
-        conclusions = mock_airlock_reporter.get_latest_conclusions()
+    conclusions = mock_airlock_reporter.get_latest_conclusions()
     assert len(mock_airlock_reporter.workflow_ids) == 7
     assert conclusions == {
         **{key: "success" for key in WORKFLOWS_MAIN.keys()},
@@ -234,14 +631,48 @@ def test_cache_creation(mock_write, mock_airlock_reporter, freezer):
     assert mock_airlock_reporter.cache == {}
     freezer.move_to("2023-09-30 09:00:08")
     mock_airlock_reporter.get_latest_conclusions()
-    assert mock_airlock_reporter.cache == CACHE["opensafely-core/airlock"]
+    assert mock_airlock_reporter.cache == {
+        **CACHE["opensafely-core/airlock"],
+        "workflows": {
+            "timestamp": ANY,
+            "names": {str(key): name for key, name in WORKFLOWS.items()},
+        },
+    }
 
 
-def test_write_to_cache_file(mock_airlock_reporter, cache_path):
+def test_write_to_cache_file(mock_airlock_reporter, workflows_cache, cache_path):
     mock_airlock_reporter.cache = CACHE["opensafely-core/airlock"]
-    with patch("workspace.workflows.jobs.CACHE_PATH", cache_path):
-        mock_airlock_reporter.write_cache_to_file()
+    mock_airlock_reporter.write_cache_to_file()
+    # The file isn't written until the cache is saved
+    assert not cache_path.exists()
+    assert workflows_cache.get("opensafely-core/airlock") == mock_airlock_reporter.cache
+
+    workflows_cache.save()
     assert json.loads(cache_path.read_text()) == CACHE
+    assert [p.name for p in cache_path.parent.glob("*.tmp")] == []
+
+
+def test_workflows_cache_save_keeps_other_updates(workflows_cache, cache_path):
+    other_repo_cache = {"timestamp": "2023-09-29T19:00:08Z", "conclusions": {}}
+    assert workflows_cache.get("opensafely-core/airlock") == {}
+    workflows_cache.set("opensafely-core/airlock", CACHE["opensafely-core/airlock"])
+
+    # Another job saves its update after this cache has been loaded
+    other_job_cache = jobs.WorkflowsCache(cache_path)
+    other_job_cache.set("opensafely/other-repo", other_repo_cache)
+    other_job_cache.save()
+
+    workflows_cache.save()
+    assert json.loads(cache_path.read_text()) == {
+        **CACHE,
+        "opensafely/other-repo": other_repo_cache,
+    }
+    assert workflows_cache.get("opensafely/other-repo") == other_repo_cache
+
+
+def test_workflows_cache_save_without_updates(workflows_cache, cache_path):
+    workflows_cache.save()
+    assert not cache_path.exists()
 
 
 @pytest.mark.parametrize("conclusion", ["running", "queued"])
@@ -250,8 +681,32 @@ def test_pending_status_not_written_to_cache_file(
     mock_get_conclusion_for_run, mock_airlock_reporter, cache_path, conclusion
 ):
     mock_get_conclusion_for_run.return_value = conclusion
-    with patch("workspace.workflows.jobs.CACHE_PATH", cache_path):
-        mock_airlock_reporter.get_latest_conclusions()
+    mock_airlock_reporter.cache = CACHE["opensafely-core/airlock"]
+    mock_airlock_reporter.get_latest_conclusions()
+    jobs.workflows_cache.save()
+
+    # The conclusions aren't cached until the runs have finished, but the workflows
+    # that were retrieved are
+    assert json.loads(cache_path.read_text()) == {
+        "opensafely-core/airlock": {
+            **CACHE["opensafely-core/airlock"],
+            "workflows": {
+                "timestamp": ANY,
+                "names": {str(key): name for key, name in WORKFLOWS.items()},
+            },
+        }
+    }
+
+
+@patch("workspace.workflows.jobs.RepoWorkflowReporter.get_conclusion_for_run")
+def test_pending_status_with_cached_workflows(
+    mock_get_conclusion_for_run, mock_airlock_reporter, cache_path
+):
+    mock_get_conclusion_for_run.return_value = "running"
+    mock_airlock_reporter.workflows_refreshed = False  # As if they were cached
+    mock_airlock_reporter.get_latest_conclusions()
+    jobs.workflows_cache.save()
+
     assert not cache_path.exists()
 
 
@@ -370,8 +825,7 @@ def test_main_for_organisation(mock_workflows, mock_runs, cache_path):
 
     # Test main
     args = jobs.get_command_line_parser().parse_args("show --target osc".split())
-    with patch("workspace.workflows.jobs.CACHE_PATH", cache_path):
-        blocks = json.loads(jobs.main(args))
+    blocks = json.loads(jobs.main(args))
     green = ":large_green_circle:"
     red = ":red_circle:"
     assert blocks == [
@@ -416,8 +870,7 @@ def test_main_for_all_orgs(mock_workflows, mock_conclusions, cache_path):
     emoji = ":large_green_circle:"
     mock_conclusions.return_value = {key: conclusion for key in WORKFLOWS_MAIN.keys()}
     args = jobs.get_command_line_parser().parse_args("show --target all".split())
-    with patch("workspace.workflows.jobs.CACHE_PATH", cache_path):
-        blocks = json.loads(jobs.main(args))
+    blocks = json.loads(jobs.main(args))
     assert blocks == [
         {
             "type": "header",
@@ -479,8 +932,7 @@ def test_main_for_all_skipping_successful(mock_workflows, mock_runs, cache_path)
     args = jobs.get_command_line_parser().parse_args(
         "show --target all --skip-successful".split()
     )
-    with patch("workspace.workflows.jobs.CACHE_PATH", cache_path):
-        blocks = json.loads(jobs.main(args))
+    blocks = json.loads(jobs.main(args))
     red = ":red_circle:"
     assert blocks == [
         {  # Only the Team REX section containing the failing repo should appear
@@ -500,6 +952,61 @@ def test_main_for_all_skipping_successful(mock_workflows, mock_runs, cache_path)
     ]
 
 
+def test_get_conclusions_for_locations_keeps_order():
+    # The first repo's conclusions are retrieved last, but are still returned first
+    second_retrieved = threading.Event()
+
+    def get_conclusions(location):
+        if location == "opensafely-core/first":
+            assert second_retrieved.wait(timeout=5)
+        else:
+            second_retrieved.set()
+        return [location]
+
+    with patch(
+        "workspace.workflows.jobs.get_conclusions_for_location",
+        side_effect=get_conclusions,
+    ):
+        conclusions = jobs.get_conclusions_for_locations(
+            ["opensafely-core/first", "opensafely-core/second"]
+        )
+    assert list(conclusions.items()) == [
+        ("opensafely-core/first", ["opensafely-core/first"]),
+        ("opensafely-core/second", ["opensafely-core/second"]),
+    ]
+
+
+@patch(
+    "workspace.workflows.config.REPOS",
+    {
+        "airlock": {"org": "opensafely-core", "team": "Team RAP"},
+        "broken-repo": {"org": "opensafely-core", "team": "Team REX"},
+    },
+)
+def test_main_for_organisation_with_error(mock_airlock_reporter, cache_path, capsys):
+    httpretty.register_uri(
+        httpretty.GET,
+        "https://api.github.com/repos/opensafely-core/broken-repo/actions/workflows",
+        status=500,
+        body="",
+    )
+
+    args = jobs.get_command_line_parser().parse_args("show --target osc".split())
+    blocks = json.loads(jobs.main(args))
+
+    # The broken repo is shown as missing, and the other repo is still reported
+    assert [block["text"]["text"] for block in blocks] == [
+        "Workflows for opensafely-core repos",
+        "<https://github.com/opensafely-core/broken-repo/actions?query=branch%3Amain|opensafely-core/broken-repo>: :ghost:",
+        f"<https://github.com/opensafely-core/airlock/actions?query=branch%3Amain|opensafely-core/airlock>: {':large_green_circle:' * 5}",
+    ]
+    assert (
+        "Could not retrieve workflows for opensafely-core/broken-repo"
+        in capsys.readouterr().err
+    )
+    assert list(json.loads(cache_path.read_text())) == ["opensafely-core/airlock"]
+
+
 def test_main_for_invalid_org():
     # Call main with an invalid org
     args = jobs.get_command_line_parser().parse_args(
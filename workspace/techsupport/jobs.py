@@ -1,12 +1,20 @@
 import json
+import threading
 from argparse import ArgumentParser
 from datetime import date, datetime
 from os import environ
 from pathlib import Path
+from time import monotonic
 
 from workspace.utils.rota import RotaReporter
 
 
+# The bot checks whether tech support is out of office for every tech-support
+# message, so we cache the dates, and only check whether the config file has
+# changed once this many seconds have passed since we last checked
+CHECK_INTERVAL = 5
+
+
 def config_file():
     return Path(environ["WRITEABLE_DIR"]) / "techsupport_ooo.json"
 
@@ -19,15 +27,51 @@ def convert_date(date_string):
     return date.fromisoformat(date_string)
 
 
+class OutOfOfficeDates:
+    """The start and end dates from the out of office config file, which are only
+    read again when the file is replaced or modified, or after invalidate() is
+    called."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def get(self):
+        path = config_file()
+        with self._lock:
+            if path != self._path or monotonic() - self._checked_at >= CHECK_INTERVAL:
+                self._check(path)
+            return self._dates
+
+    def invalidate(self):
+        with self._lock:
+            self._path = None
+            self._stat = None
+            self._dates = None, None
+            self._checked_at = None
+
+    def _check(self, path):
+        try:
+            stat = path.stat()
+            stat_key = stat.st_ino, stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            stat_key = None
+        if path != self._path or stat_key != self._stat:
+            self._dates = self._read(path) if stat_key else (None, None)
+            self._path = path
+            self._stat = stat_key
+        self._checked_at = monotonic()
+
+    def _read(self, path):
+        config_dict = json.loads(path.read_text())
+        return convert_date(config_dict["start"]), convert_date(config_dict["end"])
+
+
+out_of_office_dates = OutOfOfficeDates()
+
+
 def get_dates_from_config():
-    start = None
-    end = None
-    config = config_file()
-    if config.exists():
-        config_dict = json.load(config_file().open())
-        start = convert_date(config_dict["start"])
-        end = convert_date(config_dict["end"])
-    return start, end
+    return out_of_office_dates.get()
 
 
 def out_of_office_on(start_date, end_date):
@@ -44,6 +88,7 @@ def out_of_office_on(start_date, end_date):
 
     with config_file().open("w") as outfile:
         json.dump(config, outfile)
+    out_of_office_dates.invalidate()
     if start <= today():
         return f"Tech support out of office now ON until {end_date}"
     return f"Tech support out of office scheduled from {start_date} until {end_date}"
@@ -53,6 +98,7 @@ def out_of_office_off():
     config = config_file()
     start, _ = get_dates_from_config()
     config.unlink(missing_ok=True)
+    out_of_office_dates.invalidate()
     if start and start > today():
         return "Scheduled tech support out of office cancelled"
     return "Tech support out of office OFF"
@@ -100,7 +146,7 @@ def report_rota():
     ).report()
 
 
-if __name__ == "__main__":
+def run_from_command_line(argv=None):
     parser = ArgumentParser()
 
     subparsers = parser.add_subparsers(dest="subparser_name")
@@ -118,8 +164,12 @@ if __name__ == "__main__":
     rota_parser = subparsers.add_parser("rota")
     rota_parser.set_defaults(function=report_rota)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     if args.subparser_name == "on":
         print(args.function(args.start_date, args.end_date))
     else:
         print(args.function())
+
+
+if __name__ == "__main__":
+    run_from_command_line()
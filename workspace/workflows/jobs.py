@@ -1,8 +1,17 @@
 import argparse
+import fcntl
+import hashlib
+import itertools
 import json
 import os
+import sys
+import tempfile
+import threading
+import traceback
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from urllib.parse import urljoin
+from urllib.parse import parse_qs, urljoin, urlsplit
 
 import requests
 
@@ -16,7 +25,19 @@ from workspace.workflows import config
 
 
 CACHE_PATH = settings.WRITEABLE_DIR / "workflows_cache.json"
+HTTP_CACHE_DIR = settings.WRITEABLE_DIR / "workflows_http_cache"
 TOKEN = os.environ["DATA_TEAM_GITHUB_API_TOKEN"]  # requires "read:project" and "repo"
+# Summaries fetch the workflows for this many repos at once
+MAX_CONCURRENT_REPOS = 8
+# Workflows are rarely added or renamed, so each repo's workflow names are cached
+# for this many seconds
+WORKFLOWS_TTL = int(os.environ.get("WORKFLOWS_TTL", 24 * 60 * 60))
+# Pages of runs are retrieved until a run has been found for each workflow, up to
+# this many pages, so that a workflow that no longer runs on main doesn't cause the
+# whole history of a repo to be retrieved
+MAX_RUNS_PAGES = 10
+RUNS_PER_PAGE = 100
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 EMOJI = {
     "success": ":large_green_circle:",
     "running": ":large_yellow_circle:",
@@ -50,19 +71,193 @@ def report_invalid_org(org) -> str:
     return json.dumps(blocks)
 
 
+class HTTPCache:
+    """
+    Caches responses from the GitHub API in files in a directory.
+
+    GitHub returns an ETag (and sometimes a Last-Modified date) with each response,
+    which we send back with the next request for the same URL and parameters.  If
+    nothing has changed, GitHub responds with 304 Not Modified, which doesn't count
+    against our rate limit, and we use the cached response instead.
+
+    Each page of each endpoint has its own file, holding the response to the most
+    recent request for it, so that entries for old parameters (e.g. the created date
+    of runs) don't accumulate.  Files are replaced atomically, so concurrent jobs
+    don't see partially written entries.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, url: str, params: dict, headers: dict) -> dict:
+        return self.get_page(url, params, headers)[0]
+
+    def get_page(
+        self, url: str, params: dict, headers: dict
+    ) -> tuple[dict, str | None]:
+        """Return the response body, and the URL of the next page of results (or
+        None if this is the last page)."""
+        key = requests.Request("GET", url, params=params).prepare().url
+        path = self._get_path(key)
+        entry = self._read(path)
+        if entry is None or entry["key"] != key:
+            entry = None
+        else:
+            headers = {**headers, **self._get_conditional_headers(entry)}
+
+        response = session.get(url, headers=headers, params=params)
+        if entry is not None and response.status_code == 304:
+            with self._stats_lock:
+                self.hits += 1
+            return entry["body"], entry.get("next")
+
+        response.raise_for_status()
+        with self._stats_lock:
+            self.misses += 1
+        body = response.json()
+        next_url = response.links.get("next", {}).get("url")
+        if "ETag" in response.headers or "Last-Modified" in response.headers:
+            self._write(
+                path,
+                {
+                    "key": key,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "body": body,
+                    "next": next_url,
+                },
+            )
+        return body, next_url
+
+    def report(self):
+        print(
+            f"GitHub API cache: {self.hits} hits, {self.misses} misses",
+            file=sys.stderr,
+        )
+
+    @staticmethod
+    def _get_conditional_headers(entry) -> dict:
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def _get_path(self, key):
+        parts = urlsplit(key)
+        page = parse_qs(parts.query).get("page", ["1"])[0]
+        name = f"{parts.netloc}{parts.path}?page={page}"
+        return self.cache_dir / (hashlib.sha256(name.encode()).hexdigest() + ".json")
+
+    @staticmethod
+    def _read(path):
+        try:
+            return json.loads(path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write(self, path, entry):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        write_json_atomically(path, entry)
+
+
+def write_json_atomically(path, data):
+    """Write data to a temporary file and rename it to path, so that readers never
+    see a partially written file."""
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, suffix=".tmp", delete=False
+    ) as f:
+        json.dump(data, f)
+    os.replace(f.name, path)
+
+
+def get_session() -> requests.Session:
+    """Return a session whose connections to the GitHub API are kept alive and
+    shared by the threads that fetch each repo's workflows."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONCURRENT_REPOS)
+    session.mount("https://", adapter)
+    return session
+
+
+session = get_session()
+http_cache = HTTPCache(HTTP_CACHE_DIR)
+
+
 def get_api_result_as_json(url: str, params: dict | None = None) -> dict:
     params = params or {}
     params["format"] = "json"
     headers = {"Authorization": f"Bearer {TOKEN}"}
-    response = requests.get(url, headers=headers, params=params)
-    response.raise_for_status()
-    return response.json()
+    return http_cache.get(url, params, headers)
+
+
+def iter_api_pages(url: str, params: dict | None = None) -> Iterator[dict]:
+    """
+    Yield each page of results from the GitHub API, following the next links in the
+    Link headers of the responses.  Pages are only retrieved as they are needed, so
+    callers that stop early don't retrieve the remaining pages.
+    """
+    params = {**(params or {}), "format": "json"}
+    headers = {"Authorization": f"Bearer {TOKEN}"}
+    while url is not None:
+        body, url = http_cache.get_page(url, params, headers)
+        params = {}  # The next URL includes the parameters
+        yield body
 
 
-def load_cache() -> dict:
-    if not CACHE_PATH.exists():
-        return {}
-    return json.loads(CACHE_PATH.read_text())
+class WorkflowsCache:
+    """
+    The conclusions of each repo's workflows at the last retrieval, stored in a JSON
+    file keyed by repo location.
+
+    The file is read once, and updates are kept in memory until save() is called,
+    rather than the whole file being rewritten for each repo.  save() holds a lock
+    on a separate lock file while it merges the updates into the file's current
+    contents, so that jobs saving at the same time don't lose each other's updates,
+    and replaces the file atomically.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._contents = None
+        self._updates = {}
+        self._lock = threading.Lock()
+
+    def get(self, location) -> dict:
+        with self._lock:
+            if self._contents is None:
+                self._contents = self._read()
+            return self._contents.get(location, {})
+
+    def set(self, location, repo_cache):
+        with self._lock:
+            self._updates[location] = repo_cache
+            if self._contents is not None:
+                self._contents[location] = repo_cache
+
+    def save(self):
+        with self._lock:
+            if not self._updates:
+                return
+            lock_path = self.path.with_name(self.path.name + ".lock")
+            with open(lock_path, "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                contents = {**self._read(), **self._updates}
+                write_json_atomically(self.path, contents)
+            self._contents = contents
+            self._updates = {}
+
+    def _read(self) -> dict:
+        if not self.path.exists():
+            return {}
+        return json.loads(self.path.read_text())
+
+
+workflows_cache = WorkflowsCache(CACHE_PATH)
 
 
 def get_github_actions_link(location):
@@ -75,7 +270,7 @@ class RepoWorkflowReporter:
         Retrieves and reports on the status of workflow runs on the main branch in a specified repo.
         Workflows that are not on the main branch are skipped.
 
-        Creating an instance of this class will automatically call the GitHub API to get a list of workflow IDs and their names.
+        Creating an instance of this class will automatically get a list of workflow IDs and their names, from workflows_cache.json if they were retrieved from the GitHub API less than WORKFLOWS_TTL seconds ago.
         Subsequently calling get_latest_conclusions() will call a different endpoint of the API to get the status and conclusion for the most recent run of each workflow.
         workflows_cache.json is updated with the conclusions and the timestamp of the retrieval, and API calls are only made for new runs since the last retrieval.
 
@@ -91,13 +286,15 @@ class RepoWorkflowReporter:
         self.base_api_url = f"https://api.github.com/repos/{self.location}/"
         self.github_actions_link = get_github_actions_link(self.location)
 
+        self.cache = self._load_cache_for_repo()
+
+        self.cached_workflows = self.cache.get("workflows")
+        self.workflows_refreshed = False
         self.workflows = self.get_workflows()  # Dict of workflow_id: workflow_name
         self.workflow_ids = set(self.workflows.keys())
 
-        self.cache = self._load_cache_for_repo()
-
     def _load_cache_for_repo(self) -> dict:
-        return load_cache().get(self.location, {})
+        return workflows_cache.get(self.location)
 
     @property
     def last_retrieval_timestamp(self):
@@ -108,22 +305,71 @@ class RepoWorkflowReporter:
         url = urljoin(self.base_api_url, path)
         return get_api_result_as_json(url, params)
 
-    def get_workflows(self) -> dict:
-        results = self._get_json_response("actions/workflows")["workflows"]
-        workflows = {wf["id"]: wf["name"] for wf in results}
+    def get_workflows(self, refresh=False) -> dict:
+        if refresh or not self._cached_workflows_are_fresh():
+            results = self._get_json_response("actions/workflows")["workflows"]
+            self.cached_workflows = {
+                "timestamp": datetime.now().strftime(TIMESTAMP_FORMAT),
+                # To be consistent with the JSON file which has the IDs as strings
+                "names": {str(wf["id"]): wf["name"] for wf in results},
+            }
+            self.workflows_refreshed = True
+        workflows = {int(k): v for k, v in self.cached_workflows["names"].items()}
         self.remove_workflows_skipped_on_main(workflows)
         return workflows
 
+    def _cached_workflows_are_fresh(self) -> bool:
+        if self.cached_workflows is None:
+            return False
+        retrieved = datetime.strptime(
+            self.cached_workflows["timestamp"], TIMESTAMP_FORMAT
+        )
+        return (datetime.now() - retrieved).total_seconds() < WORKFLOWS_TTL
+
+    def refresh_workflows_if_unknown(self, run):
+        """
+        A run of a workflow that isn't in the cached workflows means that the
+        workflow has been added since they were retrieved, so retrieve them again.
+        """
+        if self.workflows_refreshed or run["workflow_id"] in self.workflow_ids:
+            return
+        skipped = config.SKIPPED_WORKFLOWS_ON_MAIN.get(self.location, [])
+        if run["workflow_id"] not in skipped:
+            self.workflows = self.get_workflows(refresh=True)
+            self.workflow_ids = set(self.workflows.keys())
+
     def remove_workflows_skipped_on_main(self, workflows):
         skipped = config.SKIPPED_WORKFLOWS_ON_MAIN.get(self.location, [])
         for workflow_id in skipped:
             workflows.pop(workflow_id, None)
 
-    def get_runs_since_last_retrieval(self) -> list:
-        params = {"branch": "main", "per_page": 100}
-        if self.last_retrieval_timestamp:  # If not present do not pass anything at all
-            params["created"] = ">=" + self.last_retrieval_timestamp
-        return self._get_json_response("actions/runs", params=params)["workflow_runs"]
+    def get_runs_since_last_retrieval(self) -> Iterator[dict]:
+        """
+        Yield runs since the last retrieval, most recent first, retrieving pages of
+        runs as they are needed.
+
+        The first page is requested without a created filter, so that the request is
+        the same each time, and GitHub responds with 304 Not Modified if no runs have
+        been created or updated since (see HTTPCache).  It may include runs from
+        before the last retrieval, which are still the latest runs of their
+        workflows.  Later pages are only needed if every run on the first page is
+        from since the last retrieval, and are requested with the created filter, so
+        that we don't page back through runs that we've already seen.
+        """
+        url = urljoin(self.base_api_url, "actions/runs")
+        params = {"branch": "main", "per_page": RUNS_PER_PAGE}
+        pages = iter_api_pages(url, params)
+        first_page = next(pages)["workflow_runs"]
+        yield from first_page
+
+        since = self.last_retrieval_timestamp
+        if since:
+            if len(first_page) < RUNS_PER_PAGE or first_page[-1]["created_at"] < since:
+                return
+            params = {**params, "created": ">=" + since, "page": 2}
+            pages = iter_api_pages(url, params)
+        for page in itertools.islice(pages, MAX_RUNS_PAGES - 1):
+            yield from page["workflow_runs"]
 
     def get_latest_conclusions(self) -> dict:
         """
@@ -131,7 +377,7 @@ class RepoWorkflowReporter:
         Update the cache file with the conclusions and the timestamp of the retrieval.
         """
         # Use the moment just before calling the GitHub API as the timestamp
-        timestamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+        timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
 
         new_runs = self.get_runs_since_last_retrieval()
         latest_runs, missing_ids = self.find_latest_for_each_workflow(new_runs)
@@ -140,14 +386,20 @@ class RepoWorkflowReporter:
         }
         self.fill_in_conclusions_for_missing_ids(conclusions, missing_ids)
 
-        self.cache = {
-            "timestamp": timestamp,
-            # To be consistent with the JSON file which has the IDs as strings
-            "conclusions": {str(k): v for k, v in conclusions.items()},
-        }
-
         pending = "running" in conclusions.values() or "queued" in conclusions.values()
-        if not pending:  # Only write cache to file if the status is final
+        if not pending:
+            self.cache = {
+                "timestamp": timestamp,
+                # To be consistent with the JSON file which has the IDs as strings
+                "conclusions": {str(k): v for k, v in conclusions.items()},
+                "workflows": self.cached_workflows,
+            }
+            self.write_cache_to_file()
+        elif self.workflows_refreshed:
+            # Only the final conclusions are cached, so keep the previous ones (and
+            # their timestamp) until the pending runs have finished, but keep the
+            # workflows so that they aren't retrieved again in the meantime
+            self.cache = {**self.cache, "workflows": self.cached_workflows}
             self.write_cache_to_file()
         return conclusions
 
@@ -171,10 +423,8 @@ class RepoWorkflowReporter:
         return
 
     def write_cache_to_file(self):
-        cache_file_contents = load_cache()
-        cache_file_contents[self.location] = self.cache
-        with open(CACHE_PATH, "w") as f:
-            f.write(json.dumps(cache_file_contents))
+        # The file is written when the job has finished (see main())
+        workflows_cache.set(self.location, self.cache)
 
     def report(self) -> str:
         # This needs to be a class method as it uses self.workflows for names
@@ -193,11 +443,19 @@ class RepoWorkflowReporter:
         return json.dumps(blocks)
 
     def find_latest_for_each_workflow(self, all_runs) -> list:
+        """
+        Find the most recent run of each workflow.  all_runs may be an iterator that
+        retrieves runs as they are needed, and we stop consuming it as soon as a run
+        has been found for each workflow.
+        """
         latest_runs = []
         found_ids = set()
         for run in all_runs:
+            self.refresh_workflows_if_unknown(run)
             if run["workflow_id"] in found_ids:
                 continue
+            if run["workflow_id"] not in self.workflow_ids:
+                continue  # The workflow is skipped on main
             latest_runs.append(run)
             found_ids.add(run["workflow_id"])
             if found_ids == self.workflow_ids:
@@ -216,13 +474,39 @@ def get_success_rate(conclusions) -> float:
     return conclusions.count("success") / len(conclusions)
 
 
-def _summarise(header_text: str, locations: list[str], skip_successful: bool) -> list:
+def get_conclusions_for_location(location: str) -> list:
+    """
+    Return the conclusions for each workflow in the repo at location.  If they
+    can't be retrieved, the repo is shown as missing, so that one repo doesn't stop
+    the others from being reported.
+    """
+    try:
+        return list(RepoWorkflowReporter(location).get_latest_conclusions().values())
+    except Exception:
+        print(f"Could not retrieve workflows for {location}", file=sys.stderr)
+        traceback.print_exc()
+        return ["missing"]
+
+
+def get_conclusions_for_locations(locations: list[str]) -> dict:
+    """
+    Return the conclusions for each location, in the same order as locations.
+    Retrieving them is mostly waiting for the GitHub API, so we retrieve several at
+    once.
+    """
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REPOS) as executor:
+        conclusions = executor.map(get_conclusions_for_location, locations)
+        return dict(zip(locations, conclusions))
+
+
+def _summarise(
+    header_text: str, conclusions_by_location: dict, skip_successful: bool
+) -> list:
     unsorted = {}
-    for location in locations:
-        wf_conclusions = RepoWorkflowReporter(location).get_latest_conclusions()
-        if skip_successful and get_success_rate(list(wf_conclusions.values())) == 1:
+    for location, wf_conclusions in conclusions_by_location.items():
+        if skip_successful and get_success_rate(wf_conclusions) == 1:
             continue
-        unsorted[location] = list(wf_conclusions.values())
+        unsorted[location] = wf_conclusions
 
     key = lambda item: get_success_rate(item[1])
     conclusions = sorted(unsorted.items(), key=key)
@@ -234,17 +518,23 @@ def _summarise(header_text: str, locations: list[str], skip_successful: bool) ->
     return blocks
 
 
-def summarise_team(team: str, skip_successful: bool) -> list:
+def summarise_team(
+    team: str, conclusions_by_location: dict, skip_successful: bool
+) -> list:
     header = f"Workflows for {team}"
     locations = get_locations_for_team(team)
-    return _summarise(header, locations, skip_successful)
+    team_conclusions = {loc: conclusions_by_location[loc] for loc in locations}
+    return _summarise(header, team_conclusions, skip_successful)
 
 
 def summarise_all(skip_successful) -> list:
-    # Show in sections by team
+    # Retrieve the conclusions for every team's repos together, and then show them
+    # in sections by team
+    locations = [loc for team in config.TEAMS for loc in get_locations_for_team(team)]
+    conclusions_by_location = get_conclusions_for_locations(locations)
     blocks = []
     for team in config.TEAMS:
-        team_blocks = summarise_team(team, skip_successful)
+        team_blocks = summarise_team(team, conclusions_by_location, skip_successful)
         if len(team_blocks) > 1:
             blocks.extend(team_blocks)
     return blocks
@@ -253,7 +543,8 @@ def summarise_all(skip_successful) -> list:
 def summarise_org(org, skip_successful) -> list:
     header_text = f"Workflows for {org} repos"
     locations = get_locations_for_org(org)
-    blocks = _summarise(header_text, locations, skip_successful)
+    conclusions_by_location = get_conclusions_for_locations(locations)
+    blocks = _summarise(header_text, conclusions_by_location, skip_successful)
     return blocks
 
 
@@ -273,7 +564,11 @@ def main(args) -> str:
 
     # Org may be a shorthand
     org = config.SHORTHANDS.get(org, org)
-    return _main(org, repo, args.skip_successful)
+    try:
+        return _main(org, repo, args.skip_successful)
+    finally:
+        workflows_cache.save()
+        http_cache.report()
 
 
 def _main(org, repo, skip_successful=False) -> str:
@@ -307,7 +602,7 @@ def get_text_blocks_for_key(args) -> str:
     return json.dumps(blocks)
 
 
-def get_command_line_parser():  # pragma: no cover
+def get_command_line_parser():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(required=True)
 
@@ -323,6 +618,10 @@ def get_command_line_parser():  # pragma: no cover
     return parser
 
 
-if __name__ == "__main__":
-    args = get_command_line_parser().parse_args()
+def run_from_command_line(argv=None):
+    args = get_command_line_parser().parse_args(argv)
     print(args.func(args))
+
+
+if __name__ == "__main__":
+    run_from_command_line()